@@ -0,0 +1,77 @@
+import math
+import hashlib
+
+# A Bloom filter of byte strings (Strong hashes of functions).
+# might_contain() never misses an added key, and wrongly answers True for a
+# key that was not added at a rate of about error_rate, as long as at most
+# capacity keys were added.
+#
+# The bit positions of a key are derived from one sha256 of the key, using
+# double hashing: position i is (h1 + i * h2) mod num_bits.
+
+class BloomFilterError(Exception): pass
+
+# Default rate of wrong positive answers:
+ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    def __init__(self,capacity,error_rate=ERROR_RATE):
+        """
+        A filter for up to capacity keys.
+        """
+        if capacity < 1:
+            raise BloomFilterError('capacity must be positive')
+        if not (0.0 < error_rate < 1.0):
+            raise BloomFilterError('error_rate must be between 0 and 1')
+
+        self.capacity = capacity
+        # Optimal amount of bits and hashes for capacity keys:
+        self._num_bits = max(8,int(math.ceil(\
+                -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self._num_hashes = max(1,int(round(\
+                (self._num_bits / capacity) * math.log(2))))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+        # Amount of added keys:
+        self.count = 0
+
+    def _positions(self,key):
+        digest = hashlib.sha256(key).digest()
+        h1 = int.from_bytes(digest[0:8],'little')
+        h2 = int.from_bytes(digest[8:16],'little') | 1
+        num_bits = self._num_bits
+        return [(h1 + (i * h2)) % num_bits for i in range(self._num_hashes)]
+
+    def add(self,key):
+        """
+        Add a key to the filter.
+        Returns True if the key might have been added before. (Such a key is
+        not counted again).
+        """
+        bits = self._bits
+        was_present = True
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not (bits[pos >> 3] & mask):
+                was_present = False
+                bits[pos >> 3] |= mask
+        if not was_present:
+            self.count += 1
+        return was_present
+
+    def might_contain(self,key):
+        """
+        Check if a key might have been added. (False means it was surely not
+        added).
+        """
+        for pos in self._positions(key):
+            if not (self._bits[pos >> 3] & (1 << (pos & 7))):
+                return False
+        return True
+
+    def is_full(self):
+        """
+        Check if more keys than the capacity were added. (The error rate is
+        then higher than requested).
+        """
+        return self.count > self.capacity
@@ -79,6 +79,9 @@ def slow_sign(data,num_perms):
 
 import hashlib
 
+# Length in bytes of a strong hash:
+STRONG_HASH_LEN = hashlib.sha256().digest_size
+
 def strong_hash(data):
     """
     Perform strong cryptographic hash.
@@ -87,6 +90,13 @@ def strong_hash(data):
     m.update(data)
     return m.digest()
 
+def strong_hasher():
+    """
+    Get an object for incremental strong hashing of data that arrives in
+    parts. Its digest() matches the result of strong_hash.
+    """
+    return hashlib.sha256()
+
 ########################################
 ########################################
 
@@ -135,3 +145,66 @@ def sign(data,num_perms):
     """
     return c1s.sign(data,num_perms)
 
+
+# Amount of bytes of one catalog1 window:
+WINDOW_SIZE = WORD_SIZE // BYTE_SIZE
+
+class Catalog1Signer:
+    """
+    Incremental catalog1 signer, for data that arrives in parts:
+
+        signer = Catalog1Signer(num_perms)
+        signer.update(part1)
+        signer.update(part2)
+        signer.digest() == sign(part1 + part2,num_perms)
+
+    Every entry of a signature is a minimum over all the windows of 4
+    consecutive bytes, so we only have to keep the running minimum and the
+    last 3 bytes of the data between updates.
+    """
+    def __init__(self,num_perms):
+        self._num_perms = num_perms
+        # Running signature. None until we have seen a full window:
+        self._sig = None
+        # Last (WINDOW_SIZE - 1) bytes of the data seen so far:
+        self._tail = b''
+        # Total amount of bytes seen so far:
+        self.data_len = 0
+
+    def _merge(self,sig):
+        """
+        Merge a signature of some windows into the running signature.
+        """
+        if self._sig is None:
+            self._sig = sig
+        else:
+            self._sig = [min(x,y) for x,y in zip(self._sig,sig)]
+
+    def update(self,data):
+        """
+        Feed more data to the signer.
+        """
+        self.data_len += len(data)
+
+        tail_data = self._tail + data[:WINDOW_SIZE - 1]
+        if len(tail_data) >= WINDOW_SIZE:
+            # Sign the windows that begin inside the previous tail:
+            self._merge(sign(tail_data,self._num_perms))
+
+        if len(data) >= WINDOW_SIZE:
+            self._merge(sign(data,self._num_perms))
+
+        if len(data) >= WINDOW_SIZE - 1:
+            self._tail = bytes(data[len(data) - (WINDOW_SIZE - 1):])
+        else:
+            self._tail = (self._tail + data)[-(WINDOW_SIZE - 1):]
+
+    def digest(self):
+        """
+        Get the signature of all the data fed so far.
+        """
+        if self._sig is None:
+            raise Catalog1Error('data must be at least of size {} bytes.'\
+                    .format(WINDOW_SIZE))
+        return list(self._sig)
+
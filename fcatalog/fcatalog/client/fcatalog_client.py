@@ -0,0 +1,485 @@
+import asyncio
+import collections
+import logging
+
+from fcatalog.proto.serializer import Serializer,ProtoDef
+from fcatalog.proto.frame_endpoint import TCPFrameEndpoint,MAX_FRAME_LEN
+from fcatalog.proto.msg_endpoint import MsgFromFrame
+from fcatalog.server.fcatalog_proto import \
+        ChooseDB,AddFunction,RequestSimilars,ResponseSimilars,\
+        RequestCompression,ResponseCompression,\
+        BeginAddFunction,BeginRequestSimilars,FuncDataChunk,EndFuncData,\
+        AddFunctionSigned,RequestSimilarsSigned,ChallengeFuncData,\
+        ChallengeResponse,SetQueryLimits,ResponseSimilarsApprox,\
+        SetMinGrade,SetQueryHashes
+from fcatalog.catalog1 import sign,strong_hash
+
+class FCatalogClientError(Exception): pass
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+
+# Protocol definition for the client side. (The mirror image of
+# FCatalogProtoDef):
+class FCatalogClientProtoDef(ProtoDef):
+    incoming_msgs = {\
+        3:ResponseSimilars,\
+        5:ResponseCompression,\
+        12:ChallengeFuncData,\
+        15:ResponseSimilarsApprox}
+    outgoing_msgs = {\
+        0:ChooseDB,\
+        1:AddFunction,\
+        2:RequestSimilars,\
+        4:RequestCompression,\
+        6:BeginAddFunction,\
+        7:BeginRequestSimilars,\
+        8:FuncDataChunk,\
+        9:EndFuncData,\
+        10:AddFunctionSigned,\
+        11:RequestSimilarsSigned,\
+        13:ChallengeResponse,\
+        14:SetQueryLimits,\
+        16:SetMinGrade,\
+        17:SetQueryHashes}
+
+client_serializer = Serializer(FCatalogClientProtoDef)
+
+
+# Default amount of hashes used by the server:
+NUM_HASHES = 16
+
+# Maximum amount of messages sent as one batch:
+BATCH_SIZE = 0x100
+
+# Maximum amount of requests waiting to be sent. add_function() blocks when
+# this amount is reached:
+MAX_QUEUED_REQUESTS = 0x1000
+
+# Function data longer than this is sent using a chunked transfer:
+MAX_INLINE_DATA_LEN = MAX_FRAME_LEN // 2
+# Size of one chunk in a chunked transfer:
+CHUNK_LEN = 0x40000
+
+# Amount of cached RequestSimilars results:
+CACHE_SIZE = 0x1000
+# Time in seconds a cached result stays valid:
+CACHE_TTL = 60.0
+
+# Amount of signed functions whose data is kept, to answer challenges from the
+# server:
+CHALLENGE_WINDOW = 0x1000
+
+
+class SimilarsResult(list):
+    """
+    A list of FSimilar returned by get_similars. approximate is True if the
+    server stopped the query at a limit (See max_candidates and query_deadline
+    of FCatalogClient), so more similar functions might exist.
+    """
+    def __init__(self,sims=(),approximate=False):
+        list.__init__(self,sims)
+        self.approximate = approximate
+
+
+class FCatalogClient:
+    def __init__(self,msg_endpoint,num_hashes=NUM_HASHES,sign_locally=False,\
+            batch_size=BATCH_SIZE,cache_size=CACHE_SIZE,cache_ttl=CACHE_TTL,\
+            max_candidates=None,query_deadline=None,min_grade=None,\
+            query_hashes=None,loop=None):
+        """
+        An asyncio fcatalog client over msg_endpoint.
+        Many requests may be in flight at the same time. Queued messages are
+        sent in batches.
+
+        If sign_locally is True, functions are signed on the client side, and
+        only their signatures are sent to the server.
+
+        max_candidates and query_deadline (In seconds) bound the work of the
+        server for every query. Results of queries that hit a limit are
+        marked approximate.
+
+        If min_grade is given, queries only return functions with a grade of
+        at least min_grade (And the exact match).
+
+        If query_hashes is given, the server searches candidates using only
+        the first query_hashes values of signatures: A quicker query, with
+        grades still over the whole signature.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+        self._msg_endpoint = msg_endpoint
+        self._num_hashes = num_hashes
+        self._sign_locally = sign_locally
+        self._batch_size = batch_size
+        self._max_candidates = max_candidates
+        self._query_deadline = query_deadline
+        self._min_grade = min_grade
+        self._query_hashes = query_hashes
+
+        # Lists of messages waiting to be sent. (Messages that should arrive
+        # together, like a chunked transfer, are queued as one list):
+        self._out_queue = asyncio.Queue(maxsize=MAX_QUEUED_REQUESTS,loop=loop)
+        # Futures waiting for ResponseSimilars, in the order of the requests:
+        self._pending = collections.deque()
+
+        # Cache of RequestSimilars results. Maps (func_hash,num_similars) to
+        # (expiry time,similars):
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        # Requests in flight, by (func_hash,num_similars):
+        self._inflight = {}
+
+        # Data of recently signed functions, by func_hash:
+        self._signed_data = collections.OrderedDict()
+
+        self._send_task = None
+        self._recv_task = None
+        self._is_open = False
+
+
+    @asyncio.coroutine
+    def start(self,db_name,compress=True):
+        """
+        Choose a database, and start the client.
+        If compress is True, frames compression is negotiated with the server.
+        """
+        if compress and self._msg_endpoint.can_compress():
+            msg_inst = client_serializer.get_msg('RequestCompression')
+            yield from self._msg_endpoint.send(msg_inst)
+            msg_inst = yield from self._msg_endpoint.recv()
+            if msg_inst is None or msg_inst.msg_name != 'ResponseCompression':
+                raise FCatalogClientError('Compression negotiation failed')
+            if msg_inst.get_field('accepted'):
+                self._msg_endpoint.enable_compression()
+
+        msg_inst = client_serializer.get_msg('ChooseDB')
+        msg_inst.set_field('db_name',db_name)
+        yield from self._msg_endpoint.send(msg_inst)
+
+        if self._max_candidates is not None or \
+                self._query_deadline is not None:
+            msg_inst = client_serializer.get_msg('SetQueryLimits')
+            msg_inst.set_field('max_candidates',self._max_candidates or 0)
+            deadline_ms = 0
+            if self._query_deadline is not None:
+                # 0 means no deadline, so use at least 1 millisecond:
+                deadline_ms = max(1,int(self._query_deadline * 1000))
+            msg_inst.set_field('deadline_ms',deadline_ms)
+            yield from self._msg_endpoint.send(msg_inst)
+
+        if self._min_grade is not None:
+            msg_inst = client_serializer.get_msg('SetMinGrade')
+            msg_inst.set_field('min_grade',self._min_grade)
+            yield from self._msg_endpoint.send(msg_inst)
+
+        if self._query_hashes is not None:
+            msg_inst = client_serializer.get_msg('SetQueryHashes')
+            msg_inst.set_field('num_hashes',self._query_hashes)
+            yield from self._msg_endpoint.send(msg_inst)
+
+        self._is_open = True
+        self._send_task = asyncio.ensure_future(self._send_loop(),\
+                loop=self._loop)
+        self._recv_task = asyncio.ensure_future(self._recv_loop(),\
+                loop=self._loop)
+
+
+    def _check_is_open(self):
+        """
+        Make sure that the client is open.
+        """
+        if not self._is_open:
+            raise FCatalogClientError('FCatalogClient is closed')
+
+
+    ###########################################################
+
+    @asyncio.coroutine
+    def _send_loop(self):
+        """
+        Send queued messages in batches.
+        """
+        while True:
+            msgs = list(( yield from self._out_queue.get() ))
+            num_items = 1
+            while len(msgs) < self._batch_size and \
+                    not self._out_queue.empty():
+                msgs.extend(self._out_queue.get_nowait())
+                num_items += 1
+
+            try:
+                if self._is_open:
+                    yield from self._msg_endpoint.send_many(msgs)
+            except (OSError,RuntimeError):
+                # The connection was lost. The receiving side will notice
+                # this too.
+                logger.exception('Failed sending messages')
+                self._is_open = False
+            finally:
+                for _ in range(num_items):
+                    self._out_queue.task_done()
+
+
+    @asyncio.coroutine
+    def _recv_loop(self):
+        """
+        Receive messages from the server.
+        """
+        try:
+            while True:
+                msg_inst = yield from self._msg_endpoint.recv()
+                if msg_inst is None:
+                    break
+
+                if msg_inst.msg_name in ('ResponseSimilars',\
+                        'ResponseSimilarsApprox'):
+                    if not self._pending:
+                        logger.warning('Unexpected {}'.\
+                                format(msg_inst.msg_name))
+                        break
+                    approximate = False
+                    if msg_inst.msg_name == 'ResponseSimilarsApprox':
+                        approximate = bool(msg_inst.get_field('approximate'))
+                    fut = self._pending.popleft()
+                    if not fut.done():
+                        fut.set_result(SimilarsResult(\
+                                msg_inst.get_field('similars'),approximate))
+
+                elif msg_inst.msg_name == 'ChallengeFuncData':
+                    self._answer_challenge(msg_inst.get_field('func_hash'))
+
+                else:
+                    logger.warning('Unexpected message {}'.\
+                            format(msg_inst.msg_name))
+                    break
+        finally:
+            self._is_open = False
+            # Fail all the requests that are still waiting:
+            while self._pending:
+                fut = self._pending.popleft()
+                if not fut.done():
+                    fut.set_exception(\
+                            FCatalogClientError('Connection was closed'))
+
+
+    def _answer_challenge(self,func_hash):
+        """
+        Answer a ChallengeFuncData message, if we still have the function
+        data.
+        """
+        func_data = self._signed_data.pop(func_hash,None)
+        if func_data is None:
+            logger.warning('Can not answer a challenge for func_hash {}'.\
+                    format(func_hash))
+            return
+
+        msg_inst = client_serializer.get_msg('ChallengeResponse')
+        msg_inst.set_field('func_data',func_data)
+        # The receiving loop should not block on a full queue:
+        asyncio.ensure_future(self._out_queue.put([msg_inst]),loop=self._loop)
+
+
+    def _chunked_msgs(self,begin_msg,func_data):
+        """
+        Get a list of messages for a chunked transfer of func_data.
+        """
+        msgs = [begin_msg]
+        for i in range(0,len(func_data),CHUNK_LEN):
+            msg_inst = client_serializer.get_msg('FuncDataChunk')
+            msg_inst.set_field('data_chunk',func_data[i:i+CHUNK_LEN])
+            msgs.append(msg_inst)
+        msgs.append(client_serializer.get_msg('EndFuncData'))
+        return msgs
+
+
+    ###########################################################
+
+    @asyncio.coroutine
+    def add_function(self,func_name,func_comment,func_data):
+        """
+        Add a function to the remote database.
+        Returns once the function was queued. (Use flush() to wait until all
+        queued messages were sent).
+        """
+        self._check_is_open()
+        # Our cached results might not be correct anymore:
+        self._cache.clear()
+
+        if self._sign_locally:
+            func_hash = strong_hash(func_data)
+            msg_inst = client_serializer.get_msg('AddFunctionSigned')
+            msg_inst.set_field('func_name',func_name)
+            msg_inst.set_field('func_comment',func_comment)
+            msg_inst.set_field('func_hash',func_hash)
+            msg_inst.set_field('func_sig',sign(func_data,self._num_hashes))
+            msgs = [msg_inst]
+
+            # Keep the function data, in case we are challenged:
+            self._signed_data[func_hash] = func_data
+            while len(self._signed_data) > CHALLENGE_WINDOW:
+                self._signed_data.popitem(last=False)
+
+        elif len(func_data) > MAX_INLINE_DATA_LEN:
+            msg_inst = client_serializer.get_msg('BeginAddFunction')
+            msg_inst.set_field('func_name',func_name)
+            msg_inst.set_field('func_comment',func_comment)
+            msgs = self._chunked_msgs(msg_inst,func_data)
+
+        else:
+            msg_inst = client_serializer.get_msg('AddFunction')
+            msg_inst.set_field('func_name',func_name)
+            msg_inst.set_field('func_comment',func_comment)
+            msg_inst.set_field('func_data',func_data)
+            msgs = [msg_inst]
+
+        yield from self._out_queue.put(msgs)
+
+
+    @asyncio.coroutine
+    def get_similars(self,func_data,num_similars):
+        """
+        Get a list of at most num_similars functions (FSimilar) similar to
+        func_data from the remote database, as a SimilarsResult.
+        Results are cached locally for cache_ttl seconds. (Approximate results
+        are not cached).
+        """
+        self._check_is_open()
+        func_hash = strong_hash(func_data)
+        key = (func_hash,num_similars)
+
+        # Check the local cache:
+        cached = self._cache.get(key)
+        if cached is not None:
+            expiry,sims = cached
+            if expiry > self._loop.time():
+                self._cache.move_to_end(key)
+                return SimilarsResult(sims)
+            del self._cache[key]
+
+        # Share identical requests that are already in flight:
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.Future(loop=self._loop)
+            self._inflight[key] = fut
+            try:
+                yield from self._request_similars(fut,func_hash,func_data,\
+                        num_similars)
+            except Exception:
+                del self._inflight[key]
+                raise
+
+        try:
+            sims = yield from asyncio.shield(fut,loop=self._loop)
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+        if not sims.approximate:
+            self._cache_result(key,sims)
+        return SimilarsResult(sims,sims.approximate)
+
+
+    @asyncio.coroutine
+    def _request_similars(self,fut,func_hash,func_data,num_similars):
+        """
+        Queue a request for similars. fut will be resolved with the result.
+        """
+        if self._sign_locally:
+            msg_inst = client_serializer.get_msg('RequestSimilarsSigned')
+            msg_inst.set_field('func_hash',func_hash)
+            msg_inst.set_field('func_sig',sign(func_data,self._num_hashes))
+            msg_inst.set_field('num_similars',num_similars)
+            msgs = [msg_inst]
+
+        elif len(func_data) > MAX_INLINE_DATA_LEN:
+            msg_inst = client_serializer.get_msg('BeginRequestSimilars')
+            msg_inst.set_field('num_similars',num_similars)
+            msgs = self._chunked_msgs(msg_inst,func_data)
+
+        else:
+            msg_inst = client_serializer.get_msg('RequestSimilars')
+            msg_inst.set_field('func_data',func_data)
+            msg_inst.set_field('num_similars',num_similars)
+            msgs = [msg_inst]
+
+        yield from self._out_queue.put(msgs)
+        # Responses arrive in the order of the requests. (Nothing can run
+        # between the put above and this append):
+        self._pending.append(fut)
+        if not self._is_open:
+            # The connection was closed while we were waiting for the queue:
+            fut.set_exception(FCatalogClientError('Connection was closed'))
+
+
+    def _cache_result(self,key,sims):
+        """
+        Keep a RequestSimilars result in the local cache.
+        """
+        if self._cache_size <= 0:
+            return
+        self._cache[key] = (self._loop.time() + self._cache_ttl,tuple(sims))
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Wait until all the queued messages were sent.
+        """
+        yield from self._out_queue.join()
+
+
+    @asyncio.coroutine
+    def close(self):
+        """
+        Send all queued messages, and close the connection.
+        """
+        if self._send_task is not None and self._is_open:
+            yield from self.flush()
+
+        self._is_open = False
+        yield from self._msg_endpoint.close()
+
+        # Stop the sending and receiving tasks:
+        tasks = [t for t in [self._send_task,self._recv_task] if t is not None]
+        self._send_task = None
+        self._recv_task = None
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            yield from asyncio.wait(tasks,loop=self._loop)
+
+
+###################################################################
+
+
+@asyncio.coroutine
+def open_client(host,port,db_name,compress=True,loop=None,**kwargs):
+    """
+    Connect to a fcatalog server, choose a database and return an
+    FCatalogClient.
+    Extra keyword arguments are passed to FCatalogClient.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    reader,writer = yield from asyncio.open_connection(host=host,port=port,\
+            loop=loop)
+    frame_endpoint = TCPFrameEndpoint(reader,writer)
+    msg_endpoint = MsgFromFrame(client_serializer,frame_endpoint)
+
+    client = FCatalogClient(msg_endpoint,loop=loop,**kwargs)
+    try:
+        yield from client.start(db_name,compress=compress)
+    except Exception:
+        yield from msg_endpoint.close()
+        raise
+
+    return client
@@ -0,0 +1,78 @@
+import asyncio
+
+from fcatalog.client.fcatalog_client import open_client
+
+# A synchronous wrapper around FCatalogClient, for environments without a
+# running event loop (Like IDA python scripts). The wrapper runs its own event
+# loop, only while one of its methods is called.
+
+class FCatalogSyncClient:
+    def __init__(self,host,port,db_name,compress=True,**kwargs):
+        """
+        Connect to a fcatalog server and choose a database.
+        Extra keyword arguments are passed to FCatalogClient.
+        """
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._client = self._loop.run_until_complete(\
+                    open_client(host,port,db_name,compress=compress,\
+                    loop=self._loop,**kwargs))
+        except Exception:
+            self._loop.close()
+            raise
+
+    def add_function(self,func_name,func_comment,func_data):
+        """
+        Add a function to the remote database.
+        The function is only queued. It is sent on the next call that waits for
+        the server (Or on flush).
+        """
+        self._loop.run_until_complete(\
+                self._client.add_function(func_name,func_comment,func_data))
+
+    def add_functions(self,funcs):
+        """
+        Add many functions to the remote database.
+        funcs is an iterable of (func_name,func_comment,func_data) tuples.
+        """
+        @asyncio.coroutine
+        def add_all():
+            for func_name,func_comment,func_data in funcs:
+                yield from self._client.add_function(\
+                        func_name,func_comment,func_data)
+            yield from self._client.flush()
+
+        self._loop.run_until_complete(add_all())
+
+    def get_similars(self,func_data,num_similars):
+        """
+        Get a list of similar functions (FSimilar) to func_data.
+        """
+        return self._loop.run_until_complete(\
+                self._client.get_similars(func_data,num_similars))
+
+    def get_similars_many(self,funcs_data,num_similars):
+        """
+        Get a list of similar functions for every function data in funcs_data.
+        All the requests are in flight together.
+        Returns a list of results, in the order of funcs_data.
+        """
+        coros = [self._client.get_similars(func_data,num_similars) \
+                for func_data in funcs_data]
+        return self._loop.run_until_complete(\
+                asyncio.gather(*coros,loop=self._loop))
+
+    def flush(self):
+        """
+        Wait until all queued messages were sent.
+        """
+        self._loop.run_until_complete(self._client.flush())
+
+    def close(self):
+        """
+        Send all queued messages, and close the connection.
+        """
+        try:
+            self._loop.run_until_complete(self._client.close())
+        finally:
+            self._loop.close()
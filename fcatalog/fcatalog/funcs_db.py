@@ -1,26 +1,279 @@
 import sqlite3
 import os
+import time
+import string
+import struct
+import hashlib
+import logging
+import itertools
+import threading
 import collections
 
 from fcatalog.catalog1 import sign,strong_hash
+from fcatalog.sig_index import SigIndex,SIG_INDEX_SUFFIX
+from fcatalog.bloom_filter import BloomFilter
+from fcatalog.metrics import SIGN_LATENCY,QUERY_LATENCY,QUERY_CANDIDATES,\
+        QUERY_RESULTS,COMMIT_LATENCY,OPEN_DB_HANDLES,ADDED_FUNCTIONS,\
+        MAINTENANCE_RUNS,MAINTENANCE_LATENCY,VACUUMED_PAGES
 
 
 # Commit after this amount of functions inserted into the DB:
 FUNCTION_BATCH = 0x800
 
+# Tuning profiles:
+# The SQLite settings of every connection to a database come from a tuning
+# profile, chosen per database (See server_conf):
+# - page_size: Size of database pages, in bytes. Only set when the database
+#   is created.
+# - cache_size: Maximum size of the page cache of every connection, in KiB.
+#   Every connection to a database (Every served client) has its own cache.
+# - mmap_size: Amount of bytes of the database file that are memory mapped.
+#   Mapped pages are shared by all the connections and processes through the
+#   OS page cache, so this is the way to use a lot of RAM for a large
+#   database. (Limited by the maximum of the SQLite build, often 2 GB).
+# - temp_store: Where temporary tables and indices (Of UNION and ORDER BY)
+#   are kept: DEFAULT (A file) or MEMORY.
+# - journal_mode: WAL for all profiles, as databases are shared by server
+#   processes (See below).
+# - synchronous: NORMAL does not wait for the disk on commits. OFF does not
+#   wait for it on checkpoints either (A power failure may then corrupt the
+#   database), and is only meant for loading a new database.
+# - busy_timeout: Amount of seconds to wait for a lock held by another
+#   connection (Possibly in another server process) before giving up.
+TuningProfile = collections.namedtuple('TuningProfile',['page_size',\
+        'cache_size','mmap_size','temp_store','journal_mode','synchronous',\
+        'busy_timeout'])
+
+TUNING_PROFILES = {
+    # SQLite defaults, for databases of up to a few hundreds of MB:
+    'small': TuningProfile(page_size=0x1000,cache_size=0x800,mmap_size=0,\
+            temp_store='DEFAULT',journal_mode='WAL',synchronous='NORMAL',\
+            busy_timeout=5.0),
+    # Databases of many GB that are mostly read, on a server with plenty of
+    # RAM. Most of the file is mapped, and the per connection caches stay
+    # moderate:
+    'large': TuningProfile(page_size=0x2000,cache_size=0x10000,\
+            mmap_size=0x400000000,temp_store='MEMORY',journal_mode='WAL',\
+            synchronous='NORMAL',busy_timeout=10.0),
+    # Loading many functions with a few connections (For example, into a new
+    # database):
+    'bulk': TuningProfile(page_size=0x2000,cache_size=0x80000,mmap_size=0,\
+            temp_store='MEMORY',journal_mode='WAL',synchronous='OFF',\
+            busy_timeout=60.0),
+}
+
+# Default tuning profile:
+DEFAULT_TUNING_PROFILE = 'small'
+
+# Maximum amount of variables in one SQL statement:
+MAX_SQL_VARS = 500
+
+# Hot values:
+# Some signature values (Of common prologues, padding and thunks) appear in a
+# large fraction of all the functions. A query that contains one of them would
+# take all these functions as candidates. The value_counts table keeps the
+# amount of functions that have every value (At every signature column), and
+# is updated by triggers on every insert and delete. A value that appears in
+# more than hot_threshold functions gives at most hot_cap candidates. The
+# candidates are still graded using all their signature values.
+#
+# The counts of a database created before value_counts existed start from
+# zero. Use rebuild_value_counts() (fcatalog-value-stats --rebuild) to count
+# the existing functions.
+
+# Default amount of functions above which a value is hot:
+HOT_VALUE_THRESHOLD = 0x2000
+# Default maximum amount of candidates taken for a hot value:
+HOT_VALUE_CAP = 0x100
+# Values that appear in more than this amount of functions are indexed by
+# their count, and are listed by hot_values():
+HOT_VALUE_MIN_COUNT = 0x40
+
+# Minimum grade:
+# A query may ask only for functions with a grade of at least min_grade. Such a
+# function matches the signature at min_grade columns, so (By pigeonhole) it
+# matches at least one of any num_hashes - min_grade + 1 columns. Only this
+# amount of columns is searched for candidates, choosing the columns with the
+# least common values (Using value_counts). For example, with 16 hashes and a
+# minimum grade of 10, the candidates of only 7 out of 16 values are taken.
+
+# Coarse queries:
+# Catalog1 signatures are prefix stable: The first k values of a signature of
+# any length are the signature of length k. A database may keep long
+# signatures (For example 64 hashes), and a query may give coarse_hashes=k: Its
+# candidates are searched and ranked using only the first k values, which is
+# as cheap as a query on a database of k hashes. Only the best
+# num_similars * REFINE_FACTOR candidates are then graded using the whole
+# signature. Grades of results are always over the whole signature.
+
+# Amount of coarse candidates graded using the whole signature, for every
+# requested similar:
+REFINE_FACTOR = 4
+
+# The deadline of a bounded query (See get_similars_by_signature) is checked
+# every this amount of SQLite virtual machine instructions:
+DEADLINE_CHECK_STEPS = 1000
+
+# Duplicate uploads:
+# Most added functions are re-uploads of functions that are already in the
+# database. Replacing such a row would rewrite it and all its signature index
+# entries. Instead, a function whose signature, name and comment are unchanged
+# is skipped, and a function whose name or comment changed only has these
+# columns updated. (Only a function with another signature replaces its row).
+#
+# To avoid looking up every new function, every server process keeps a Bloom
+# filter of the strong hashes in every database it opened, updated on every
+# insert. A function that is not in the filter is inserted directly.
+# (Functions inserted by other processes may be missing from the filter, so
+# the insert does nothing on a conflict, and the function is then looked up).
+# Reading all the strong hashes of a large database takes seconds, so the
+# filter is built using a connection of its own (See
+# FuncsDB.build_hash_filter), which the server runs outside of the event loop
+# when the database is first opened and when the filter fills up. Until the
+# filter is built, every added function is looked up.
+
+# Minimum capacity of the strong hash filter of a database. The filter is
+# rebuilt with twice the capacity when it fills up:
+HASH_FILTER_MIN_CAPACITY = 0x10000
+
+# Signature clusters:
+# Many functions (Compiler generated stubs, copies of statically linked
+# library functions under other names) have exactly the same signature. In a
+# clustered database every distinct signature is kept once, in the sigs
+# table, and every function in the funcs table links to its signature by
+# sig_id. The signature column indices, value_counts and the signature index
+# are all over sigs, so a signature shared by many functions is one
+# candidate. Queries grade signatures, and only the best ones are expanded
+# to their member functions.
+#
+# num_funcs of a signature is kept by triggers on funcs, and a signature is
+# deleted together with its last function. Signatures are looked up by
+# sig_key, a 64 bit hash of their values.
+#
+# New databases are clustered. A database created before clusters existed
+# keeps its layout, where every function row holds its own signature. It is
+# queried the same way, as if every function was a cluster of its own (With
+# its rowid as the sig_id).
+
+# Maintenance:
+# Servers call maintain() on the databases they serve, when the databases are
+# idle (See fcatalog.server.maintenance). It runs a few steps, each in its own
+# transaction:
+# - analyze: ANALYZE gathers statistics of the tables and indices for the
+#   query planner. Only ANALYSIS_LIMIT rows of every index are examined, so it
+#   is quick on a large database.
+# - vacuum: Pages of deleted and replaced rows stay in the freelist of the
+#   file. New databases use incremental auto vacuum, and every run returns at
+#   most vacuum_pages free pages to the file system. (A database created before
+#   that has no auto vacuum. fcatalog-migrate turns it on).
+# - checkpoint: Copy the WAL into the database file and truncate it. The
+#   checkpoint holds the write lock while it waits for readers, so it waits
+#   only CHECKPOINT_BUSY_TIMEOUT (Instead of the busy timeout of the
+#   connection). It is busy if readers or writers did not let it finish by
+#   then, and the next run tries again.
+# The time of the last maintenance is kept in the meta table, so server
+# processes that share a database do not all maintain it.
+
+# Amount of rows of every index examined by ANALYZE:
+ANALYSIS_LIMIT = 1000
+# Default maximum amount of free pages returned by one maintenance run:
+MAINTENANCE_VACUUM_PAGES = 0x1000
+# Time a checkpoint waits for readers and writers, in milliseconds:
+CHECKPOINT_BUSY_TIMEOUT = 100
+
+# UPSERT is available since SQLite 3.24. It makes the value_counts trigger a
+# few times faster:
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3,24,0)
+
+# The candidates of a query without the signature index are counted (For the
+# QUERY_CANDIDATES metric) by a separate COUNT statement, which costs about as
+# much as the query itself. One in every CANDIDATES_SAMPLE_PERIOD such queries
+# of a process is counted:
+CANDIDATES_SAMPLE_PERIOD = 0x40
+_sql_queries = itertools.count()
+
 class FuncsDBError(Exception):
     pass
 
+# Strong hash filters of the databases opened by this process, by database
+# path, and the paths of the databases whose filter is being built:
+_hash_filters = {}
+_hash_filter_builds = set()
+_hash_filter_lock = threading.Lock()
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+
+def is_good_db_name(db_name):
+    """
+    Check if a db_name is valid. We have to be careful of directory traversal
+    here.
+    """
+    good_chars = string.ascii_letters + string.digits + "_"
+    for c in db_name:
+        if c not in good_chars:
+            return False
+
+    return True
+
+
+def sig_key(func_sig):
+    """
+    Get the key of a signature in the sigs table: A signed 64 bit hash of its
+    values.
+    """
+    data = struct.pack('<{}q'.format(len(func_sig)),*func_sig)
+    return int.from_bytes(hashlib.sha256(data).digest()[:8],'little',\
+            signed=True)
+
 
 DBSimilar = collections.namedtuple('DBSimilar',\
         ['func_hash','func_name','func_comment','func_sig','func_grade'])
 
 
+class Similars(list):
+    """
+    A list of DBSimilar, ordered by similarity. approximate is True if some
+    candidates were left out by the limits of the query, so more similar
+    functions might exist.
+    """
+    def __init__(self,sims=(),approximate=False):
+        list.__init__(self,sims)
+        self.approximate = approximate
+
+
 class FuncsDB:
-    def __init__(self,db_path,num_hashes):
+    def __init__(self,db_path,num_hashes,busy_timeout=None,\
+            use_sig_index=False,hot_threshold=HOT_VALUE_THRESHOLD,\
+            hot_cap=HOT_VALUE_CAP,clustered=True,\
+            tuning_profile=DEFAULT_TUNING_PROFILE):
+        """
+        If use_sig_index is True, similarity queries are answered using a
+        SigIndex kept beside the database file (Shared between all the
+        processes that use the database).
+        Values that appear in more than hot_threshold functions give at most
+        hot_cap candidates to a query (See Hot values above). A hot_threshold
+        of None disables this.
+        clustered chooses the layout of a new database (See Signature clusters
+        above). An existing database keeps its layout.
+        tuning_profile is the name of the SQLite settings of the connection
+        (See Tuning profiles above). busy_timeout (In seconds) overrides the
+        busy timeout of the profile.
+        """
+        profile = TUNING_PROFILES.get(tuning_profile)
+        if profile is None:
+            raise FuncsDBError('Unknown tuning profile {!r}'.\
+                    format(tuning_profile))
+        if busy_timeout is None:
+            busy_timeout = profile.busy_timeout
+
         # Keep as members:
         self._db_path = db_path
+        self._tuning_profile = tuning_profile
         self._num_hashes = num_hashes
+        self._hot_threshold = hot_threshold
+        self._hot_cap = hot_cap
 
         # Inserted functions waiting to be commited:
         self._funcs_pending = 0
@@ -30,13 +283,70 @@ class FuncsDB:
         if os.path.isfile(db_path):
             db_existed = True
 
-        # Open a connection to the database.
-        self._conn = sqlite3.connect(self._db_path,isolation_level=None)
+        # Open a connection to the database. The connection may be used from
+        # another thread (See FCatalogServerLogic), but never concurrently:
+        self._conn = sqlite3.connect(self._db_path,isolation_level=None,\
+                timeout=busy_timeout,check_same_thread=False)
         self._is_open = True
+        OPEN_DB_HANDLES.inc()
+
+        c = self._conn.cursor()
+        # The page size can only be changed before the database is written
+        # to (Including the switch to WAL):
+        if not db_existed:
+            c.execute('PRAGMA page_size={}'.format(profile.page_size))
+            # (See Maintenance above):
+            c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # Write ahead logging lets readers and a writer from different
+        # connections (And processes) work concurrently. The journal mode is
+        # persistent in the database file:
+        c.execute('PRAGMA journal_mode={}'.format(profile.journal_mode))
+        # With WAL, a commit does not have to wait for the disk. (A commit may
+        # be lost on power failure, but the database stays consistent):
+        c.execute('PRAGMA synchronous={}'.format(profile.synchronous))
+        # A negative cache_size is in KiB:
+        c.execute('PRAGMA cache_size={}'.format(-profile.cache_size))
+        c.execute('PRAGMA mmap_size={}'.format(profile.mmap_size))
+        c.execute('PRAGMA temp_store={}'.format(profile.temp_store))
+        # INSERT OR REPLACE fires the delete triggers of the replaced rows only
+        # with recursive triggers. (Keeps value_counts correct):
+        c.execute('PRAGMA recursive_triggers=ON')
 
         # If the database file did not exist, we create an empty database:
+        if db_existed:
+            self._clustered = self._has_table('sigs')
+        else:
+            self._clustered = clustered
+        self._set_layout()
+
         if not db_existed:
             self._build_empty_db()
+        else:
+            self._check_num_hashes()
+            # A database created before the meta table or value_counts
+            # existed:
+            if not self._has_table('meta'):
+                self._build_meta_table()
+            if not self._has_table('value_counts'):
+                self._build_value_counts()
+                logger.warning('Created value_counts for %s. Counts of'
+                        ' existing functions are missing until it is'
+                        ' rebuilt',db_path)
+
+        self._sig_index = None
+        if use_sig_index:
+            self._sig_index = SigIndex(db_path + SIG_INDEX_SUFFIX,num_hashes)
+            self._sync_sig_index()
+
+        # The strong hash filter (See Duplicate uploads above), or None until
+        # it is built:
+        if db_path == ':memory:':
+            # Nobody else sees the database, which is empty:
+            self._hash_filter_key = None
+            self._hash_filter = BloomFilter(HASH_FILTER_MIN_CAPACITY)
+        else:
+            self._hash_filter_key = os.path.realpath(db_path)
+            self._hash_filter = _hash_filters.get(self._hash_filter_key)
 
         # Begin transaction for inserts:
         c = self._conn.cursor()
@@ -58,14 +368,20 @@ class FuncsDB:
         self._check_is_open()
         # Set state to be closed:
         self._is_open = False
+        OPEN_DB_HANDLES.dec()
 
         c = self._conn.cursor()
         try:
-            c.execute('COMMIT')
+            self._bump_generation()
+            with COMMIT_LATENCY.time():
+                c.execute('COMMIT')
         except sqlite3.Error as e:
             c.execute('ROLLBACK')
         self._conn.close()
 
+        if self._sig_index is not None:
+            self._sig_index.close()
+
 
     def commit_funcs(self):
         """
@@ -74,9 +390,11 @@ class FuncsDB:
         self._check_is_open()
         c = self._conn.cursor()
         try:
+            self._bump_generation()
             # Zero the amount of pending functions:
             self._funcs_pending = 0
-            c.execute('COMMIT')
+            with COMMIT_LATENCY.time():
+                c.execute('COMMIT')
         except sqlite3.Error:
             c.execute('ROLLBACK')
 
@@ -84,6 +402,255 @@ class FuncsDB:
         c.execute('BEGIN TRANSACTION')
 
 
+    def _bump_generation(self):
+        """
+        Increase the write generation of the database, if functions were
+        written in the current transaction. The generation is written in the
+        same transaction as the functions.
+        """
+        if self._funcs_pending > 0:
+            c = self._conn.cursor()
+            c.execute('UPDATE meta SET value = value + 1 WHERE key=?',\
+                    ('generation',))
+
+
+    def generation(self):
+        """
+        Get the write generation of the database: A number that changes
+        whenever functions are committed to the database (By any connection).
+        Results of queries may be reused as long as the generation is the
+        same. Returns None if the generation could not be read.
+        """
+        self._check_is_open()
+        c = self._conn.cursor()
+        try:
+            c.execute('SELECT value FROM meta WHERE key=?',('generation',))
+            row = c.fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return row[0]
+
+
+    def settings(self):
+        """
+        Get the current SQLite settings of the connection (See Tuning profiles
+        above), and the size of the database. Returns a dict.
+        """
+        self._check_is_open()
+        c = self._conn.cursor()
+        res = {'tuning_profile': self._tuning_profile,\
+                'clustered': self._clustered}
+        for pragma in ('page_size','cache_size','mmap_size','temp_store',\
+                'journal_mode','synchronous','busy_timeout','auto_vacuum',\
+                'page_count','freelist_count'):
+            c.execute('PRAGMA ' + pragma)
+            row = c.fetchone()
+            # (mmap_size is empty if memory mapping is not supported):
+            res[pragma] = None if row is None else row[0]
+        return res
+
+
+    def maintain(self,min_interval=0,vacuum_pages=MAINTENANCE_VACUUM_PAGES):
+        """
+        Run the maintenance steps of the database (See Maintenance above),
+        unless it was maintained (By any connection) in the last min_interval
+        seconds. Pending functions are committed first.
+        Returns a dict with the result of every step: done, busy, skipped or
+        failed. Returns None if the database was maintained recently.
+        """
+        self._check_is_open()
+        self.commit_funcs()
+        c = self._conn.cursor()
+        # Every step runs in its own transaction:
+        c.execute('COMMIT')
+        try:
+            # Claim the maintenance of the database, unless another
+            # connection did it recently:
+            now = int(time.time())
+            c.execute('INSERT OR IGNORE INTO meta (key,value) VALUES (?,?)',\
+                    ('maintained',0))
+            c.execute('UPDATE meta SET value=? WHERE key=? AND value <= ?',\
+                    (now,'maintained',now - min_interval))
+            if c.rowcount != 1:
+                return None
+
+            results = {}
+            for step,run_step in (('analyze',self._analyze),\
+                    ('vacuum',lambda: self._vacuum(vacuum_pages)),\
+                    ('checkpoint',self._checkpoint)):
+                with MAINTENANCE_LATENCY.labels(step).time():
+                    try:
+                        result = run_step()
+                    except sqlite3.Error as e:
+                        logger.warning('Maintenance step %s of %s failed:'
+                                ' %s',step,self._db_path,e)
+                        result = 'failed'
+                MAINTENANCE_RUNS.labels(step,result).inc()
+                results[step] = result
+            return results
+
+        finally:
+            c.execute('BEGIN TRANSACTION')
+
+
+    def _analyze(self):
+        c = self._conn.cursor()
+        c.execute('PRAGMA analysis_limit={}'.format(ANALYSIS_LIMIT))
+        c.execute('ANALYZE')
+        return 'done'
+
+
+    def _vacuum(self,vacuum_pages):
+        c = self._conn.cursor()
+        c.execute('PRAGMA auto_vacuum')
+        # 2 is INCREMENTAL:
+        if c.fetchone()[0] != 2:
+            return 'skipped'
+        c.execute('PRAGMA freelist_count')
+        free_before = c.fetchone()[0]
+        if free_before == 0:
+            return 'skipped'
+        # A page is freed on every step of the statement:
+        c.execute('PRAGMA incremental_vacuum({})'.format(vacuum_pages))
+        c.fetchall()
+        c.execute('PRAGMA freelist_count')
+        VACUUMED_PAGES.inc(free_before - c.fetchone()[0])
+        return 'done'
+
+
+    def _checkpoint(self):
+        c = self._conn.cursor()
+        c.execute('PRAGMA busy_timeout')
+        busy_timeout = c.fetchone()[0]
+        c.execute('PRAGMA busy_timeout={}'.format(CHECKPOINT_BUSY_TIMEOUT))
+        try:
+            c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            busy,log_pages,checkpointed_pages = c.fetchone()
+        finally:
+            c.execute('PRAGMA busy_timeout={}'.format(busy_timeout))
+        return 'busy' if busy else 'done'
+
+
+    def _sig_columns(self):
+        """
+        Get the names of the signature columns, separated by commas.
+        """
+        return ','.join(['c' + str(i+1) for i in range(self._num_hashes)])
+
+
+    def _set_layout(self):
+        """
+        Prepare the table names and statements of the layout of the database
+        (Clustered or not, see Signature clusters above).
+        """
+        sig_columns = self._sig_columns()
+        if self._clustered:
+            # The table that keeps the signatures:
+            self._sig_table = 'sigs'
+            # The column of funcs that links a function to its signature:
+            self._member_col = 'sig_id'
+            func_columns = 'sig_id'
+            func_sig = 'SELECT f.func_name,f.func_comment,' + \
+                    ','.join('s.c' + str(i+1) \
+                    for i in range(self._num_hashes)) + \
+                    ' FROM funcs AS f JOIN sigs AS s ON s.sig_id=f.sig_id'
+            self._cmd_select_cluster = 'SELECT sig_id FROM sigs' \
+                    ' WHERE sig_key=?' + ''.join(' AND c' + str(i+1) + '=?' \
+                    for i in range(self._num_hashes))
+            self._cmd_insert_cluster = 'INSERT INTO sigs' \
+                    ' (sig_key,num_funcs,' + sig_columns + ') VALUES (?,0' + \
+                    (',?' * self._num_hashes) + ')'
+        else:
+            self._sig_table = 'funcs'
+            self._member_col = 'rowid'
+            func_columns = sig_columns
+            func_sig = 'SELECT func_name,func_comment,' + sig_columns + \
+                    ' FROM funcs AS f'
+
+        # Statements for adding functions:
+        columns = '(func_hash,func_name,func_comment,' + func_columns + \
+                ') values (?,?,?' + (',?' * len(func_columns.split(','))) + ')'
+        if HAS_UPSERT:
+            self._cmd_insert_new = 'INSERT INTO funcs ' + columns + \
+                    ' ON CONFLICT (func_hash) DO NOTHING'
+        else:
+            self._cmd_insert_new = 'INSERT OR IGNORE INTO funcs ' + columns
+        self._cmd_replace = 'INSERT OR REPLACE INTO funcs ' + columns
+        self._cmd_select_func = func_sig + ' WHERE f.func_hash=?'
+
+        # Statements for queries:
+        self._cmd_select_sigs = 'SELECT rowid,' + sig_columns + ' FROM ' + \
+                self._sig_table + ' WHERE '
+        self._cmd_select_exact = 'SELECT ' + self._member_col + \
+                ',func_name,func_comment FROM funcs WHERE func_hash=?'
+        self._cmd_select_members = 'SELECT func_hash,func_name,func_comment' \
+                ' FROM funcs WHERE ' + self._member_col + '=? LIMIT ?'
+
+
+    def needs_hash_filter(self):
+        """
+        Check if the strong hash filter of the database should be built (See
+        build_hash_filter): This process has no filter for the database, or
+        its filter is full, and no filter is being built.
+        """
+        key = self._hash_filter_key
+        if key is None:
+            return False
+        hash_filter = _hash_filters.get(key)
+        if hash_filter is not None and not hash_filter.is_full():
+            return False
+        return key not in _hash_filter_builds
+
+
+    def build_hash_filter(self):
+        """
+        Build the strong hash filter of the database (See Duplicate uploads
+        above), for all the FuncsDB instances of this process. Does nothing if
+        the filter is not needed anymore (See needs_hash_filter).
+        The database is read using a connection of its own, so this may run
+        in another thread, even after this instance was closed.
+        """
+        key = self._hash_filter_key
+        with _hash_filter_lock:
+            if not self.needs_hash_filter():
+                return
+            _hash_filter_builds.add(key)
+
+        try:
+            conn = sqlite3.connect(self._db_path)
+            try:
+                c = conn.cursor()
+                c.execute('SELECT COUNT(*) FROM funcs')
+                num_funcs = c.fetchone()[0]
+                hash_filter = BloomFilter(\
+                        max(HASH_FILTER_MIN_CAPACITY,num_funcs * 2))
+                c.execute('SELECT func_hash FROM funcs')
+                for (func_hash,) in c:
+                    hash_filter.add(bytes(func_hash))
+            finally:
+                conn.close()
+            _hash_filters[key] = hash_filter
+        except sqlite3.Error:
+            logger.exception('Failed building the strong hash filter of %s',\
+                    self._db_path)
+        finally:
+            with _hash_filter_lock:
+                _hash_filter_builds.discard(key)
+
+
+    def _sync_sig_index(self):
+        """
+        Append to the signature index all the signatures that were added to
+        the database without it (For example, before the index existed).
+        """
+        c = self._conn.cursor()
+        c.execute(self._cmd_select_sigs + 'rowid > ? ORDER BY rowid',\
+                (self._sig_index.last_rowid,))
+        self._sig_index.append((row[0],row[1:]) for row in c.fetchall())
+
+
     def _build_empty_db(self):
         """
         Build an initial empty database.
@@ -91,59 +658,446 @@ class FuncsDB:
         """
         self._check_is_open()
         c = self._conn.cursor()
+        # Another connection might be building the same database right now,
+        # hence IF NOT EXISTS:
+        if self._clustered:
+            self._build_sigs_table()
+
+        # Create the funcs table:
+        c.execute(self._cmd_create_funcs('funcs'))
+
+        self._build_sig_indices()
+        if self._clustered:
+            self._build_cluster_triggers()
+
+        self._build_meta_table()
+        self._build_value_counts()
+
+        self._conn.commit()
+
+
+    def _cmd_create_funcs(self,table_name):
+        """
+        Get the statement that creates the funcs table (Under another name),
+        in the layout of the database.
+        """
         cmd_tbl = \
-            """CREATE TABLE funcs(
+            """CREATE TABLE IF NOT EXISTS {}(
                 func_hash BLOB PRIMARY KEY,
                 func_name TEXT NOT NULL,
-                func_comment TEXT NOT NULL"""
+                func_comment TEXT NOT NULL""".format(table_name)
 
-        for i in range(self._num_hashes):
-            cmd_tbl += ',\n'
-            cmd_tbl += 'c' + str(i+1) + ' INTEGER NOT NULL'
+        if self._clustered:
+            cmd_tbl += ',\nsig_id INTEGER NOT NULL'
+        else:
+            for i in range(self._num_hashes):
+                cmd_tbl += ',\n'
+                cmd_tbl += 'c' + str(i+1) + ' INTEGER NOT NULL'
 
         cmd_tbl += ');'
+        return cmd_tbl
 
-        # Create the funcs table:
-        c.execute(cmd_tbl)
 
-        # Add index for each of the 'c{num}' columns:
+    def _build_sigs_table(self):
+        """
+        Create the sigs table of a clustered database.
+        """
+        c = self._conn.cursor()
+        cmd_sigs = \
+            """CREATE TABLE IF NOT EXISTS sigs(
+                sig_id INTEGER PRIMARY KEY,
+                sig_key INTEGER NOT NULL,
+                num_funcs INTEGER NOT NULL"""
+        for i in range(self._num_hashes):
+            cmd_sigs += ',\n'
+            cmd_sigs += 'c' + str(i+1) + ' INTEGER NOT NULL'
+        cmd_sigs += ');'
+        c.execute(cmd_sigs)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_sigs_key ON sigs(sig_key)')
+
+
+    def _build_sig_indices(self):
+        """
+        Add index for each of the 'c{num}' columns of the signature table.
+        """
+        c = self._conn.cursor()
         for i in range(self._num_hashes):
             cname = 'c' + str(i+1)
-            cmd_index = 'CREATE INDEX idx_' + cname + ' ON ' + \
-                    'funcs(' + cname + ');'
+            cmd_index = 'CREATE INDEX IF NOT EXISTS idx_' + cname + ' ON ' + \
+                    self._sig_table + '(' + cname + ');'
             c.execute(cmd_index)
 
-        self._conn.commit()
 
+    def _check_num_hashes(self):
+        """
+        Make sure that the signatures inside the database have num_hashes
+        values.
+        """
+        c = self._conn.cursor()
+        c.execute('PRAGMA table_info(' + self._sig_table + ')')
+        db_num_hashes = sum(1 for row in c.fetchall() \
+                if row[1].startswith('c') and row[1][1:].isdigit())
+        if db_num_hashes not in (0,self._num_hashes):
+            self._conn.close()
+            self._is_open = False
+            OPEN_DB_HANDLES.dec()
+            raise FuncsDBError('Database {} has signatures of {} hashes,'
+                    ' not {}'.format(self._db_path,db_num_hashes,\
+                    self._num_hashes))
 
-    def add_function(self,func_name,func_data,func_comment):
+
+    def _build_cluster_triggers(self):
         """
-        Add a (Reversed) function to the database.
+        Create the index of the members of every signature, and the triggers
+        that keep num_funcs of signatures, in a clustered database.
+        """
+        c = self._conn.cursor()
+        c.execute('CREATE INDEX IF NOT EXISTS idx_funcs_sig ON funcs(sig_id)')
+        c.execute('CREATE TRIGGER IF NOT EXISTS cluster_insert'
+                ' AFTER INSERT ON funcs BEGIN\n'
+                'UPDATE sigs SET num_funcs=num_funcs+1'
+                ' WHERE sig_id=NEW.sig_id;\n'
+                'END')
+        # A signature is deleted with its last function. (This fires the
+        # value_counts triggers of sigs):
+        c.execute('CREATE TRIGGER IF NOT EXISTS cluster_delete'
+                ' AFTER DELETE ON funcs BEGIN\n'
+                'UPDATE sigs SET num_funcs=num_funcs-1'
+                ' WHERE sig_id=OLD.sig_id;\n'
+                'DELETE FROM sigs WHERE sig_id=OLD.sig_id AND num_funcs=0;\n'
+                'END')
+
+
+    def _has_table(self,table_name):
+        """
+        Check if the database has a table.
+        """
+        c = self._conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table'"
+                " AND name=?",(table_name,))
+        return c.fetchone() is not None
+
+
+    def _build_meta_table(self):
+        """
+        Create the meta table: Values that describe the database as a whole.
+        """
+        c = self._conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS meta('
+                'key TEXT PRIMARY KEY,'
+                'value INTEGER NOT NULL)')
+        # Write generation (See generation()):
+        c.execute('INSERT OR IGNORE INTO meta (key,value) VALUES (?,?)',\
+                ('generation',0))
+
+
+    def _build_value_counts(self):
+        """
+        Create the value_counts table, and the triggers that update it.
+        """
+        c = self._conn.cursor()
+        c.execute('CREATE TABLE IF NOT EXISTS value_counts('
+                'col INTEGER NOT NULL,'
+                'value INTEGER NOT NULL,'
+                'count INTEGER NOT NULL,'
+                'PRIMARY KEY (col,value)) WITHOUT ROWID')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_value_counts_hot'
+                ' ON value_counts(count) WHERE count > {}'.\
+                format(HOT_VALUE_MIN_COUNT))
+
+        # The statements inside the triggers have no conflict clauses: The
+        # conflict clause of the outer INSERT OR REPLACE would override them.
+        insert_body = ''
+        delete_body = ''
+        for i in range(self._num_hashes):
+            where = 'col={} AND value=NEW.c{}'.format(i+1,i+1)
+            if HAS_UPSERT:
+                insert_body += 'INSERT INTO value_counts (col,value,count)' \
+                        ' VALUES ({},NEW.c{},1) ON CONFLICT (col,value)' \
+                        ' DO UPDATE SET count=count+1;\n'.format(i+1,i+1)
+            else:
+                insert_body += 'INSERT INTO value_counts (col,value,count)' \
+                        ' SELECT {},NEW.c{},0 WHERE NOT EXISTS' \
+                        ' (SELECT 1 FROM value_counts WHERE {});\n'.\
+                        format(i+1,i+1,where)
+                insert_body += 'UPDATE value_counts SET count=count+1' \
+                        ' WHERE {};\n'.format(where)
+            delete_body += 'UPDATE value_counts SET count=count-1' \
+                    ' WHERE {};\n'.format(where.replace('NEW.','OLD.'))
+
+        c.execute('CREATE TRIGGER IF NOT EXISTS value_counts_insert'
+                ' AFTER INSERT ON ' + self._sig_table + ' BEGIN\n' + \
+                insert_body + 'END')
+        c.execute('CREATE TRIGGER IF NOT EXISTS value_counts_delete'
+                ' AFTER DELETE ON ' + self._sig_table + ' BEGIN\n' + \
+                delete_body + 'END')
+
+
+    def rebuild_value_counts(self):
+        """
+        Count the values of all the functions in the database again. (For
+        example, for a database created before value_counts existed). This
+        takes a while on a large database, and holds the write lock meanwhile.
         """
         self._check_is_open()
         c = self._conn.cursor()
         try:
+            self._count_values()
+            c.execute('COMMIT')
+        except sqlite3.Error:
+            c.execute('ROLLBACK')
+            raise
+        finally:
+            c.execute('BEGIN TRANSACTION')
+
+
+    def _count_values(self):
+        """
+        Fill value_counts with the counts of the values of all the signatures
+        in the database.
+        """
+        c = self._conn.cursor()
+        c.execute('DELETE FROM value_counts')
+        for i in range(self._num_hashes):
+            c.execute('INSERT INTO value_counts (col,value,count)'
+                    ' SELECT {},c{},COUNT(*) FROM {} GROUP BY c{}'.\
+                    format(i+1,i+1,self._sig_table,i+1))
 
+
+    def is_clustered(self):
+        """
+        Check if the functions of the database are clustered by signature
+        (See Signature clusters above).
+        """
+        return self._clustered
+
+
+    def cluster_signatures(self):
+        """
+        Convert a database that is not clustered to the clustered layout, in
+        place: Every distinct signature is moved to the sigs table, and the
+        funcs table is rebuilt with only the strong hashes, names, comments
+        and sig_ids of the functions. The value counts are counted again.
+        This takes a while on a large database and holds the write lock
+        meanwhile. Other connections to the database (Of server processes)
+        must be closed first, as they keep using the old layout. The
+        signature index of the database becomes invalid, and should be
+        deleted. (So the database must be opened without use_sig_index).
+        Returns False if the database was already clustered.
+        """
+        self._check_is_open()
+        if self._clustered:
+            return False
+        if self._sig_index is not None:
+            raise FuncsDBError('Can not cluster a database opened with'
+                    ' use_sig_index')
+
+        c = self._conn.cursor()
+        sig_columns = self._sig_columns()
+        self._conn.create_function('sig_key',-1,lambda *s: sig_key(s))
+        try:
+            self._clustered = True
+            self._set_layout()
+
+            self._build_sigs_table()
+            c.execute('INSERT INTO sigs (sig_key,num_funcs,' + sig_columns + \
+                    ') SELECT sig_key(' + sig_columns + '),COUNT(*),' + \
+                    sig_columns + ' FROM funcs GROUP BY ' + sig_columns)
+
+            c.execute(self._cmd_create_funcs('funcs_clustered'))
+            c.execute('INSERT INTO funcs_clustered'
+                    ' (func_hash,func_name,func_comment,sig_id)'
+                    ' SELECT f.func_hash,f.func_name,f.func_comment,s.sig_id'
+                    ' FROM funcs AS f JOIN sigs AS s'
+                    ' ON s.sig_key=sig_key(' + ','.join('f.c' + str(i+1) \
+                    for i in range(self._num_hashes)) + ')' + \
+                    ''.join(' AND s.c{}=f.c{}'.format(i+1,i+1) \
+                    for i in range(self._num_hashes)))
+            # Drops the signature column indices and the triggers of funcs
+            # too:
+            c.execute('DROP TABLE funcs')
+            c.execute('ALTER TABLE funcs_clustered RENAME TO funcs')
+
+            self._build_sig_indices()
+            self._build_cluster_triggers()
+            self._build_value_counts()
+            self._count_values()
+            c.execute('UPDATE meta SET value = value + 1 WHERE key=?',\
+                    ('generation',))
+            self._funcs_pending = 0
+            c.execute('COMMIT')
+        except sqlite3.Error:
+            c.execute('ROLLBACK')
+            self._clustered = False
+            self._set_layout()
+            raise
+        finally:
+            self._conn.create_function('sig_key',-1,None)
+            c.execute('BEGIN TRANSACTION')
+
+        return True
+
+
+    def hot_values(self,limit):
+        """
+        Get the most common signature values. Returns a list of at most limit
+        (col,value,count) tuples, where col is the signature column (Starting
+        from 1), ordered by count. Only values that appear in more than
+        HOT_VALUE_MIN_COUNT functions are listed.
+        """
+        self._check_is_open()
+        c = self._conn.cursor()
+        c.execute('SELECT col,value,count FROM value_counts'
+                ' WHERE count > {} ORDER BY count DESC LIMIT ?'.\
+                format(HOT_VALUE_MIN_COUNT),(limit,))
+        return c.fetchall()
+
+
+    def _value_counts(self,func_sig):
+        """
+        Get the amount of functions that have every value of a signature (At
+        the same column).
+        """
+        c = self._conn.cursor()
+        terms = ' OR '.join(['(col=? AND value=?)'] * self._num_hashes)
+        params = []
+        for i,value in enumerate(func_sig):
+            params += [i+1,value]
+        c.execute('SELECT col,count FROM value_counts WHERE ' + terms,params)
+        counts = [0] * self._num_hashes
+        for col,count in c.fetchall():
+            counts[col-1] = count
+        return counts
+
+
+    def _plan_query(self,func_sig,max_candidates=None,min_grade=None,\
+            coarse_hashes=None):
+        """
+        Get the maximum amount of candidates to take for every value of a
+        signature: At most hot_cap for hot values, and at most max_candidates
+        for all values (None for no limit). If min_grade is given, only the
+        least common num_hashes - min_grade + 1 values are searched, and the
+        other values get a limit of 0. If coarse_hashes is given, only the
+        first coarse_hashes values may be searched.
+        Returns the limits, True if a limit leaves out candidates, and the
+        counts of the values.
+        """
+        num_cols = self._num_hashes
+        if coarse_hashes is not None:
+            num_cols = coarse_hashes
+        if self._hot_threshold is None and max_candidates is None and \
+                min_grade is None:
+            limits = [None] * num_cols + [0] * (self._num_hashes - num_cols)
+            return limits,False,None
+
+        counts = self._value_counts(func_sig)
+        searched = range(num_cols)
+        if min_grade is not None:
+            num_searched = max(0,self._num_hashes - min_grade + 1)
+            searched = sorted(searched,key=lambda col: counts[col])\
+                    [:num_searched]
+        searched = set(searched)
+
+        limits = []
+        approximate = False
+        for col,count in enumerate(counts):
+            if col not in searched:
+                limits.append(0)
+                continue
+            limit = max_candidates
+            if self._hot_threshold is not None and \
+                    count > self._hot_threshold:
+                limit = self._hot_cap if limit is None else \
+                        min(limit,self._hot_cap)
+            if limit is not None and count > limit:
+                approximate = True
+            limits.append(limit)
+        return limits,approximate,counts
+
+
+    def add_function(self,func_name,func_data,func_comment):
+        """
+        Add a (Reversed) function to the database.
+        """
+        with SIGN_LATENCY.time():
             s = sign(func_data,self._num_hashes)
             func_hash = strong_hash(func_data)
+        self.add_signature(func_name,func_hash,s,func_comment)
 
 
-            cmd_insert = \
-                    """INSERT OR REPLACE into funcs 
-                        (func_hash,func_name,func_comment"""
+    def add_signature(self,func_name,func_hash,func_sig,func_comment):
+        """
+        Add a (Reversed) function to the database, given its strong hash and
+        its catalog1 signature (Instead of the function data).
+        A function that is already in the database is only written if its
+        name, comment or signature changed.
+        """
+        self._check_is_open()
+        if len(func_sig) != self._num_hashes:
+            raise FuncsDBError('Signature length {} does not match'
+                    ' num_hashes {}'.format(len(func_sig),self._num_hashes))
 
-            for i in range(self._num_hashes):
-                cmd_insert += ',c' + str(i+1) + ' '
+        c = self._conn.cursor()
+        try:
+            s = list(func_sig)
+            func_hash = bytes(func_hash)
+
+            if self._hash_filter is None or self._hash_filter.is_full():
+                # Take a filter that was built since, if there is one. (A full
+                # filter is still correct, but answers True more often):
+                self._hash_filter = _hash_filters.get(self._hash_filter_key,\
+                        self._hash_filter)
+
+            params = [sqlite3.Binary(func_hash),func_name,func_comment]
+
+            inserted = False
+            # (A key of a rolled back insert stays in the filter. It only
+            # costs a lookup):
+            if self._hash_filter is not None and \
+                    not self._hash_filter.add(func_hash):
+                # Surely a new function, unless another process has just
+                # added it:
+                sig_params,new_sig_id = self._sig_params(s)
+                c.execute(self._cmd_insert_new,params + sig_params)
+                inserted = (c.rowcount == 1)
+                if not inserted and new_sig_id is not None:
+                    # The signature was added for nothing:
+                    c.execute('DELETE FROM sigs WHERE sig_id=?'
+                            ' AND num_funcs=0',(new_sig_id,))
+
+            if not inserted:
+                c.execute(self._cmd_select_func,(sqlite3.Binary(func_hash),))
+                row = c.fetchone()
+                if row is not None and list(row[2:]) == s:
+                    if row[0] == func_name and row[1] == func_comment:
+                        # Nothing to write:
+                        ADDED_FUNCTIONS.labels('skipped').inc()
+                        return
+                    # Only the name or comment changed. The signature columns
+                    # (And their indices) are not touched:
+                    c.execute('UPDATE funcs SET func_name=?,func_comment=?'
+                            ' WHERE func_hash=?',\
+                            (func_name,func_comment,sqlite3.Binary(func_hash)))
+                    ADDED_FUNCTIONS.labels('updated').inc()
+                    self._funcs_added()
+                    return
 
-            cmd_insert += ') values (?,?,?' + (',?' * self._num_hashes) + ');'
+                # A new function, or another signature for an existing one:
+                sig_params,new_sig_id = self._sig_params(s)
+                c.execute(self._cmd_replace,params + sig_params)
+                ADDED_FUNCTIONS.labels('replaced' if row is not None \
+                        else 'inserted').inc()
+            else:
+                ADDED_FUNCTIONS.labels('inserted').inc()
 
-            c.execute(cmd_insert,[\
-                    sqlite3.Binary(func_hash),func_name,func_comment] + s)
+            # The index is appended before the transaction is committed, so
+            # that every committed function is in the index. (Rows of a rolled
+            # back transaction are skipped at query time). Signatures of a
+            # clustered database were appended when they were added:
+            if self._sig_index is not None and not self._clustered:
+                self._sig_index.append([(c.lastrowid,s)])
 
-            # Commit functions inserted to the db if _funcs_pending is large
-            # enough:
-            if self._funcs_pending > FUNCTION_BATCH:
-                self.commit_funcs()
+            self._funcs_added()
 
         except sqlite3.Error:
             # Give up previous transaction, and start a new one.
@@ -151,78 +1105,425 @@ class FuncsDB:
             c.execute('BEGIN TRANSACTION')
 
 
-    def get_similars(self,func_data,num_similars):
+    def _sig_params(self,func_sig):
+        """
+        Get the values of the signature columns of a new row in funcs: The
+        signature itself, or the sig_id of the signature in a clustered
+        database (Adding it to sigs if it is not there).
+        Returns the values, and the sig_id of the signature if it was added.
+        """
+        if not self._clustered:
+            return func_sig,None
+
+        c = self._conn.cursor()
+        key = sig_key(func_sig)
+        c.execute(self._cmd_select_cluster,[key] + func_sig)
+        row = c.fetchone()
+        if row is not None:
+            return [row[0]],None
+
+        c.execute(self._cmd_insert_cluster,[key] + func_sig)
+        sig_id = c.lastrowid
+        if self._sig_index is not None:
+            self._sig_index.append([(sig_id,func_sig)])
+        return [sig_id],sig_id
+
+
+    def _funcs_added(self):
+        """
+        Count a written function. Commit the written functions if there are
+        enough of them.
+        """
+        self._funcs_pending += 1
+        if self._funcs_pending > FUNCTION_BATCH:
+            self.commit_funcs()
+
+
+    def get_similars(self,func_data,num_similars,max_candidates=None,\
+            deadline=None,min_grade=None,coarse_hashes=None):
         """
         Get a list of at most num_similars similar functions to a given
         function. The list will be ordered by similarity. The first element is
         the most similar one.
+        See get_similars_by_signature about max_candidates, deadline,
+        min_grade and coarse_hashes.
+        """
+        with SIGN_LATENCY.time():
+            s = sign(func_data,self._num_hashes)
+            func_hash = strong_hash(func_data)
+        return self.get_similars_by_signature(func_hash,s,num_similars,\
+                max_candidates=max_candidates,deadline=deadline,\
+                min_grade=min_grade,coarse_hashes=coarse_hashes)
+
+
+    def get_similars_by_signature(self,func_hash,func_sig,num_similars,\
+            max_candidates=None,deadline=None,min_grade=None,\
+            coarse_hashes=None):
+        """
+        Get a list of at most num_similars similar functions to a function
+        with the given strong hash and catalog1 signature. The list will be
+        ordered by similarity. The first element is the most similar one.
+        Returns a Similars list (None on database errors).
+
+        If min_grade is given, only functions with a grade of at least
+        min_grade are returned (The exact match is always returned).
+
+        If coarse_hashes is given, candidates are searched and ranked using
+        only the first coarse_hashes values of the signature (See Coarse
+        queries above).
+
+        A bounded query takes at most max_candidates candidates for every
+        signature value, and stops at deadline (A time.monotonic() time),
+        returning the best results found so far. The result is marked
+        approximate if a limit was hit.
         """
         self._check_is_open()
+        if len(func_sig) != self._num_hashes:
+            raise FuncsDBError('Signature length {} does not match'
+                    ' num_hashes {}'.format(len(func_sig),self._num_hashes))
+
+        if min_grade is not None and min_grade <= 1:
+            # Every candidate has a grade of at least 1:
+            min_grade = None
+        if coarse_hashes is not None:
+            if coarse_hashes < 1:
+                raise FuncsDBError('coarse_hashes must be positive')
+            if coarse_hashes >= self._num_hashes:
+                coarse_hashes = None
+
+        if max_candidates is not None or deadline is not None:
+            return self._get_similars_bounded(func_hash,func_sig,\
+                    num_similars,max_candidates,deadline,min_grade,\
+                    coarse_hashes)
+
+        if self._sig_index is not None:
+            return self._get_similars_indexed(func_hash,func_sig,\
+                    num_similars,min_grade,coarse_hashes)
+
         c = self._conn.cursor()
         try:
-            # A list to keep results:
-            res_list = []
-
-            s = sign(func_data,self._num_hashes)
-            func_hash = strong_hash(func_data)
+            s = list(func_sig)
 
+            # The exact match (Using strong hash), and its sig_id:
+            exact = self._exact_match(func_hash)
+            exact_sig_id = None if exact is None else exact[0]
 
-            # Get all potential candidates for similarity:
-            lselects = ['SELECT * FROM funcs WHERE c' + str(i+1) + '=?' \
-                    for i in range(self._num_hashes)]
-            # Also search for exact match (Using strong hash):
-            sel_hash = 'SELECT * FROM funcs WHERE func_hash=?'
-            lselects.append(sel_hash)
+            # Get all potential candidate signatures for similarity. Hot values
+            # give a limited amount of candidates:
+            sel_sigs = 'SELECT rowid AS sig_id,' + self._sig_columns() + \
+                    ' FROM ' + self._sig_table + ' WHERE '
+            lselects = []
+            select_params = []
+            limits,approximate,counts = self._plan_query(s,\
+                    min_grade=min_grade,coarse_hashes=coarse_hashes)
+            for i,limit in enumerate(limits):
+                sel = sel_sigs + 'c' + str(i+1) + '=?'
+                if limit is None:
+                    lselects.append(sel)
+                    select_params.append(s[i])
+                elif limit > 0:
+                    lselects.append('SELECT * FROM (' + sel + ' LIMIT ?)')
+                    select_params += [s[i],limit]
+            candidates = "\nUNION\n".join(lselects)
+            candidate_params = list(select_params)
+            # Also take the signature of the exact match:
+            lselects.append(sel_sigs + 'rowid=?')
+            select_params.append(exact_sig_id)
             selects = "\nUNION\n".join(lselects)
 
-            # Find best matching rows
-            matching = 'SELECT func_hash,func_name,func_comment,'
-
-            sig_vals = ",".join(['c' + str(i+1) for i in range(self._num_hashes)])
-            matching += sig_vals
+            # Find best matching signatures:
+            matching = 'SELECT sig_id,' + self._sig_columns()
 
             # Make an expression (c1=sig[0]) + (c2=sig[1]) + ...
             # Which will be the grade of every row (The amount of matches of the
-            # signature).
+            # signature). A coarse query grades only the first coarse_hashes
+            # columns:
+            grade_cols = self._num_hashes
+            if coarse_hashes is not None:
+                grade_cols = coarse_hashes
             sig_sum = ' + '.join(\
-                    ['(c' + str(i+1) + '=?)' for i in range(self._num_hashes)])
+                    ['(c' + str(i+1) + '=?)' for i in range(grade_cols)])
             matching += ',(' + sig_sum + ') AS grade '
 
             matching += 'FROM (' + selects + ') '
 
-            # Find the num_similars rows with highest grade:
-            matching += 'ORDER BY grade DESC LIMIT ?'
+            grade_params = []
+            if min_grade is not None:
+                # The other columns add at most num_hashes - grade_cols to
+                # the grade:
+                matching += 'WHERE grade >= ? OR sig_id = ? '
+                grade_params = [min_grade - (self._num_hashes - grade_cols),\
+                        exact_sig_id]
 
-            c.execute(matching,s + s + [func_hash,num_similars])
+            # Find the num_similars signatures with highest grade (The exact
+            # match first among equal grades). Every signature has at least
+            # one function:
+            matching += 'ORDER BY grade DESC,sig_id=? DESC LIMIT ?'
+            limit = num_similars
+            if coarse_hashes is not None:
+                limit = num_similars * REFINE_FACTOR
 
-            for res in c.fetchall():
-                res_hash,res_name,res_comment = res[:3]
-                # We don't want to include the last superficial column grade, this
-                # is why we have -1 here:
-                res_sig = list(res[3:-1])
-                # The function's grade:
-                grade = res[-1]
-                sres = DBSimilar(\
-                        func_hash=res_hash,\
-                        func_name=res_name,\
-                        func_comment=res_comment,\
-                        func_sig=res_sig,\
-                        func_grade=grade)
+            with QUERY_LATENCY.time():
+                c.execute(matching,s[:grade_cols] + select_params + \
+                        grade_params + [exact_sig_id,limit])
+                rows = c.fetchall()
 
-                # If we have exact match (Using strong hash), we move the result to
-                # the beginning of res_list. Otherwise, we just append to the end.
-                # The exact match will always be at the beginning.
-                if res_hash == func_hash:
-                    res_list.insert(0,sres)
+                if coarse_hashes is not None:
+                    # Refine the grades over the whole signature:
+                    clusters = self._grade_clusters(s,\
+                            [res[:-1] for res in rows],num_similars,\
+                            exact_sig_id,min_grade)
                 else:
-                    res_list.append(sres)
+                    # We don't want to include the last superficial column
+                    # grade in the signature:
+                    clusters = [(res[0],list(res[1:-1]),res[-1]) \
+                            for res in rows]
 
-            return res_list
+                res = self._expand_clusters(func_hash,exact,clusters,\
+                        num_similars,approximate)
+
+            num_candidates = None
+            if next(_sql_queries) % CANDIDATES_SAMPLE_PERIOD == 0:
+                num_candidates = 0
+                if candidates:
+                    c.execute('SELECT COUNT(*) FROM (' + candidates + ')',\
+                            candidate_params)
+                    num_candidates = c.fetchone()[0]
 
         except sqlite3.Error:
             # Give up previous transaction, and start a new one.
             c.execute('ROLLBACK')
             c.execute('BEGIN TRANSACTION')
+            return None
+
+        if num_candidates is not None:
+            QUERY_CANDIDATES.observe(num_candidates)
+        return res
+
+
+    def _exact_match(self,func_hash):
+        """
+        Get the function with a strong hash: A (sig_id,func_name,func_comment)
+        tuple, or None if there is no such function.
+        """
+        c = self._conn.cursor()
+        c.execute(self._cmd_select_exact,(func_hash,))
+        return c.fetchone()
+
+
+    def _get_similars_indexed(self,func_hash,func_sig,num_similars,\
+            min_grade=None,coarse_hashes=None):
+        """
+        Get similar functions using the signature index: The index gives the
+        rowids of all the candidate signatures, and the candidates are then
+        graded using their rows in the database.
+        """
+        s = list(func_sig)
+
+        c = self._conn.cursor()
+        try:
+            with QUERY_LATENCY.time():
+                exact = self._exact_match(func_hash)
+                limits,approximate,counts = self._plan_query(s,\
+                        min_grade=min_grade,coarse_hashes=coarse_hashes)
+                rowids = list(self._sig_index.find_candidates(s,limits))
+                num_candidates = len(rowids)
+                # Also take the signature of the exact match:
+                if exact is not None:
+                    rowids.append(exact[0])
+                rows = self._rows_by_rowids(self._cmd_select_sigs,rowids)
+                clusters = self._grade_clusters(s,rows,num_similars,\
+                        None if exact is None else exact[0],min_grade,\
+                        coarse_hashes)
+                res = self._expand_clusters(func_hash,exact,clusters,\
+                        num_similars,approximate)
+
+        except sqlite3.Error:
+            # Give up previous transaction, and start a new one.
+            c.execute('ROLLBACK')
+            c.execute('BEGIN TRANSACTION')
+            return None
+
+        QUERY_CANDIDATES.observe(num_candidates)
+        return res
+
 
+    def _rows_by_rowids(self,select,rowids):
+        """
+        Get the rows of a list of rowids, using a select statement that ends
+        with WHERE.
+        """
+        c = self._conn.cursor()
+        rows = []
+        for i in range(0,len(rowids),MAX_SQL_VARS):
+            part = rowids[i:i + MAX_SQL_VARS]
+            c.execute(select + 'rowid IN (' + \
+                    ','.join('?' * len(part)) + ')',part)
+            rows += c.fetchall()
+        return rows
+
+
+    def _get_similars_bounded(self,func_hash,func_sig,num_similars,\
+            max_candidates,deadline,min_grade=None,coarse_hashes=None):
+        """
+        Get similar functions, taking at most max_candidates candidates for
+        every signature value, until deadline. (See
+        get_similars_by_signature).
+        The candidates of every value are taken by a separate statement,
+        starting from the least common values, and the deadline is checked
+        between and during the statements.
+        """
+        s = list(func_sig)
+
+        select = self._cmd_select_sigs
+
+        def is_past_deadline():
+            return (deadline is not None) and (time.monotonic() > deadline)
+
+        c = self._conn.cursor()
+        exact = None
+        rows = []
+        approximate = False
+        num_candidates = 0
+        if deadline is not None:
+            # Interrupts a statement when the deadline has passed:
+            self._conn.set_progress_handler(is_past_deadline,\
+                    DEADLINE_CHECK_STEPS)
+        try:
+            with QUERY_LATENCY.time():
+                # The exact match (Using strong hash) first:
+                exact = self._exact_match(func_hash)
+                if exact is not None:
+                    rows += self._rows_by_rowids(select,[exact[0]])
+
+                limits,approximate,counts = self._plan_query(s,\
+                        max_candidates,min_grade,coarse_hashes)
+                cols = range(self._num_hashes)
+                if counts is not None:
+                    cols = sorted(cols,key=lambda col: counts[col])
+                for col in cols:
+                    if is_past_deadline():
+                        approximate = True
+                        break
+                    limit = limits[col]
+                    if limit == 0:
+                        continue
+                    if self._sig_index is not None:
+                        col_limits = [0] * self._num_hashes
+                        col_limits[col] = limit
+                        rowids = list(self._sig_index.find_candidates(s,\
+                                col_limits))
+                        col_rows = self._rows_by_rowids(select,rowids)
+                    else:
+                        c.execute(select + 'c{}=? LIMIT ?'.format(col+1),\
+                                (s[col],-1 if limit is None else limit))
+                        col_rows = c.fetchall()
+                    rows += col_rows
+                    num_candidates += len(col_rows)
+
+        except sqlite3.Error:
+            if not is_past_deadline():
+                # Give up previous transaction, and start a new one.
+                c.execute('ROLLBACK')
+                c.execute('BEGIN TRANSACTION')
+                return None
+            # A statement was interrupted at the deadline:
+            approximate = True
+
+        finally:
+            if deadline is not None:
+                self._conn.set_progress_handler(None,0)
+
+        QUERY_CANDIDATES.observe(num_candidates)
+        clusters = self._grade_clusters(s,rows,num_similars,\
+                None if exact is None else exact[0],min_grade,coarse_hashes)
+        try:
+            # The best signatures are expanded after the deadline as well:
+            return self._expand_clusters(func_hash,exact,clusters,\
+                    num_similars,approximate)
+        except sqlite3.Error:
+            # Give up previous transaction, and start a new one.
+            c.execute('ROLLBACK')
+            c.execute('BEGIN TRANSACTION')
+            return None
+
+
+    def _grade_clusters(self,func_sig,rows,num_similars,exact_sig_id,\
+            min_grade=None,coarse_hashes=None):
+        """
+        Grade candidate signature rows (sig_id,signature...) against a
+        signature. Returns a list of (sig_id,signature,grade) of the best
+        num_similars candidates with a grade of at least min_grade, ordered by
+        grade (The signature of the exact match first among equal grades).
+        If coarse_hashes is given, only the best candidates over the first
+        coarse_hashes values are graded.
+        """
+        s = func_sig
+        # Every candidate once:
+        rows = dict((res[0],res) for res in rows).values()
+        if coarse_hashes is not None:
+            def coarse_grade(res):
+                return (sum(a == b for a,b in \
+                        zip(res[1:1 + coarse_hashes],s)),\
+                        res[0] == exact_sig_id)
+            rows = sorted(rows,key=coarse_grade,reverse=True)\
+                    [:num_similars * REFINE_FACTOR]
+
+        clusters = []
+        for res in rows:
+            res_sig = list(res[1:])
+            grade = sum(a == b for a,b in zip(res_sig,s))
+            if min_grade is not None and grade < min_grade and \
+                    res[0] != exact_sig_id:
+                continue
+            clusters.append((res[0],res_sig,grade))
+
+        clusters.sort(key=lambda cl: (cl[2],cl[0] == exact_sig_id),\
+                reverse=True)
+        return clusters[:num_similars]
+
+
+    def _expand_clusters(self,func_hash,exact,clusters,num_similars,\
+            approximate):
+        """
+        Get the functions of the best graded signatures (A list of
+        (sig_id,signature,grade), ordered by grade), up to num_similars
+        functions. exact is the exact match (See _exact_match), which is
+        always at the beginning if it is one of them.
+        Returns a Similars list.
+        """
+        c = self._conn.cursor()
+        res_list = []
+        for sig_id,res_sig,grade in clusters:
+            if len(res_list) >= num_similars:
+                break
+            if exact is not None and sig_id == exact[0]:
+                # The exact match first among its signature:
+                res_list.append(DBSimilar(\
+                        func_hash=bytes(func_hash),\
+                        func_name=exact[1],\
+                        func_comment=exact[2],\
+                        func_sig=res_sig,\
+                        func_grade=grade))
+            # (One more, in case the exact match is one of them):
+            c.execute(self._cmd_select_members,\
+                    (sig_id,num_similars - len(res_list) + 1))
+            for res_hash,res_name,res_comment in c.fetchall():
+                if exact is not None and res_hash == func_hash:
+                    continue
+                res_list.append(DBSimilar(\
+                        func_hash=res_hash,\
+                        func_name=res_name,\
+                        func_comment=res_comment,\
+                        func_sig=res_sig,\
+                        func_grade=grade))
 
+        res_list = res_list[:num_similars]
+        # The exact match (If found) is always at the beginning:
+        for i,sres in enumerate(res_list):
+            if exact is not None and sres.func_hash == func_hash:
+                res_list.insert(0,res_list.pop(i))
+                break
+        QUERY_RESULTS.observe(len(res_list))
+        return Similars(res_list,approximate)
 
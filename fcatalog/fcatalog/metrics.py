@@ -0,0 +1,356 @@
+import time
+import bisect
+import asyncio
+import logging
+import threading
+
+# Server instrumentation:
+# Counters, gauges and histograms kept in a registry, and rendered in the
+# Prometheus text exposition format. The registry can be served over HTTP by
+# start_metrics_server(), on the same event loop as the server.
+#
+# Every server process keeps its own metrics. Metrics are updated from the
+# event loop and from other threads (Query threads, maintenance), so every
+# child metric updates its values under a lock of its own.
+
+class MetricsError(Exception): pass
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+# Histogram buckets for durations, in seconds:
+LATENCY_BUCKETS = (0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,\
+        0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+# Histogram buckets for sizes (Amounts of rows, bytes):
+SIZE_BUCKETS = (1,4,16,64,256,1024,4096,16384,65536,262144,1048576)
+
+
+class Registry:
+    def __init__(self):
+        # Metrics by name:
+        self._metrics = {}
+
+    def register(self,metric):
+        if metric.name in self._metrics:
+            raise MetricsError('Metric {} is already registered'.\
+                    format(metric.name))
+        self._metrics[metric.name] = metric
+
+    def get(self,name):
+        return self._metrics[name]
+
+    def render(self):
+        """
+        Render all the metrics in the Prometheus text format.
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            lines += self._metrics[name].render()
+        return '\n'.join(lines) + '\n'
+
+
+# The default registry:
+REGISTRY = Registry()
+
+
+def _format_labels(label_names,label_values,extra=()):
+    """
+    Format the labels of one sample, for example: {msg_name="AddFunction"}
+    """
+    pairs = list(zip(label_names,label_values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k,_escape(v)) \
+            for k,v in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').\
+            replace('\n','\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    # Prometheus metric type:
+    metric_type = None
+
+    def __init__(self,name,help_text,label_names=(),registry=REGISTRY):
+        self.name = name
+        self._help_text = help_text
+        self._label_names = tuple(label_names)
+        # Children by label values:
+        self._children = {}
+        # Guards the creation of children:
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def labels(self,*label_values):
+        """
+        Get the child metric for the given label values.
+        """
+        if len(label_values) != len(self._label_names):
+            raise MetricsError('Metric {} expects labels {}'.\
+                    format(self.name,self._label_names))
+        try:
+            return self._children[label_values]
+        except KeyError:
+            with self._lock:
+                child = self._children.get(label_values)
+                if child is None:
+                    child = self._new_child()
+                    self._children[label_values] = child
+                return child
+
+    def _default_child(self):
+        """
+        Get the child of a metric without labels.
+        """
+        return self.labels()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name,self._help_text),\
+                '# TYPE {} {}'.format(self.name,self.metric_type)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for label_values,child in children:
+            lines += child.render(self.name,self._label_names,label_values)
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self,amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self,amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self,value):
+        with self._lock:
+            self.value = value
+
+    def render(self,name,label_names,label_values):
+        return ['{}{} {}'.format(name,\
+                _format_labels(label_names,label_values),\
+                _format_value(self.value))]
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self,amount=1):
+        self._default_child().inc(amount)
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self,amount=1):
+        self._default_child().inc(amount)
+
+    def dec(self,amount=1):
+        self._default_child().dec(amount)
+
+    def set(self,value):
+        self._default_child().set(value)
+
+
+class _Timer:
+    """
+    A context manager that observes the time spent inside it.
+    """
+    def __init__(self,hist_value):
+        self._hist_value = hist_value
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self._hist_value.observe(time.perf_counter() - self._start)
+
+
+class _HistogramValue:
+    def __init__(self,buckets):
+        self._buckets = buckets
+        # Amount of observations in every bucket (Not cumulative). The last
+        # one is the +Inf bucket:
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self,value):
+        bucket = bisect.bisect_left(self._buckets,value)
+        with self._lock:
+            self._counts[bucket] += 1
+            self._sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def render(self,name,label_names,label_values):
+        # A consistent copy of the counts and the sum:
+        with self._lock:
+            counts = self._counts[:]
+            value_sum = self._sum
+        lines = []
+        cumulative = 0
+        for bound,count in zip(self._buckets + (float('inf'),),counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(name,\
+                    _format_labels(label_names,label_values,\
+                    [('le',_format_value(bound))]),cumulative))
+        labels = _format_labels(label_names,label_values)
+        lines.append('{}_sum{} {}'.format(name,labels,\
+                _format_value(value_sum)))
+        lines.append('{}_count{} {}'.format(name,labels,cumulative))
+        return lines
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self,name,help_text,label_names=(),\
+            buckets=LATENCY_BUCKETS,registry=REGISTRY):
+        self._buckets = tuple(sorted(buckets))
+        super().__init__(name,help_text,label_names,registry)
+
+    def _new_child(self):
+        return _HistogramValue(self._buckets)
+
+    def observe(self,value):
+        self._default_child().observe(value)
+
+    def time(self):
+        """
+        Observe the time spent inside a with block.
+        """
+        return self._default_child().time()
+
+
+###################################################################
+# Server metrics:
+
+MESSAGES = Counter('fcatalog_messages_total',\
+        'Received messages by type',['msg_name'])
+MESSAGE_LATENCY = Histogram('fcatalog_message_seconds',\
+        'Time spent handling a message, by type',['msg_name'])
+
+FRAME_READ_LATENCY = Histogram('fcatalog_frame_read_seconds',\
+        'Time from the length prefix of a frame until the whole frame arrived')
+DESERIALIZE_LATENCY = Histogram('fcatalog_deserialize_seconds',\
+        'Time spent deserializing a message')
+SERIALIZE_LATENCY = Histogram('fcatalog_serialize_seconds',\
+        'Time spent serializing a message')
+SEND_LATENCY = Histogram('fcatalog_send_seconds',\
+        'Time spent sending a frame (Including waiting for the write buffer'
+        ' to drain)')
+SIGN_LATENCY = Histogram('fcatalog_sign_seconds',\
+        'Time spent computing signatures and strong hashes of function data')
+QUERY_LATENCY = Histogram('fcatalog_query_seconds',\
+        'Time spent in the database finding similar functions')
+QUERY_CANDIDATES = Histogram('fcatalog_query_candidates',\
+        'Amount of candidate signatures graded for one query (Only a sampled'
+        ' fraction of the queries without the signature index is counted)',\
+        buckets=SIZE_BUCKETS)
+QUERY_RESULTS = Histogram('fcatalog_query_results',\
+        'Amount of similar functions returned for one query',\
+        buckets=SIZE_BUCKETS)
+QUERY_CACHE_REQUESTS = Counter('fcatalog_query_cache_total',\
+        'Similarity queries by the way they were answered: hit (A cached'
+        ' result), shared (Joined an identical running query) or miss',\
+        ['result'])
+ADDED_FUNCTIONS = Counter('fcatalog_added_functions_total',\
+        'Functions added to databases by what was written: inserted (A new'
+        ' function), skipped (Already in the database), updated (Only the'
+        ' name or comment changed) or replaced (Another signature)',\
+        ['result'])
+MAINTENANCE_RUNS = Counter('fcatalog_maintenance_total',\
+        'Database maintenance steps by result: done, busy (A checkpoint that'
+        ' readers did not let finish), skipped or failed',['step','result'])
+MAINTENANCE_LATENCY = Histogram('fcatalog_maintenance_seconds',\
+        'Time spent on database maintenance steps',['step'])
+VACUUMED_PAGES = Counter('fcatalog_vacuumed_pages_total',\
+        'Free database pages returned to the file system by maintenance')
+COMMIT_LATENCY = Histogram('fcatalog_commit_seconds',\
+        'Time spent committing database transactions')
+
+OPEN_CONNECTIONS = Gauge('fcatalog_open_connections',\
+        'Connections being served')
+OPEN_DB_HANDLES = Gauge('fcatalog_open_db_handles',\
+        'Open database connections')
+
+
+###################################################################
+# HTTP exposition:
+
+# Maximum size of an HTTP request head:
+MAX_REQUEST_HEAD = 0x2000
+
+# Time limit for receiving an HTTP request, in seconds:
+HTTP_READ_TIMEOUT = 10.0
+
+
+@asyncio.coroutine
+def _http_handler(reader,writer,registry):
+    """
+    Answer one HTTP request. GET /metrics returns the registry.
+    """
+    try:
+        head = yield from asyncio.wait_for(\
+                reader.readuntil(b'\r\n\r\n'),HTTP_READ_TIMEOUT)
+        request_line = head.split(b'\r\n',1)[0].split()
+        if len(request_line) >= 2 and request_line[0] == b'GET' and \
+                request_line[1].split(b'?')[0] == b'/metrics':
+            status = '200 OK'
+            body = registry.render().encode('UTF-8')
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+
+        writer.write('HTTP/1.0 {}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: close\r\n\r\n'.format(status,len(body)).\
+                encode('ascii') + body)
+        yield from writer.drain()
+    except (asyncio.TimeoutError,asyncio.IncompleteReadError,\
+            asyncio.LimitOverrunError,ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+@asyncio.coroutine
+def start_metrics_server(host,port,registry=REGISTRY,loop=None):
+    """
+    Serve the metrics of a registry over HTTP at http://host:port/metrics
+    Returns an asyncio Server instance.
+    """
+    @asyncio.coroutine
+    def handler(reader,writer):
+        yield from _http_handler(reader,writer,registry)
+
+    return (yield from asyncio.start_server(handler,host=host,port=port,\
+            loop=loop,reuse_address=True,limit=MAX_REQUEST_HEAD))
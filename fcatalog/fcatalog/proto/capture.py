@@ -0,0 +1,143 @@
+import time
+import struct
+import random
+import logging
+import collections
+
+# Traffic capture:
+# A CaptureWriter appends the frames received on sampled connections to a
+# binary log, to be replayed later (See fcatalog.tools.replay). Whole
+# connections are sampled, so that every captured session can be replayed.
+#
+# The log begins with CAPTURE_MAGIC, followed by records. Every record is a
+# header (RECORD_HEADER) followed by the record data:
+#   timestamp (double, seconds since the epoch), conn_id (uint32),
+#   kind (uint8), data length (uint32)
+# Kinds are RECORD_OPEN (A connection was opened), RECORD_FRAME (A frame was
+# received. The data is the uncompressed frame) and RECORD_CLOSE.
+#
+# A new writer appends to an existing log, so conn_id may repeat: A
+# RECORD_OPEN always begins a new session.
+
+class CaptureError(Exception): pass
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b'FCCAPT01'
+
+RECORD_HEADER = struct.Struct('<dIBI')
+
+RECORD_OPEN = 0
+RECORD_FRAME = 1
+RECORD_CLOSE = 2
+
+# Default maximum size of a capture log, in bytes. Nothing is recorded once it
+# is reached:
+DEFAULT_MAX_BYTES = 0x40000000
+
+# Size of the write buffer of the log file:
+WRITE_BUFFER_SIZE = 0x10000
+
+# Random source for sampling connections:
+capture_random = random.Random()
+
+# A record of a capture log:
+CaptureRecord = collections.namedtuple('CaptureRecord',\
+        ['timestamp','conn_id','kind','data'])
+
+
+class ConnectionCapture:
+    """
+    Records the frames of one connection.
+    """
+    def __init__(self,writer,conn_id):
+        self._writer = writer
+        self._conn_id = conn_id
+        self._is_open = True
+
+    def frame(self,data_frame):
+        """
+        Record a received frame.
+        """
+        if self._is_open:
+            self._writer.write_record(self._conn_id,RECORD_FRAME,data_frame)
+
+    def close(self):
+        """
+        Record the end of the connection. (May be called more than once).
+        """
+        if self._is_open:
+            self._is_open = False
+            self._writer.write_record(self._conn_id,RECORD_CLOSE)
+
+
+class CaptureWriter:
+    def __init__(self,path,sample_rate=1.0,max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Append captured connections to the log at path.
+        sample_rate is the fraction of connections to capture.
+        """
+        self._sample_rate = sample_rate
+        self._max_bytes = max_bytes
+        self._file = open(path,'ab',buffering=WRITE_BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        self._size = self._file.tell()
+        self._next_conn_id = 0
+        self._is_full = False
+
+    def start_connection(self):
+        """
+        Start capturing a new connection.
+        Returns a ConnectionCapture, or None if the connection was not
+        sampled.
+        """
+        if self._is_full or self._sample_rate <= 0.0 or \
+                capture_random.random() >= self._sample_rate:
+            return None
+
+        conn_id = self._next_conn_id
+        self._next_conn_id = (self._next_conn_id + 1) & 0xffffffff
+        self.write_record(conn_id,RECORD_OPEN)
+        return ConnectionCapture(self,conn_id)
+
+    def write_record(self,conn_id,kind,data=b''):
+        if self._is_full:
+            return
+        record_len = RECORD_HEADER.size + len(data)
+        if self._size + record_len > self._max_bytes:
+            logger.warning('Capture log is full (%s bytes).'
+                    ' Stopped capturing.',self._size)
+            self._is_full = True
+            return
+
+        self._file.write(RECORD_HEADER.pack(time.time(),conn_id,kind,\
+                len(data)))
+        self._file.write(data)
+        self._size += record_len
+
+    def close(self):
+        self._is_full = True
+        self._file.close()
+
+
+def read_capture(f):
+    """
+    Read the records of a capture log from a binary file object.
+    A truncated last record (For example of a server that was killed) is
+    ignored.
+    """
+    if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise CaptureError('Not a fcatalog capture log')
+
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp,conn_id,kind,data_len = RECORD_HEADER.unpack(header)
+        data = f.read(data_len)
+        if len(data) < data_len:
+            return
+        yield CaptureRecord(timestamp=timestamp,conn_id=conn_id,kind=kind,\
+                data=data)
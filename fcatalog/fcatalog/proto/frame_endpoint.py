@@ -1,5 +1,8 @@
 import struct
 import asyncio
+import zlib
+
+from fcatalog.metrics import FRAME_READ_LATENCY
 
 # Generic class for FrameEndpoint.
 # A method to send frames over a streaming protocol.
@@ -10,6 +13,12 @@ class FrameEndpoint:
         """Send a frame"""
         raise NotImplementedError()
 
+    @asyncio.coroutine
+    def send_many(self,data_frames):
+        """Send a few frames, one after the other"""
+        for data_frame in data_frames:
+            yield from self.send(data_frame)
+
     @asyncio.coroutine
     def recv(self):
         """Receive a frame"""
@@ -20,6 +29,20 @@ class FrameEndpoint:
         """Close the connection"""
         raise NotImplementedError()
 
+    def can_compress(self):
+        """
+        Check if this frame endpoint is able to compress frames.
+        """
+        return False
+
+    def enable_compression(self):
+        """
+        Start compressing outgoing frames.
+        (Should be called only after the remote peer has agreed to receive
+        compressed frames)
+        """
+        raise NotImplementedError()
+
 
 ################################################
 ################################################
@@ -31,33 +54,148 @@ MAX_FRAME_LEN = 2**20
 # Amount of bytes of length prefix:
 SIZE_PREFIX_LEN = 4
 
+# The highest bit of the length prefix marks a zlib compressed frame:
+COMPRESSED_FLAG = 0x80000000
+
+# Frames shorter than this amount of bytes are always sent uncompressed:
+COMPRESS_THRESHOLD = 0x100
+
+# zlib compression level for outgoing frames:
+COMPRESS_LEVEL = 6
+
+
+def compress_frame(data_frame:bytes,threshold,level):
+    """
+    Compress a frame, if it is worth it.
+    Returns the length prefix value (Possibly marked with COMPRESSED_FLAG) and
+    the payload to be sent.
+    """
+    if len(data_frame) >= threshold:
+        zdata = zlib.compress(data_frame,level)
+        # Only send the compressed version if it is actually smaller:
+        if len(zdata) < len(data_frame):
+            return len(zdata) | COMPRESSED_FLAG, zdata
+
+    return len(data_frame), data_frame
+
+
+def decompress_frame(zdata:bytes,max_frame_len):
+    """
+    Decompress a compressed frame.
+    Returns None if the data is invalid, or if the decompressed frame is longer
+    than max_frame_len. (We never decompress more than max_frame_len + 1 bytes,
+    so a decompression bomb can not make us allocate more than that).
+    """
+    dobj = zlib.decompressobj()
+    try:
+        data_frame = dobj.decompress(zdata,max_frame_len + 1)
+    except zlib.error:
+        return None
+
+    if len(data_frame) > max_frame_len:
+        # Decompressed frame is too large:
+        return None
+
+    if not dobj.eof or dobj.unused_data:
+        # Truncated zlib stream, or garbage after its end:
+        return None
+
+    return data_frame
+
+
 class TCPFrameEndpoint(FrameEndpoint):
-    def __init__(self,reader,writer,max_frame_len=MAX_FRAME_LEN):
+    def __init__(self,reader,writer,max_frame_len=MAX_FRAME_LEN,\
+            compress_threshold=COMPRESS_THRESHOLD,\
+            compress_level=COMPRESS_LEVEL,\
+            idle_timeout=None,read_timeout=None,write_timeout=None,\
+            write_buffer_limit=None):
+        """
+        Timeouts are in seconds (None means no timeout):
+        - idle_timeout: Maximum time to wait for the beginning of a frame.
+        - read_timeout: Maximum time to wait for the rest of a frame, once
+          its length prefix has arrived.
+        - write_timeout: Maximum time to wait for the write buffer to drain.
+        The connection is closed when a timeout expires.
+        write_buffer_limit is the high-water mark of the write buffer.
+        """
         # Max length of one frame:
         self._max_frame_len = max_frame_len
 
+        # Compression parameters for outgoing frames:
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+        # Compression is off until it is negotiated with the remote peer:
+        self._compress = False
+
         # Keep reader and writer:
         # Those are asyncio TCP Stream Reader and Writer.
         self._reader = reader
         self._writer = writer
 
+        self._idle_timeout = idle_timeout
+        self._read_timeout = read_timeout
+        self._write_timeout = write_timeout
+        if write_buffer_limit is not None:
+            writer.transport.set_write_buffer_limits(high=write_buffer_limit)
+
         # Set connection state to be open:
         self._is_open = True
 
 
+    @asyncio.coroutine
+    def _drain(self):
+        """
+        Wait for the underlying write buffer to drain below its high-water
+        mark. If it does not drain in time, the connection is aborted.
+        """
+        try:
+            yield from _wait_for(self._writer.drain(),self._write_timeout)
+        except asyncio.TimeoutError:
+            # The remote peer does not read. Throw away the write buffer:
+            self._writer.transport.abort()
+            self._is_open = False
+
+
     @asyncio.coroutine
     def send(self,data_frame:bytes):
         """
         Send a frame
         (Send data as a length prefixed frame)
         """
+        if not self._is_open:
+            return
+        self._write_frame(data_frame)
+        # Try to flush underlying buffer:
+        # See https://docs.python.org/3/library/asyncio-stream.html#asyncio.StreamWriter.drain
+        yield from self._drain()
+
+
+    @asyncio.coroutine
+    def send_many(self,data_frames):
+        """
+        Send a few frames. The underlying buffer is flushed only once, after
+        all the frames were written.
+        """
+        if not self._is_open:
+            return
+        for data_frame in data_frames:
+            self._write_frame(data_frame)
+        yield from self._drain()
+
+
+    def _write_frame(self,data_frame:bytes):
+        """
+        Write a length prefixed frame to the underlying writer.
+        """
+        len_prefix = len(data_frame)
+        if self._compress:
+            len_prefix,data_frame = compress_frame(data_frame,\
+                    self._compress_threshold,self._compress_level)
+
         # Encode the length of the data as an unsigned int (4 bytes):
-        blen = struct.pack('I',len(data_frame))
+        blen = struct.pack('I',len_prefix)
         # Write the length prefix and the data:
         self._writer.write(blen + data_frame)
-        # Try to flush underlying buffer:
-        # See https://docs.python.org/3/library/asyncio-stream.html#asyncio.StreamWriter.drain
-        yield from self._writer.drain()
 
 
     @asyncio.coroutine
@@ -71,10 +209,20 @@ class TCPFrameEndpoint(FrameEndpoint):
 
         try:
             # Read the length prefix (4 bytes):
-            blen = yield from self._reader.readexactly(SIZE_PREFIX_LEN)
+            blen = yield from _wait_for(\
+                    self._reader.readexactly(SIZE_PREFIX_LEN),\
+                    self._idle_timeout)
             # Unpack 4 bytes into an integer:
             len_data = struct.unpack('I',blen)[0]
 
+            # Compressed frames are only accepted after compression was
+            # negotiated. Otherwise the flag is treated as part of the length
+            # (Which makes the frame too big):
+            is_compressed = False
+            if self._compress and (len_data & COMPRESSED_FLAG):
+                is_compressed = True
+                len_data &= ~COMPRESSED_FLAG
+
             # If the message length is too big, we close the connection.
             if len_data > self._max_frame_len:
                 yield from self.close()
@@ -82,7 +230,17 @@ class TCPFrameEndpoint(FrameEndpoint):
 
             # Read the message itself (We already know the length):
             # Will read exactly len_data:
-            bmsg = yield from self._reader.readexactly(len_data)
+            with FRAME_READ_LATENCY.time():
+                bmsg = yield from _wait_for(\
+                        self._reader.readexactly(len_data),\
+                        self._read_timeout)
+
+            if is_compressed:
+                bmsg = decompress_frame(bmsg,self._max_frame_len)
+                if bmsg is None:
+                    # Invalid compressed frame, or a decompression bomb:
+                    yield from self.close()
+                    return None
             
             return bmsg
 
@@ -92,6 +250,11 @@ class TCPFrameEndpoint(FrameEndpoint):
             # We return None:
             return None
 
+        except asyncio.TimeoutError:
+            # The remote peer is idle or stalled. We close the connection:
+            yield from self.close()
+            return None
+
 
     @asyncio.coroutine
     def close(self):
@@ -103,3 +266,26 @@ class TCPFrameEndpoint(FrameEndpoint):
             self._is_open = False
 
 
+    def can_compress(self):
+        """
+        Check if this frame endpoint is able to compress frames.
+        """
+        return True
+
+    def enable_compression(self):
+        """
+        Start compressing outgoing frames, and accept compressed incoming
+        frames.
+        """
+        self._compress = True
+
+
+@asyncio.coroutine
+def _wait_for(coro,timeout):
+    """
+    Wait for a coroutine, with an optional timeout (None means no timeout).
+    Raises asyncio.TimeoutError if the timeout expires.
+    """
+    if timeout is None:
+        return (yield from coro)
+    return (yield from asyncio.wait_for(coro,timeout))
@@ -0,0 +1,462 @@
+import time
+import struct
+import asyncio
+import collections
+
+from .frame_endpoint import FrameEndpoint,MAX_FRAME_LEN,SIZE_PREFIX_LEN,\
+        COMPRESSED_FLAG,COMPRESS_THRESHOLD,COMPRESS_LEVEL,\
+        compress_frame,decompress_frame
+from fcatalog.metrics import FRAME_READ_LATENCY
+
+# A FrameEndpoint implemented directly over an asyncio.BufferedProtocol
+# (Available since Python 3.7). Incoming data is received into a growable
+# buffer, and frames are split in place and handed out as memoryviews.
+# Outgoing frames are coalesced and written once per loop iteration.
+#
+# The wire format is the same as the one of TCPFrameEndpoint.
+
+# Initial (and minimal) size of a receive buffer:
+RECV_BUFFER_SIZE = 0x10000
+
+# Minimal amount of free space we hand to the transport on get_buffer():
+MIN_RECV_SPACE = 0x1000
+
+# Pause reading from the socket if this amount of received frames is waiting
+# to be consumed:
+MAX_PENDING_FRAMES = 0x40
+
+
+class BufferedFrameEndpoint(FrameEndpoint,asyncio.BufferedProtocol):
+    def __init__(self,client_handler=None,max_frame_len=MAX_FRAME_LEN,\
+            compress_threshold=COMPRESS_THRESHOLD,\
+            compress_level=COMPRESS_LEVEL,\
+            max_pending_frames=MAX_PENDING_FRAMES,\
+            idle_timeout=None,read_timeout=None,write_timeout=None,\
+            write_buffer_limit=None,loop=None):
+        """
+        client_handler is an optional coroutine function. If given, it is
+        invoked with this endpoint as argument once the connection is made.
+        max_pending_frames bounds the amount of received frames (In flight
+        requests) waiting to be consumed.
+        Timeouts and write_buffer_limit are as in TCPFrameEndpoint.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+        self._client_handler = client_handler
+        # Task running client_handler:
+        self.handler_task = None
+
+        # Max length of one frame:
+        self._max_frame_len = max_frame_len
+        # Compression parameters for outgoing frames:
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+        # Compression is off until it is negotiated with the remote peer:
+        self._compress = False
+
+        self._max_pending_frames = max_pending_frames
+
+        # Timeouts (In seconds):
+        self._idle_timeout = idle_timeout
+        self._read_timeout = read_timeout
+        self._write_timeout = write_timeout
+        self._write_buffer_limit = write_buffer_limit
+        # Timer for receiving the rest of a partially received frame:
+        self._read_timer = None
+
+        self._transport = None
+
+        # Receive buffer. Data between _buf_start and _buf_end was received
+        # but is not yet a full frame. Regions before _buf_start might be
+        # referenced by frames we have handed out, so they are never written
+        # again. Once the buffer is full we move to a new buffer.
+        self._buf = bytearray(RECV_BUFFER_SIZE)
+        self._buf_start = 0
+        self._buf_end = 0
+        # Total length (Including prefix) of the frame currently being
+        # received, if its prefix is already known:
+        self._next_frame_len = None
+        self._next_is_compressed = False
+        # Time when the length prefix of the frame arrived:
+        self._next_frame_start = None
+
+        # Received frames waiting for recv():
+        self._frames = collections.deque()
+        # A future for a recv() call waiting for a frame:
+        self._recv_waiter = None
+        self._reading_paused = False
+
+        # Outgoing data waiting to be written:
+        self._out_bufs = []
+        self._flush_scheduled = False
+        # Write flow control:
+        self._writing_paused = False
+        self._drain_waiter = None
+
+        # Set when the connection was closed (By any side), or when the
+        # remote peer has sent invalid data:
+        self._eof = False
+        self._is_open = True
+
+
+    ##############################################################
+    # asyncio.BufferedProtocol interface:
+
+    def connection_made(self,transport):
+        self._transport = transport
+        if self._write_buffer_limit is not None:
+            transport.set_write_buffer_limits(high=self._write_buffer_limit)
+        if self._client_handler is not None:
+            self.handler_task = asyncio.ensure_future(\
+                    self._client_handler(self),loop=self._loop)
+
+
+    def get_buffer(self,sizehint):
+        """
+        Return a writable buffer for incoming data.
+        """
+        needed = MIN_RECV_SPACE
+        if self._next_frame_len is not None:
+            # Make sure the whole frame can fit:
+            needed = max(needed,\
+                    self._buf_start + self._next_frame_len - self._buf_end)
+
+        if len(self._buf) - self._buf_end < needed:
+            # Move the partial data to a new buffer. We don't reuse the old
+            # buffer, as handed out frames might still point into it.
+            pending = self._buf_end - self._buf_start
+            new_buf = bytearray(max(RECV_BUFFER_SIZE,pending + needed))
+            new_buf[:pending] = self._buf[self._buf_start:self._buf_end]
+            self._buf = new_buf
+            self._buf_start = 0
+            self._buf_end = pending
+
+        return memoryview(self._buf)[self._buf_end:]
+
+
+    def buffer_updated(self,nbytes):
+        """
+        nbytes bytes were written into the buffer returned by get_buffer()
+        """
+        self._buf_end += nbytes
+        self._split_frames()
+        self._update_read_timer()
+
+        if len(self._frames) >= self._max_pending_frames and \
+                not self._reading_paused and not self._eof:
+            # The consumer is too slow. Stop reading from the socket:
+            self._reading_paused = True
+            self._transport.pause_reading()
+
+
+    def eof_received(self):
+        self._set_eof()
+        # Let the transport close itself:
+        return False
+
+
+    def connection_lost(self,exc):
+        self._is_open = False
+        self._set_eof()
+        self._cancel_read_timer()
+        # Release any waiting senders:
+        self._writing_paused = False
+        self._wake_drain_waiter()
+
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake_drain_waiter()
+
+
+    ##############################################################
+
+    def _split_frames(self):
+        """
+        Split all the full frames inside the receive buffer.
+        """
+        buf_view = memoryview(self._buf)
+        while not self._eof:
+            avail = self._buf_end - self._buf_start
+            if avail < SIZE_PREFIX_LEN:
+                break
+
+            if self._next_frame_len is None:
+                len_data = struct.unpack_from('I',self._buf,self._buf_start)[0]
+
+                # Compressed frames are only accepted after compression was
+                # negotiated. Otherwise the flag is treated as part of the
+                # length (Which makes the frame too big):
+                is_compressed = False
+                if self._compress and (len_data & COMPRESSED_FLAG):
+                    is_compressed = True
+                    len_data &= ~COMPRESSED_FLAG
+
+                # If the message length is too big, we close the connection:
+                if len_data > self._max_frame_len:
+                    self._abort()
+                    return
+
+                self._next_frame_len = SIZE_PREFIX_LEN + len_data
+                self._next_is_compressed = is_compressed
+                self._next_frame_start = time.perf_counter()
+
+            if avail < self._next_frame_len:
+                # The frame was not fully received yet:
+                break
+
+            frame = buf_view[self._buf_start + SIZE_PREFIX_LEN:\
+                    self._buf_start + self._next_frame_len]
+            self._buf_start += self._next_frame_len
+            self._next_frame_len = None
+            FRAME_READ_LATENCY.observe(\
+                    time.perf_counter() - self._next_frame_start)
+
+            if self._next_is_compressed:
+                frame = decompress_frame(frame,self._max_frame_len)
+                if frame is None:
+                    # Invalid compressed frame, or a decompression bomb:
+                    self._abort()
+                    return
+
+            self._push_frame(frame)
+
+
+    def _push_frame(self,frame):
+        """
+        Hand a frame (Or None, for end of stream) to the consumer.
+        """
+        if self._recv_waiter is not None:
+            waiter = self._recv_waiter
+            self._recv_waiter = None
+            if not waiter.done():
+                waiter.set_result(frame)
+                return
+        if frame is not None:
+            self._frames.append(frame)
+
+
+    def _update_read_timer(self):
+        """
+        Make sure a partially received frame arrives within read_timeout.
+        """
+        if self._read_timeout is None:
+            return
+        if self._eof or (self._buf_start == self._buf_end):
+            # No partial frame:
+            self._cancel_read_timer()
+        elif self._read_timer is None:
+            self._read_timer = self._loop.call_later(self._read_timeout,\
+                    self._abort)
+
+
+    def _idle_expired(self):
+        """
+        No frame was received within idle_timeout.
+        """
+        if self._buf_start != self._buf_end:
+            # A frame is being received. It is covered by the read timer:
+            return
+        self._abort()
+
+
+    def _cancel_read_timer(self):
+        if self._read_timer is not None:
+            self._read_timer.cancel()
+            self._read_timer = None
+
+
+    def _set_eof(self):
+        """
+        Mark end of stream, and wake up a waiting recv() call.
+        """
+        if self._eof:
+            return
+        self._eof = True
+        self._push_frame(None)
+
+
+    def _abort(self):
+        """
+        Close the connection due to invalid data from the remote peer (Or a
+        stalled remote peer).
+        """
+        self._cancel_read_timer()
+        self._set_eof()
+        self._close_transport()
+
+
+    def _wake_drain_waiter(self):
+        waiter = self._drain_waiter
+        self._drain_waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+    def _flush(self):
+        """
+        Write all pending outgoing data in one call.
+        """
+        self._flush_scheduled = False
+        if not self._out_bufs:
+            return
+        out_bufs = self._out_bufs
+        self._out_bufs = []
+        if self._transport is not None and \
+                not self._transport.is_closing():
+            self._transport.writelines(out_bufs)
+
+
+    def _close_transport(self):
+        if self._transport is not None and self._is_open:
+            self._is_open = False
+            self._flush()
+            self._transport.close()
+
+
+    ##############################################################
+    # FrameEndpoint interface:
+
+    @asyncio.coroutine
+    def send(self,data_frame:bytes):
+        """
+        Send a frame
+        (Send data as a length prefixed frame)
+        """
+        if not self._is_open:
+            return
+
+        len_prefix = len(data_frame)
+        if self._compress:
+            len_prefix,data_frame = compress_frame(data_frame,\
+                    self._compress_threshold,self._compress_level)
+
+        self._out_bufs.append(struct.pack('I',len_prefix))
+        self._out_bufs.append(data_frame)
+
+        # Frames sent during the same loop iteration are written together:
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+        if self._writing_paused:
+            # Transport buffer is above its high-water mark. Wait for it to
+            # drain:
+            if self._drain_waiter is None:
+                self._drain_waiter = self._loop.create_future()
+            try:
+                yield from asyncio.wait_for(asyncio.shield(\
+                        self._drain_waiter),self._write_timeout)
+            except asyncio.TimeoutError:
+                # The remote peer does not read. Throw away the write
+                # buffer:
+                self._out_bufs = []
+                self._is_open = False
+                self._set_eof()
+                self._transport.abort()
+
+
+    @asyncio.coroutine
+    def recv(self):
+        """
+        Receive a frame.
+        The frame is returned as a memoryview into the receive buffer.
+        return value of None means that the remote host has closed the
+        connection (Or some read error has occured).
+        """
+        if self._frames:
+            frame = self._frames.popleft()
+        elif self._eof:
+            return None
+        else:
+            assert self._recv_waiter is None,'recv() called concurrently'
+            self._recv_waiter = self._loop.create_future()
+            idle_timer = None
+            if self._idle_timeout is not None:
+                idle_timer = self._loop.call_later(self._idle_timeout,\
+                        self._idle_expired)
+            try:
+                frame = yield from self._recv_waiter
+            finally:
+                # recv() might have been cancelled:
+                self._recv_waiter = None
+                if idle_timer is not None:
+                    idle_timer.cancel()
+
+        if self._reading_paused and \
+                len(self._frames) < self._max_pending_frames:
+            self._reading_paused = False
+            if self._is_open:
+                self._transport.resume_reading()
+
+        return frame
+
+
+    @asyncio.coroutine
+    def close(self):
+        """Close the connection"""
+        # Pending frames are flushed before the transport is closed:
+        self._close_transport()
+
+
+    def can_compress(self):
+        """
+        Check if this frame endpoint is able to compress frames.
+        """
+        return True
+
+    def enable_compression(self):
+        """
+        Start compressing outgoing frames, and accept compressed incoming
+        frames.
+        """
+        self._compress = True
+
+
+###################################################################
+
+
+@asyncio.coroutine
+def start_frame_server(client_handler,host,port,loop=None,sock=None,\
+        **kwargs):
+    """
+    Start a server that invokes the coroutine function client_handler with a
+    BufferedFrameEndpoint for every new connection.
+    If sock (An already listening socket) is given, host and port are ignored.
+    Extra keyword arguments are passed to BufferedFrameEndpoint.
+    Returns an asyncio Server instance.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    def protocol_factory():
+        return BufferedFrameEndpoint(client_handler,loop=loop,**kwargs)
+
+    if sock is not None:
+        return (yield from loop.create_server(protocol_factory,sock=sock))
+
+    return (yield from loop.create_server(protocol_factory,\
+            host=host,port=port,reuse_address=True))
+
+
+@asyncio.coroutine
+def open_frame_connection(host,port,loop=None,**kwargs):
+    """
+    Connect to a remote host, and return a BufferedFrameEndpoint.
+    Extra keyword arguments are passed to BufferedFrameEndpoint.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    def protocol_factory():
+        return BufferedFrameEndpoint(loop=loop,**kwargs)
+
+    transport,frame_endpoint = yield from \
+            loop.create_connection(protocol_factory,host=host,port=port)
+    return frame_endpoint
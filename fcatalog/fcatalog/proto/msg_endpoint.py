@@ -1,5 +1,7 @@
 import asyncio
 from .serializer import DeserializeError,SerializeError
+from fcatalog.metrics import DESERIALIZE_LATENCY,SERIALIZE_LATENCY,\
+        SEND_LATENCY
 
 
 class MsgEndpoint:
@@ -8,6 +10,12 @@ class MsgEndpoint:
         """Send a message"""
         raise NotImplementedError()
 
+    @asyncio.coroutine
+    def send_many(self,msgs):
+        """Send a few messages, one after the other"""
+        for msg in msgs:
+            yield from self.send(msg)
+
     @asyncio.coroutine
     def recv(self):
         """Receive a message"""
@@ -18,16 +26,32 @@ class MsgEndpoint:
         """Close the connection"""
         raise NotImplementedError()
 
+    def can_compress(self):
+        """
+        Check if this endpoint is able to compress messages.
+        """
+        return False
+
+    def enable_compression(self):
+        """Start compressing outgoing messages"""
+        raise NotImplementedError()
+
 
 
 class MsgFromFrame(MsgEndpoint):
-    def __init__(self,serializer,frame_endpoint):
+    def __init__(self,serializer,frame_endpoint,capture=None):
+        """
+        If capture (A ConnectionCapture) is given, every received frame is
+        recorded.
+        """
         # Keep serializer:
         self.serializer = serializer
 
         # Keep frame_endpoint:
         self._frame_endpoint = frame_endpoint
 
+        self._capture = capture
+
 
     @asyncio.coroutine
     def recv(self):
@@ -40,11 +64,17 @@ class MsgFromFrame(MsgEndpoint):
 
         # Check if the remote host has closed the connection:
         if frame is None:
+            if self._capture is not None:
+                self._capture.close()
             return None
 
+        if self._capture is not None:
+            self._capture.frame(frame)
+
         try:
             # Deserialize the frame into a message:
-            msg_inst = self.serializer.deserialize_msg(frame)
+            with DESERIALIZE_LATENCY.time():
+                msg_inst = self.serializer.deserialize_msg(frame)
         except DeserializeError:
             # If we have an error reading the frame, we consider the
             # connection as closed:
@@ -58,8 +88,21 @@ class MsgFromFrame(MsgEndpoint):
         """
         Send a message msg to the other side.
         """
-        frame = self.serializer.serialize_msg(msg)
-        return ( yield from self._frame_endpoint.send(frame) )
+        with SERIALIZE_LATENCY.time():
+            frame = self.serializer.serialize_msg(msg)
+        with SEND_LATENCY.time():
+            return ( yield from self._frame_endpoint.send(frame) )
+
+
+    @asyncio.coroutine
+    def send_many(self,msgs):
+        """
+        Send a few messages to the other side, as one batch of frames.
+        """
+        with SERIALIZE_LATENCY.time():
+            frames = [self.serializer.serialize_msg(msg) for msg in msgs]
+        with SEND_LATENCY.time():
+            return ( yield from self._frame_endpoint.send_many(frames) )
 
 
     @asyncio.coroutine
@@ -67,5 +110,20 @@ class MsgFromFrame(MsgEndpoint):
         """
         Close the connection
         """
+        if self._capture is not None:
+            self._capture.close()
         # Close the connection:
         yield from self._frame_endpoint.close()
+
+
+    def can_compress(self):
+        """
+        Check if the underlying frame endpoint is able to compress frames.
+        """
+        return self._frame_endpoint.can_compress()
+
+    def enable_compression(self):
+        """
+        Start compressing frames at the underlying frame endpoint.
+        """
+        self._frame_endpoint.enable_compression()
@@ -273,7 +273,8 @@ def d_string(data:bytes) -> str:
         raise DeserializeError('Invalid length prefix')
 
     try:
-        return 4+s_len,data[4:4+s_len].decode('UTF-8','strict')
+        # data might be a memoryview (Which has no decode method):
+        return 4+s_len,str(data[4:4+s_len],'UTF-8','strict')
     except UnicodeDecodeError:
         raise DeserializeError('Invalid utf-8 string.')
 
@@ -298,7 +299,9 @@ def d_blob(data:bytes) -> bytes:
     if len(data) < 4 + b_len:
         raise DeserializeError('Invalid length prefix')
 
-    return 4+b_len,data[4:4+b_len]
+    # Always return a bytes object, even if data is a memoryview. (The result
+    # should not keep a reference to the underlying receive buffer):
+    return 4+b_len,bytes(data[4:4+b_len])
 
 
 def s_uint32(x:int) -> bytes:
@@ -317,3 +320,27 @@ def d_uint32(data:bytes) -> int:
         raise DeserializeError('data is too short to contain a uint32.')
 
     return 4,struct.unpack('I',data[0:4])[0]
+
+
+def s_uint32_list(xs) -> bytes:
+    """
+    Serialize a list of integers into a length prefixed list of uint32.
+    """
+    return struct.pack('I{}I'.format(len(xs)),len(xs),*xs)
+
+
+def d_uint32_list(data:bytes):
+    """
+    Deserialize a length prefixed list of uint32 from the data bytes.
+    Returns next location and the resulting list of integers.
+    """
+    if len(data) < 4:
+        raise DeserializeError('data is too short to contain a uint32 list.')
+
+    l_len = struct.unpack('I',data[0:4])[0]
+
+    if len(data) < 4 + 4*l_len:
+        raise DeserializeError('Invalid length prefix')
+
+    return 4+4*l_len,list(struct.unpack('{}I'.format(l_len),\
+            data[4:4+4*l_len]))
@@ -0,0 +1,496 @@
+import io
+import os
+import time
+import itertools
+import pstats
+import asyncio
+import cProfile
+import logging
+import tracemalloc
+
+from fcatalog.funcs_db import FuncsDB,is_good_db_name,DEFAULT_TUNING_PROFILE
+
+# An admin control channel for a running server process:
+# Line based text commands are accepted on a Unix socket. They allow to
+# profile the process (Or only the connections of one database) with cProfile
+# for a few seconds, to take and compare tracemalloc snapshots, to dump the
+# stacks of all the asyncio tasks, to list the hot signature values of a
+# database, and to show the SQLite settings of a database.
+#
+# Example:
+#   socat - UNIX-CONNECT:/home/ufcatalog/run/admin.0.sock
+#   profile start 30
+#
+# cProfile only sees the thread that enabled it. The event loop thread is
+# profiled by one profile, and every similarity query run by a query thread
+# (See QUERY_THREADS) gets a profile of its own. They are merged into one
+# .pstats file when profiling stops. Time spent in other threads (Logging,
+# database maintenance) is not profiled.
+# Commands that open a database (DB_COMMANDS) run in a thread of an executor:
+# Opening a database may wait for its locks (Up to the busy timeout of its
+# tuning profile), and may write to it (See FuncsDB), which would stall all
+# the connections of the event loop.
+# When profiling one database, a message handler is only profiled while it
+# runs, and not while it waits (For a query thread, or to send), so code of
+# other connections is not charged to it. (Its callers therefore do not get
+# the time of its later steps as cumulative time).
+
+class AdminError(Exception): pass
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+# Default profiling duration, in seconds:
+DEFAULT_PROFILE_SECONDS = 10.0
+
+# Amount of frames kept for every tracemalloc allocation:
+DEFAULT_TRACEMALLOC_FRAMES = 1
+
+# Amount of lines shown for a tracemalloc snapshot or comparison:
+DEFAULT_TRACEMALLOC_LIMIT = 20
+
+# Amount of hot values listed by default:
+DEFAULT_HOT_LIMIT = 20
+
+# Maximum length of a command line:
+MAX_COMMAND_LEN = 0x400
+
+# Commands that open a database, and run in a thread of the executor:
+DB_COMMANDS = ('hot','stats')
+
+HELP_TEXT = """Commands:
+  profile start [seconds]            Profile the whole process (The event
+                                     loop and the query threads).
+  profile db <db_name> [seconds]     Profile connections of one database.
+  profile stop                       Stop profiling early.
+  tracemalloc start [frames]         Start tracing memory allocations.
+  tracemalloc snapshot [limit]       Take a snapshot. Compare it to the
+                                     previous snapshot, if there is one.
+  tracemalloc stop                   Stop tracing memory allocations.
+  tasks                              Dump the stacks of all asyncio tasks.
+  hot <db_name> [limit]              List the most common signature values
+                                     of a database.
+  stats <db_name>                    Show the SQLite settings and the size
+                                     of a database.
+  help                               Show this text.
+"""
+
+
+# Serial numbers for output files:
+_output_serial = itertools.count()
+
+def _output_path(output_dir,kind):
+    """
+    Get a path for a new output file.
+    """
+    return os.path.join(output_dir,'fcatalog-{}-{}-{}.{}'.format(\
+            os.getpid(),time.strftime('%Y%m%d-%H%M%S'),\
+            next(_output_serial),kind))
+
+
+def all_tasks(loop):
+    """
+    Get all the tasks of a loop.
+    """
+    # asyncio.all_tasks is available since Python 3.7:
+    if hasattr(asyncio,'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop)
+
+
+class Profiling:
+    """
+    cProfile profiling of this process, or of the connections of one
+    database.
+    """
+    def __init__(self):
+        self._profile = None
+        # If not None, only connections of this database are profiled:
+        self._db_name = None
+        self._output_path = None
+        self._stop_handle = None
+        # Profiles of the query threads:
+        self._thread_profiles = []
+
+    @property
+    def is_running(self):
+        return self._profile is not None
+
+    def start(self,seconds,output_dir,loop,db_name=None):
+        """
+        Start profiling for the given amount of seconds.
+        Returns the path of the .pstats file that will be written.
+        """
+        if self.is_running:
+            raise AdminError('Profiling is already running')
+
+        self._profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._db_name = db_name
+        self._output_path = _output_path(output_dir,'pstats')
+        self._stop_handle = loop.call_later(seconds,self.stop)
+        if db_name is None:
+            self._profile.enable()
+        return self._output_path
+
+    def stop(self):
+        """
+        Stop profiling, and write the collected stats.
+        Returns the path of the .pstats file.
+        """
+        if not self.is_running:
+            raise AdminError('Profiling is not running')
+
+        profile = self._profile
+        thread_profiles = self._thread_profiles
+        output_path = self._output_path
+        self._profile = None
+        self._thread_profiles = []
+        self._db_name = None
+        self._stop_handle.cancel()
+        self._stop_handle = None
+
+        profile.disable()
+        _dump_stats([profile] + thread_profiles,output_path)
+        logger.info('Profile stats were written to %s',output_path)
+        return output_path
+
+    def for_db(self,db_name):
+        """
+        Get the profile to enable while handling a message of a connection to
+        the database db_name, or None.
+        """
+        if self._profile is None or self._db_name is None:
+            return None
+        if self._db_name != db_name:
+            return None
+        return self._profile
+
+    def run_in_thread(self,db_name,func,*args):
+        """
+        Call func(*args) from a query thread, on behalf of a connection to
+        the database db_name. The call is profiled (Into a profile of its
+        own) if the process or the database is being profiled.
+        """
+        if self._profile is None or self._db_name not in (None,db_name):
+            return func(*args)
+        thread_profiles = self._thread_profiles
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func,*args)
+        finally:
+            thread_profiles.append(profile)
+
+
+def _dump_stats(profiles,output_path):
+    """
+    Write the merged stats of a few profiles into a .pstats file.
+    """
+    stats = None
+    for profile in profiles:
+        profile.create_stats()
+        if not profile.stats:
+            # pstats can not load a profile without stats:
+            continue
+        if stats is None:
+            stats = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+    if stats is None:
+        profiles[0].dump_stats(output_path)
+    else:
+        stats.dump_stats(output_path)
+
+
+# Profiling state of this process:
+profiling = Profiling()
+
+
+def connection_profile(db_name):
+    """
+    Get the profile to enable while handling a message of a connection to the
+    database db_name, or None if the connection is not being profiled.
+    """
+    return profiling.for_db(db_name)
+
+
+def run_profiled_in_thread(db_name,func,*args):
+    """
+    Call func(*args) from a query thread, on behalf of a connection to the
+    database db_name. (Profiled if needed, see Profiling.run_in_thread).
+    """
+    return profiling.run_in_thread(db_name,func,*args)
+
+
+@asyncio.coroutine
+def run_profiled(coro,profile):
+    """
+    Run a coroutine, with the profile enabled only while the coroutine runs.
+    The profile is disabled whenever the coroutine waits, so the code of
+    other tasks that run meanwhile is not charged to it.
+    """
+    value = None
+    exc = None
+    while True:
+        profile.enable()
+        try:
+            if exc is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(exc)
+        except StopIteration as e:
+            return e.value
+        finally:
+            profile.disable()
+
+        try:
+            value = yield future
+            exc = None
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            value = None
+            exc = e
+
+
+class AdminServer:
+    def __init__(self,output_dir,loop=None,db_base_path=None,num_hashes=None,\
+            tuning_profile=DEFAULT_TUNING_PROFILE,db_tuning_profiles=None,\
+            executor=None):
+        """
+        Profiles and snapshots are written into output_dir.
+        The databases (For the hot and stats commands) are in db_base_path,
+        and are opened with their tuning profiles (See FuncsDB).
+        Commands that open a database run in executor (The default executor
+        of the loop if None).
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._executor = executor
+        self._output_dir = output_dir
+        self._db_base_path = db_base_path
+        self._num_hashes = num_hashes
+        self._tuning_profile = tuning_profile
+        self._db_tuning_profiles = db_tuning_profiles or {}
+        # The last tracemalloc snapshot:
+        self._snapshot = None
+
+    @asyncio.coroutine
+    def client_handler(self,reader,writer):
+        """
+        Handle the commands of one admin connection.
+        """
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+                words = line.decode('UTF-8','replace').split()
+                try:
+                    if len(words) > 0 and words[0] in DB_COMMANDS:
+                        response = yield from self._loop.run_in_executor(\
+                                self._executor,self.handle_command,words)
+                    else:
+                        response = self.handle_command(words)
+                except AdminError as e:
+                    response = 'Error: {}\n'.format(e)
+                except Exception as e:
+                    logger.exception('Admin command failed')
+                    response = 'Error: {!r}\n'.format(e)
+                writer.write(response.encode('UTF-8'))
+                yield from writer.drain()
+        except (ValueError,ConnectionError):
+            # Line is too long, or the connection was reset:
+            pass
+        finally:
+            writer.close()
+
+    def handle_command(self,words):
+        """
+        Run one command, given as a list of words. Returns the response text.
+        (Commands in DB_COMMANDS block until the database was opened).
+        """
+        if len(words) == 0:
+            return ''
+        cmd,args = words[0],words[1:]
+        if cmd == 'help':
+            return HELP_TEXT
+        if cmd == 'profile':
+            return self._cmd_profile(args)
+        if cmd == 'tracemalloc':
+            return self._cmd_tracemalloc(args)
+        if cmd == 'tasks':
+            return self._cmd_tasks()
+        if cmd == 'hot':
+            return self._cmd_hot(args)
+        if cmd == 'stats':
+            return self._cmd_stats(args)
+        raise AdminError('Unknown command {!r}. Try help.'.format(cmd))
+
+    def _cmd_profile(self,args):
+        if args == ['stop']:
+            return 'Profile stats were written to {}\n'.\
+                    format(profiling.stop())
+
+        db_name = None
+        if len(args) >= 2 and args[0] == 'db':
+            db_name = args[1]
+            args = args[2:]
+        elif len(args) >= 1 and args[0] == 'start':
+            args = args[1:]
+        else:
+            raise AdminError('Usage: profile start|db <db_name>|stop')
+
+        seconds = DEFAULT_PROFILE_SECONDS
+        if len(args) > 0:
+            seconds = _parse_number(args[0],float)
+
+        output_path = profiling.start(seconds,\
+                self._output_dir,self._loop,db_name=db_name)
+        return 'Profiling {} for {} seconds. Stats will be written to {}\n'.\
+                format('all connections' if db_name is None else \
+                'connections of database {}'.format(db_name),\
+                seconds,output_path)
+
+    def _cmd_tracemalloc(self,args):
+        if len(args) == 0:
+            raise AdminError('Usage: tracemalloc start|snapshot|stop')
+
+        if args[0] == 'start':
+            frames = DEFAULT_TRACEMALLOC_FRAMES
+            if len(args) > 1:
+                frames = _parse_number(args[1],int)
+            tracemalloc.start(frames)
+            self._snapshot = None
+            return 'Tracing memory allocations\n'
+
+        if args[0] == 'stop':
+            tracemalloc.stop()
+            self._snapshot = None
+            return 'Stopped tracing memory allocations\n'
+
+        if args[0] == 'snapshot':
+            if not tracemalloc.is_tracing():
+                raise AdminError('tracemalloc is not tracing.'
+                        ' Use tracemalloc start')
+            limit = DEFAULT_TRACEMALLOC_LIMIT
+            if len(args) > 1:
+                limit = _parse_number(args[1],int)
+
+            snapshot = tracemalloc.take_snapshot()
+            output_path = _output_path(self._output_dir,'tracemalloc')
+            snapshot.dump(output_path)
+
+            if self._snapshot is None:
+                title = 'Top allocations:'
+                stats = snapshot.statistics('lineno')
+            else:
+                title = 'Allocation changes since the previous snapshot:'
+                stats = snapshot.compare_to(self._snapshot,'lineno')
+            self._snapshot = snapshot
+
+            lines = ['Snapshot was written to {}'.format(output_path),title]
+            lines += [str(stat) for stat in stats[:limit]]
+            return '\n'.join(lines) + '\n'
+
+        raise AdminError('Usage: tracemalloc start|snapshot|stop')
+
+    def _cmd_tasks(self):
+        out = io.StringIO()
+        tasks = all_tasks(self._loop)
+        out.write('{} tasks\n'.format(len(tasks)))
+        for task in tasks:
+            out.write('\n{!r}\n'.format(task))
+            task.print_stack(file=out)
+        return out.getvalue()
+
+    def _cmd_hot(self,args):
+        if len(args) not in (1,2):
+            raise AdminError('Usage: hot <db_name> [limit]')
+
+        db_name = args[0]
+        limit = DEFAULT_HOT_LIMIT
+        if len(args) > 1:
+            limit = _parse_number(args[1],int)
+
+        fdb = self._open_db(db_name)
+        try:
+            hot_values = fdb.hot_values(limit)
+        finally:
+            fdb.close()
+
+        lines = ['{} hot values of database {}:'.format(len(hot_values),\
+                db_name)]
+        lines += ['c{} 0x{:08x} {}'.format(col,value,count) \
+                for col,value,count in hot_values]
+        return '\n'.join(lines) + '\n'
+
+    def _cmd_stats(self,args):
+        if len(args) != 1:
+            raise AdminError('Usage: stats <db_name>')
+
+        db_name = args[0]
+        fdb = self._open_db(db_name)
+        try:
+            settings = fdb.settings()
+        finally:
+            fdb.close()
+
+        lines = ['Settings of database {}:'.format(db_name)]
+        lines += ['{} {}'.format(name,settings[name]) \
+                for name in sorted(settings)]
+        return '\n'.join(lines) + '\n'
+
+    def _open_db(self,db_name):
+        """
+        Open an existing database by name, with its tuning profile.
+        """
+        if self._db_base_path is None:
+            raise AdminError('No databases are configured')
+        db_path = os.path.join(self._db_base_path,db_name)
+        if not is_good_db_name(db_name) or not os.path.isfile(db_path):
+            raise AdminError('No database {!r}'.format(db_name))
+        return FuncsDB(db_path,self._num_hashes,\
+                tuning_profile=self._db_tuning_profiles.get(db_name,\
+                self._tuning_profile))
+
+
+def _parse_number(text,num_type):
+    try:
+        value = num_type(text)
+    except ValueError:
+        raise AdminError('Invalid number {!r}'.format(text))
+    if value <= 0:
+        raise AdminError('Expected a positive number, got {!r}'.format(text))
+    return value
+
+
+@asyncio.coroutine
+def start_admin_server(path,output_dir,loop=None,db_base_path=None,\
+        num_hashes=None,tuning_profile=DEFAULT_TUNING_PROFILE,\
+        db_tuning_profiles=None,executor=None):
+    """
+    Serve admin commands on the Unix socket at path. Only the owner of the
+    server process may connect. Commands that open a database run in
+    executor (See AdminServer).
+    Returns an asyncio Server instance.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    # Remove a socket left by a previous run:
+    if os.path.exists(path):
+        os.unlink(path)
+
+    admin = AdminServer(output_dir,loop=loop,db_base_path=db_base_path,\
+            num_hashes=num_hashes,tuning_profile=tuning_profile,\
+            db_tuning_profiles=db_tuning_profiles,executor=executor)
+    old_umask = os.umask(0o177)
+    try:
+        server = yield from asyncio.start_unix_server(admin.client_handler,\
+                path=path,loop=loop,limit=MAX_COMMAND_LEN)
+    finally:
+        os.umask(old_umask)
+    return server
@@ -0,0 +1,82 @@
+import asyncio
+import collections
+import logging
+
+# Admission control for client connections:
+# At most max_connections connections are served at the same time. Every
+# served connection holds a database handle. Excess connections wait in a
+# bounded queue for a free slot, and are rejected if the queue is full or if
+# no slot was freed in time.
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+
+class AdmissionControl:
+    def __init__(self,max_connections,max_queued,queue_timeout,loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+
+        self._max_connections = max_connections
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+
+        # Amount of connections being served:
+        self.active = 0
+        # Futures of connections waiting for a slot:
+        self._waiters = collections.deque()
+
+    @property
+    def queued(self):
+        """
+        Amount of connections waiting for a slot.
+        """
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    @asyncio.coroutine
+    def acquire(self):
+        """
+        Wait for a slot to serve a connection.
+        Returns True if a slot was acquired, or False if the connection should
+        be rejected.
+        """
+        if self.active < self._max_connections and not self._waiters:
+            self.active += 1
+            return True
+
+        if self.queued >= self._max_queued:
+            return False
+
+        waiter = asyncio.Future(loop=self._loop)
+        self._waiters.append(waiter)
+        try:
+            yield from asyncio.wait_for(waiter,self._queue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed to us just before we were cancelled. Pass
+                # it on:
+                self.release()
+            raise
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+        # The slot was handed to us by release():
+        return True
+
+    def release(self):
+        """
+        Free the slot of a connection that was served.
+        """
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Hand our slot to the waiting connection:
+                waiter.set_result(None)
+                return
+        self.active -= 1
@@ -1,42 +1,166 @@
 import asyncio
+import functools
+import collections
 import logging
 import os
-import string
+import random
+import time
 
 from fcatalog.proto.msg_endpoint import MsgEndpoint
 from fcatalog.server.fcatalog_proto import cser_serializer,FSimilar
-from fcatalog.funcs_db import FuncsDB
+from fcatalog.funcs_db import FuncsDB,Similars,is_good_db_name,\
+        HOT_VALUE_THRESHOLD,HOT_VALUE_CAP,DEFAULT_TUNING_PROFILE
+from fcatalog.metrics import MESSAGES,MESSAGE_LATENCY,OPEN_CONNECTIONS
+from fcatalog.server.tracing import Tracer,NULL_TRACE
+from fcatalog.server.admin import connection_profile,run_profiled,\
+        run_profiled_in_thread
+from fcatalog.catalog1 import Catalog1Signer,Catalog1Error,strong_hasher,\
+        sign,strong_hash,STRONG_HASH_LEN
 
 class ServerLogicError(Exception): pass
 
+# Maximum total length of function data sent using a chunked transfer:
+MAX_CHUNKED_DATA_LEN = 2**28
+
+# Messages that begin a chunked transfer of function data:
+CHUNKED_BEGIN_MSGS = ('BeginAddFunction','BeginRequestSimilars')
+# Messages that are allowed while a chunked transfer is in progress:
+CHUNKED_DATA_MSGS = ('FuncDataChunk','EndFuncData')
+
+# Maximum amount of unanswered signature challenges for one connection. A
+# sampled AddFunctionSigned while this amount is reached closes the connection:
+MAX_PENDING_CHALLENGES = 0x100
+
+# A challenge must be answered within this amount of messages received after it
+# was sent, and within this amount of seconds. Otherwise the connection is
+# closed. (A client that ignores challenges would get its signatures added
+# without verification):
+CHALLENGE_RESPONSE_MSGS = 0x2000
+CHALLENGE_TIMEOUT = 60.0
+
+# Default maximum amount of similars returned for one query. Larger requested
+# amounts are reduced to this amount:
+MAX_SIMILARS = 0x100
+
+# Random source for sampling spot checks. (Should not be predictable by
+# clients):
+spot_check_random = random.SystemRandom()
+
 
 # Set up logger:
 logger = logging.getLogger(__name__)
 
-def is_good_db_name(db_name):
+
+# An AddFunctionSigned message waiting for a ChallengeResponse, and the message
+# count and time by which the response is due:
+PendingChallenge = collections.namedtuple('PendingChallenge',\
+        ['add_msg','msgs_due','time_due'])
+
+
+class ChunkedFuncData:
     """
-    Check if a db_name is valid. We have to be careful of directory traversal
-    here.
+    State of one chunked transfer of function data.
+    The data is signed and hashed as it arrives, and is never kept as a whole.
     """
-    good_chars = string.ascii_letters + string.digits + "_"
-    for c in db_name:
-        if c not in good_chars:
-            return False
+    def __init__(self,begin_msg,num_hashes):
+        # The message that began the transfer:
+        self.begin_msg = begin_msg
+        self._signer = Catalog1Signer(num_hashes)
+        self._hasher = strong_hasher()
 
-    return True
+    @property
+    def data_len(self):
+        """
+        Amount of function data received so far.
+        """
+        return self._signer.data_len
+
+    def update(self,data_chunk):
+        """
+        Feed a chunk of function data.
+        """
+        self._signer.update(data_chunk)
+        self._hasher.update(data_chunk)
+
+    def digest(self):
+        """
+        Get the strong hash and catalog1 signature of all the function data.
+        Raises Catalog1Error if not enough data was received.
+        """
+        return self._hasher.digest(),self._signer.digest()
 
 
 class FCatalogServerLogic:
-    def __init__(self,db_base_path,num_hashes,msg_endpoint):
+    def __init__(self,db_base_path,num_hashes,msg_endpoint,\
+            max_chunked_len=MAX_CHUNKED_DATA_LEN,spot_check_rate=0.0,\
+            use_sig_index=False,max_similars=MAX_SIMILARS,tracer=None,\
+            query_cache=None,query_executor=None,\
+            hot_threshold=HOT_VALUE_THRESHOLD,hot_cap=HOT_VALUE_CAP,\
+            tuning_profile=DEFAULT_TUNING_PROFILE,db_tuning_profiles=None,\
+            maintenance=None,challenge_timeout=CHALLENGE_TIMEOUT):
         # Keep database base path:
         self._db_base_path = db_base_path
         # Keep amount of hashes:
         self._num_hashes = num_hashes
         # Message endpoint:
         self._msg_endpoint = msg_endpoint
+        # Maximum total length of function data in a chunked transfer:
+        self._max_chunked_len = max_chunked_len
 
         # Initially Functions Database interface is None:
         self._fdb = None
+        self._db_name = None
+        # Answer queries using a signature index shared between processes:
+        self._use_sig_index = use_sig_index
+        # Maximum amount of similars returned for one query:
+        self._max_similars = max_similars
+        # Limits of candidates for hot signature values (See FuncsDB):
+        self._hot_threshold = hot_threshold
+        self._hot_cap = hot_cap
+        # SQLite tuning profile of databases, and of some databases by name
+        # (See FuncsDB):
+        self._tuning_profile = tuning_profile
+        self._db_tuning_profiles = db_tuning_profiles or {}
+        # Background maintenance of databases, told about every handled
+        # message (None disables maintenance):
+        self._maintenance = maintenance
+        # Results of similarity queries, shared with the other connections
+        # (None disables caching):
+        self._query_cache = query_cache
+        # An executor (concurrent.futures) for running similarity queries
+        # outside the event loop. If None, queries run on the event loop:
+        self._query_executor = query_executor
+
+        # Tracing of sampled messages:
+        if tracer is None:
+            tracer = Tracer()
+        self._tracer = tracer
+        # The trace of the message being handled:
+        self._trace = NULL_TRACE
+
+        # Current chunked transfer of function data (If any):
+        self._chunked = None
+
+        # Limits of queries, set by SetQueryLimits (None means no limit).
+        # Once set, results are sent as ResponseSimilarsApprox:
+        self._bounded = False
+        self._max_candidates = None
+        self._deadline_ms = None
+        # Minimum grade of results, set by SetMinGrade (None means no
+        # minimum):
+        self._min_grade = None
+        # Amount of signature values used for searching candidates, set by
+        # SetQueryHashes (None means the whole signature):
+        self._query_hashes = None
+
+        # Fraction of AddFunctionSigned messages to verify:
+        self._spot_check_rate = spot_check_rate
+        # Challenges waiting for a ChallengeResponse (PendingChallenge), by
+        # func_hash, oldest first:
+        self._pending_challenges = collections.OrderedDict()
+        self._challenge_timeout = challenge_timeout
+        # Amount of messages handled after ChooseDB:
+        self._num_msgs = 0
 
     @asyncio.coroutine
     def client_handler(self):
@@ -45,18 +169,37 @@ class FCatalogServerLogic:
         Communication with the client is done through the msg_endpoint class
         instance.
         """
-        logger.debug('New connection {}'.format(id(self._msg_endpoint)))
+        OPEN_CONNECTIONS.inc()
+        try:
+            yield from self._client_handler()
+        finally:
+            OPEN_CONNECTIONS.dec()
+
+
+    @asyncio.coroutine
+    def _client_handler(self):
+        logger.debug('New connection %s',id(self._msg_endpoint))
         msg_inst = ( yield from self._msg_endpoint.recv() )
 
         if msg_inst is None:
             # Remote peer has disconnected or sent invalid data. We disconnect.
             return
 
+        MESSAGES.labels(msg_inst.msg_name).inc()
+        if msg_inst.msg_name == 'RequestCompression':
+            # Compression may only be negotiated before ChooseDB. Old clients
+            # just send ChooseDB first.
+            yield from self._handle_request_compression(msg_inst)
+            msg_inst = ( yield from self._msg_endpoint.recv() )
+            if msg_inst is None:
+                return
+            MESSAGES.labels(msg_inst.msg_name).inc()
+
         if msg_inst.msg_name != 'ChooseDB':
             # If the first message is not ChooseDB, we disconnect.
-            logger.debug('Connection {} has {} as first message.'
-                    ' Closing connection.'.\
-                            format(msg_inst.msg_name, id(self._msg_endpoint)))
+            logger.debug('Connection %s has %s as first message.'
+                    ' Closing connection.',\
+                    id(self._msg_endpoint),msg_inst.msg_name)
             return
 
         # Database name:
@@ -64,40 +207,62 @@ class FCatalogServerLogic:
 
         # Validate database name:
         if not is_good_db_name(db_name):
-            logger.info('Invalid db name {} was chosen at connection {}'.\
-                    format(db_name,id(self._msg_endpoint)))
+            logger.info('Invalid db name %r was chosen at connection %s',\
+                    db_name,id(self._msg_endpoint))
             # Disconnect the client:
             return
 
         # Conclude database path:
         db_path = os.path.join(self._db_base_path,db_name)
 
-        logger.debug('db_path = {} at connection {}'.\
-                format(db_path,id(self._msg_endpoint)))
+        logger.debug('db_path = %s at connection %s',\
+                db_path,id(self._msg_endpoint))
 
+        self._db_name = db_name
         # Build a Functions DB interface:
-        self._fdb = FuncsDB(db_path,self._num_hashes)
+        self._fdb = FuncsDB(db_path,self._num_hashes,\
+                use_sig_index=self._use_sig_index,\
+                hot_threshold=self._hot_threshold,hot_cap=self._hot_cap,\
+                tuning_profile=self._db_tuning_profiles.get(db_name,\
+                self._tuning_profile))
+        self._build_hash_filter()
         try:
             msg_inst = ( yield from self._msg_endpoint.recv() )
             while msg_inst is not None:
-                if msg_inst.msg_name == 'ChooseDB':
-                    # We can't have two ChooseDB messages in a connection. We
-                    # close the connection:
-                    return
-                elif msg_inst.msg_name == 'AddFunction':
-                    yield from self._handle_add_function(msg_inst)
-                elif msg_inst.msg_name == 'RequestSimilars':
-                    yield from self._handle_request_similars(msg_inst)
+                MESSAGES.labels(msg_inst.msg_name).inc()
+                msg_start = time.perf_counter()
+                self._trace = self._tracer.start(msg_inst.msg_name,\
+                        id(self._msg_endpoint))
+
+                profile = connection_profile(self._db_name)
+                if profile is None:
+                    keep_open = yield from self._handle_msg(msg_inst)
                 else:
-                    # This should never happen:
-                    raise ServerLogicError('Unknown message name {}'.\
-                            format(msg_inst.msg_name))
+                    keep_open = yield from run_profiled(\
+                            self._handle_msg(msg_inst),profile)
+                if not keep_open:
+                    return
+
+                MESSAGE_LATENCY.labels(msg_inst.msg_name).observe(\
+                        time.perf_counter() - msg_start)
+                self._trace.finish()
+                self._trace = NULL_TRACE
+
+                # Every message is handled in its own transaction. The database
+                # is shared with the other connections of this process (And of
+                # other server processes). A connection that kept its write
+                # lock while waiting for the next message would make their
+                # writes wait on the lock, blocking the event loop:
+                self._fdb.commit_funcs()
+                self._build_hash_filter()
+                if self._maintenance is not None:
+                    self._maintenance.db_used(self._db_name)
 
                 # Receive the next message:
                 msg_inst = ( yield from self._msg_endpoint.recv() )
 
-            logger.debug('Received a None message on connection {}'.\
-                    format(id(self._msg_endpoint)))
+            logger.debug('Received a None message on connection %s',\
+                    id(self._msg_endpoint))
 
         finally:
             # We make sure to eventually close the fdb interface (To commit all
@@ -105,6 +270,114 @@ class FCatalogServerLogic:
             self._fdb.close()
 
 
+    @asyncio.coroutine
+    def _handle_msg(self,msg_inst):
+        """
+        Handle one message after ChooseDB.
+        Returns False if the connection should be closed.
+        """
+        self._num_msgs += 1
+        if not self._challenges_in_time():
+            return False
+
+        if (self._chunked is not None) and \
+                (msg_inst.msg_name not in CHUNKED_DATA_MSGS):
+            # A chunked transfer may not be interleaved with other
+            # messages. We close the connection:
+            return False
+
+        if msg_inst.msg_name == 'ChooseDB':
+            # We can't have two ChooseDB messages in a connection. We
+            # close the connection:
+            return False
+        elif msg_inst.msg_name == 'RequestCompression':
+            # Compression can not be negotiated after ChooseDB. We
+            # close the connection:
+            return False
+        elif msg_inst.msg_name == 'AddFunction':
+            yield from self._handle_add_function(msg_inst)
+        elif msg_inst.msg_name == 'RequestSimilars':
+            yield from self._handle_request_similars(msg_inst)
+        elif msg_inst.msg_name == 'AddFunctionSigned':
+            if not self._is_valid_signed(msg_inst):
+                return False
+            if not (yield from self._handle_add_function_signed(msg_inst)):
+                return False
+        elif msg_inst.msg_name == 'RequestSimilarsSigned':
+            if not self._is_valid_signed(msg_inst):
+                return False
+            yield from self._handle_request_similars_signed(msg_inst)
+        elif msg_inst.msg_name == 'ChallengeResponse':
+            if not self._check_challenge_response(msg_inst):
+                # The client did not answer a challenge correctly.
+                # We close the connection:
+                return False
+        elif msg_inst.msg_name == 'SetQueryLimits':
+            self._handle_set_query_limits(msg_inst)
+        elif msg_inst.msg_name == 'SetMinGrade':
+            self._min_grade = msg_inst.get_field('min_grade') or None
+        elif msg_inst.msg_name == 'SetQueryHashes':
+            self._query_hashes = msg_inst.get_field('num_hashes') or None
+        elif msg_inst.msg_name in CHUNKED_BEGIN_MSGS:
+            self._chunked = ChunkedFuncData(msg_inst,\
+                    self._num_hashes)
+        elif msg_inst.msg_name == 'FuncDataChunk':
+            if self._chunked is None:
+                # No chunked transfer was begun. We close the
+                # connection:
+                return False
+            data_chunk = msg_inst.get_field('data_chunk')
+            if self._chunked.data_len + len(data_chunk) > \
+                    self._max_chunked_len:
+                logger.info('Chunked function data is too long'
+                        ' on connection %s',id(self._msg_endpoint))
+                return False
+            self._chunked.update(data_chunk)
+        elif msg_inst.msg_name == 'EndFuncData':
+            if self._chunked is None:
+                # No chunked transfer was begun. We close the
+                # connection:
+                return False
+            yield from self._handle_end_func_data()
+        else:
+            # This should never happen:
+            raise ServerLogicError('Unknown message name {}'.\
+                    format(msg_inst.msg_name))
+
+        return True
+
+
+    @asyncio.coroutine
+    def _handle_request_compression(self,msg_inst):
+        """
+        Handle a RequestCompression message.
+        """
+        accepted = self._msg_endpoint.can_compress()
+
+        logger.debug('RequestCompression: accepted=%s on connection %s',\
+                accepted,id(self._msg_endpoint))
+
+        # Build a ResponseCompression message:
+        resp_msg = cser_serializer.get_msg('ResponseCompression')
+        resp_msg.set_field('accepted',int(accepted))
+
+        # The response itself is sent before compression is enabled:
+        yield from self._msg_endpoint.send(resp_msg)
+
+        if accepted:
+            self._msg_endpoint.enable_compression()
+
+
+    def _handle_set_query_limits(self,msg_inst):
+        """
+        Handle a SetQueryLimits message. The limits apply to the following
+        queries of the connection.
+        """
+        self._bounded = True
+        self._max_candidates = msg_inst.get_field('max_candidates') or None
+        self._deadline_ms = msg_inst.get_field('deadline_ms') or None
+
+
     @asyncio.coroutine
     def _handle_add_function(self,msg_inst):
         """
@@ -114,14 +387,12 @@ class FCatalogServerLogic:
         func_comment = msg_inst.get_field('func_comment')
         func_data = msg_inst.get_field('func_data')
 
-        logger.debug('AddFunction: func_name={}'
-                ' func_comment={}'
-                ' func_data={} on connection {}'.\
-                        format(func_name,func_comment,func_data,\
-                        id(self._msg_endpoint)))
+        self._trace.add_payload(func_name=func_name,\
+                func_comment=func_comment,func_data=func_data)
 
         # Add function to database:
-        self._fdb.add_function(func_name,func_data,func_comment)
+        with self._trace.span('db'):
+            self._fdb.add_function(func_name,func_data,func_comment)
 
         
     @asyncio.coroutine
@@ -130,16 +401,287 @@ class FCatalogServerLogic:
         Handle a RequestSimilars message.
         """
         func_data = msg_inst.get_field('func_data')
-        num_similars = msg_inst.get_field('num_similars')
+        num_similars = self._cap_num_similars(msg_inst)
 
-        logger.debug('GetSimilars: func_data={}'
-                ' num_similars={} on connection {}'.\
-                        format(func_data,num_similars,\
-                        id(self._msg_endpoint)))
+        self._trace.add_payload(func_data=func_data,\
+                num_similars=num_similars)
 
         # Get a list of similar functions from the db:
-        sims = self._fdb.get_similars(func_data,num_similars)
+        with self._trace.span('db'):
+            sims = yield from self._get_similars(\
+                    (strong_hash(func_data),num_similars),\
+                    self._fdb.get_similars,func_data,num_similars)
+
+        yield from self._send_similars(sims)
+
+
+    def _cap_num_similars(self,msg_inst):
+        """
+        Get the num_similars field of a query message, reduced to at most
+        max_similars.
+        """
+        return min(msg_inst.get_field('num_similars'),self._max_similars)
+
+
+    def _is_valid_signed(self,msg_inst):
+        """
+        Check the strong hash and signature sizes of a signed message.
+        """
+        func_hash = msg_inst.get_field('func_hash')
+        func_sig = msg_inst.get_field('func_sig')
+        if len(func_hash) != STRONG_HASH_LEN or \
+                len(func_sig) != self._num_hashes:
+            logger.info('Invalid %s on connection %s',\
+                    msg_inst.msg_name,id(self._msg_endpoint))
+            return False
+        return True
+
+
+    def _challenges_in_time(self):
+        """
+        Check that the oldest pending challenge is not overdue.
+        """
+        if not self._pending_challenges:
+            return True
+        challenge = next(iter(self._pending_challenges.values()))
+        if (self._num_msgs <= challenge.msgs_due) and \
+                (time.monotonic() <= challenge.time_due):
+            return True
+        logger.warning('Signature challenge was not answered in time on'
+                ' connection %s',id(self._msg_endpoint))
+        return False
+
+
+    @asyncio.coroutine
+    def _handle_add_function_signed(self,msg_inst):
+        """
+        Handle an AddFunctionSigned message.
+        A sampled fraction of the messages is verified before it is added to
+        the database.
+        Returns False if the connection should be closed.
+        """
+        func_hash = msg_inst.get_field('func_hash')
+
+        self._trace.add_payload(func_name=msg_inst.get_field('func_name'),\
+                func_comment=msg_inst.get_field('func_comment'),\
+                func_hash=func_hash,func_sig=msg_inst.get_field('func_sig'))
+
+        challenge = self._pending_challenges.get(func_hash)
+        if challenge is not None:
+            # The function is already challenged. The latest message is the
+            # one verified by the response (Its due time is kept):
+            self._pending_challenges[func_hash] = \
+                    challenge._replace(add_msg=msg_inst)
+            return True
+
+        if spot_check_random.random() < self._spot_check_rate:
+            if len(self._pending_challenges) >= MAX_PENDING_CHALLENGES:
+                # The client does not answer challenges. We close the
+                # connection:
+                logger.warning('Too many unanswered signature challenges on'
+                        ' connection %s',id(self._msg_endpoint))
+                return False
+            # Challenge the client to send the function data. The function is
+            # added only after its signature was verified.
+            self._pending_challenges[func_hash] = PendingChallenge(\
+                    add_msg=msg_inst,\
+                    msgs_due=self._num_msgs + CHALLENGE_RESPONSE_MSGS,\
+                    time_due=time.monotonic() + self._challenge_timeout)
+            challenge_msg = cser_serializer.get_msg('ChallengeFuncData')
+            challenge_msg.set_field('func_hash',func_hash)
+            with self._trace.span('send'):
+                yield from self._msg_endpoint.send(challenge_msg)
+            return True
+
+        with self._trace.span('db'):
+            self._fdb.add_signature(\
+                    msg_inst.get_field('func_name'),\
+                    func_hash,msg_inst.get_field('func_sig'),\
+                    msg_inst.get_field('func_comment'))
+        return True
 
+
+    def _check_challenge_response(self,msg_inst):
+        """
+        Handle a ChallengeResponse message: Verify the function data against
+        the pending AddFunctionSigned message, and add the function to the
+        database.
+        Returns False if the response is invalid.
+        """
+        func_data = msg_inst.get_field('func_data')
+        func_hash = strong_hash(func_data)
+        challenge = self._pending_challenges.pop(func_hash,None)
+        if challenge is None:
+            logger.info('Unexpected ChallengeResponse on connection %s',\
+                    id(self._msg_endpoint))
+            return False
+        add_msg = challenge.add_msg
+
+        try:
+            with self._trace.span('sign'):
+                func_sig = sign(func_data,self._num_hashes)
+        except Catalog1Error:
+            func_sig = None
+
+        if func_sig != add_msg.get_field('func_sig'):
+            logger.warning('Signature spot check failed for func_name=%r'
+                    ' on connection %s',add_msg.get_field('func_name'),\
+                    id(self._msg_endpoint))
+            return False
+
+        with self._trace.span('db'):
+            self._fdb.add_signature(\
+                    add_msg.get_field('func_name'),\
+                    func_hash,func_sig,\
+                    add_msg.get_field('func_comment'))
+        return True
+
+
+    @asyncio.coroutine
+    def _handle_request_similars_signed(self,msg_inst):
+        """
+        Handle a RequestSimilarsSigned message.
+        """
+        func_hash = msg_inst.get_field('func_hash')
+        num_similars = self._cap_num_similars(msg_inst)
+
+        self._trace.add_payload(func_hash=func_hash,\
+                func_sig=msg_inst.get_field('func_sig'),\
+                num_similars=num_similars)
+
+        # The signature is given by the client, so it is a part of the key:
+        func_sig = msg_inst.get_field('func_sig')
+        with self._trace.span('db'):
+            sims = yield from self._get_similars(\
+                    (func_hash,tuple(func_sig),num_similars),\
+                    self._fdb.get_similars_by_signature,\
+                    func_hash,func_sig,num_similars)
+
+        yield from self._send_similars(sims)
+
+
+    @asyncio.coroutine
+    def _handle_end_func_data(self):
+        """
+        Handle an EndFuncData message. Finish the current chunked transfer.
+        """
+        chunked = self._chunked
+        self._chunked = None
+        begin_msg = chunked.begin_msg
+
+        self._trace.add_payload(begin_msg=begin_msg.msg_name,\
+                data_len=chunked.data_len)
+
+        try:
+            with self._trace.span('sign'):
+                func_hash,func_sig = chunked.digest()
+        except Catalog1Error:
+            # Function data is too short to be signed:
+            func_hash,func_sig = None,None
+
+        if begin_msg.msg_name == 'BeginAddFunction':
+            if func_sig is None:
+                # Nothing to add:
+                return
+            with self._trace.span('db'):
+                self._fdb.add_signature(\
+                        begin_msg.get_field('func_name'),\
+                        func_hash,func_sig,\
+                        begin_msg.get_field('func_comment'))
+
+        elif begin_msg.msg_name == 'BeginRequestSimilars':
+            sims = Similars()
+            if func_sig is not None:
+                num_similars = self._cap_num_similars(begin_msg)
+                # The signature was computed here from the function data, so
+                # the query is the same as a RequestSimilars one:
+                with self._trace.span('db'):
+                    sims = yield from self._get_similars(\
+                            (func_hash,num_similars),\
+                            self._fdb.get_similars_by_signature,\
+                            func_hash,func_sig,num_similars)
+            yield from self._send_similars(sims)
+
+        else:
+            # This should never happen:
+            raise ServerLogicError('Unknown chunked transfer {}'.\
+                    format(begin_msg.msg_name))
+
+
+    @asyncio.coroutine
+    def _get_similars(self,key,query,*args):
+        """
+        Run a similarity query: query(*args), where query is a method of the
+        FuncsDB. key identifies the query within the database. Identical
+        queries share their results using the query cache (If there is one).
+        The limits, the minimum grade and the query hashes of the connection
+        are passed to the query.
+        """
+        deadline = None
+        if self._deadline_ms is not None:
+            deadline = time.monotonic() + self._deadline_ms / 1000
+        key += (self._max_candidates,self._deadline_ms,self._min_grade,\
+                self._query_hashes)
+        query = functools.partial(query,max_candidates=self._max_candidates,\
+                deadline=deadline,min_grade=self._min_grade,\
+                coarse_hashes=self._query_hashes)
+
+        if self._query_cache is None:
+            return (yield from self._run_query(query,*args))
+
+        generation = self._fdb.generation()
+        if generation is None:
+            return (yield from self._run_query(query,*args))
+
+        # Without limits of the client, only the hot value caps make a result
+        # approximate, and they give the same result for the same generation:
+        keep_approximate = self._max_candidates is None and \
+                self._deadline_ms is None
+        return (yield from self._query_cache.get((self._db_name,) + key,\
+                generation,lambda: self._run_query(query,*args),\
+                keep_approximate))
+
+
+    @asyncio.coroutine
+    def _run_query(self,query,*args):
+        """
+        Call query(*args) using the query executor (If there is one).
+        """
+        if self._query_executor is None:
+            return query(*args)
+
+        loop = asyncio.get_event_loop()
+        # The profile of the event loop thread does not see the query threads:
+        fut = loop.run_in_executor(self._query_executor,\
+                run_profiled_in_thread,self._db_name,query,*args)
+        try:
+            return (yield from asyncio.shield(fut,loop=loop))
+        except asyncio.CancelledError:
+            # The database may only be closed after the query is done:
+            yield from asyncio.wait([fut],loop=loop)
+            raise
+
+
+    def _build_hash_filter(self):
+        """
+        Start building the strong hash filter of the database using the query
+        executor (Or the default executor of the loop), if it is needed. (See
+        FuncsDB.build_hash_filter). Until it is built, added functions are
+        looked up.
+        """
+        if not self._fdb.needs_hash_filter():
+            return
+        loop = asyncio.get_event_loop()
+        loop.run_in_executor(self._query_executor,self._fdb.build_hash_filter)
+
+
+    @asyncio.coroutine
+    def _send_similars(self,sims):
+        """
+        Send a ResponseSimilars message, given a list of similars from the db
+        (A ResponseSimilarsApprox message if the connection has query
+        limits).
+        """
         # We convert the sims we have received from the db to another format:
         res_sims = []
         for s in sims:
@@ -149,9 +691,15 @@ class FCatalogServerLogic:
             res_sims.append(fs)
         
         # Build a ResponseSimilars message:
-        resp_msg = cser_serializer.get_msg('ResponseSimilars')
+        if self._bounded:
+            resp_msg = cser_serializer.get_msg('ResponseSimilarsApprox')
+            resp_msg.set_field('approximate',\
+                    int(getattr(sims,'approximate',False)))
+        else:
+            resp_msg = cser_serializer.get_msg('ResponseSimilars')
         resp_msg.set_field('similars',res_sims)
 
         # Send back the Response similars message:
-        yield from self._msg_endpoint.send(resp_msg)
+        with self._trace.span('send'):
+            yield from self._msg_endpoint.send(resp_msg)
 
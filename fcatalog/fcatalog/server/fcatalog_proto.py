@@ -1,6 +1,6 @@
 import collections
 from fcatalog.proto.serializer import s_string,d_string,\
-        s_blob,d_blob,s_uint32,d_uint32,\
+        s_blob,d_blob,s_uint32,d_uint32,s_uint32_list,d_uint32_list,\
         Serializer,ProtoDef,MsgDef
 
 
@@ -80,58 +80,422 @@ class RequestSimilars(MsgDef):
         return msg_inst
 
 
+def s_similars(sims) -> bytes:
+    """
+    Serialize a list of FSimilar.
+    """
+    resl = []
+    resl.append(s_uint32(len(sims)))
+
+    for sim in sims:
+        resl.append(s_string(sim.name))
+        resl.append(s_string(sim.comment))
+        resl.append(s_uint32(sim.sim_grade))
+
+    return b''.join(resl)
+
+
+def d_similars(msg_data:bytes):
+    """
+    Deserialize a list of FSimilar.
+    Returns the amount of bytes read and the list.
+    """
+    # Read the amount of similars:
+    nl,num_sims = d_uint32(msg_data)
+    total = nl
+    msg_data = msg_data[nl:]
+
+    sims = []
+    for _ in range(num_sims):
+        nl,sim_name = d_string(msg_data)
+        msg_data = msg_data[nl:]
+        total += nl
+        nl,sim_comment = d_string(msg_data)
+        msg_data = msg_data[nl:]
+        total += nl
+        nl,sim_grade = d_uint32(msg_data)
+        msg_data = msg_data[nl:]
+        total += nl
+
+        sims.append(FSimilar(\
+                name=sim_name,\
+                comment=sim_comment,\
+                sim_grade=sim_grade\
+                ))
+
+    return total,sims
+
+
 class ResponseSimilars(MsgDef):
     afields = ['similars']
     def serialize(self,msg_inst) -> bytes:
         """
         Serialize a msg_inst into bytes.
         """
-        sims = msg_inst.get_field('similars')
+        return s_similars(msg_inst.get_field('similars'))
+
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,sims = d_similars(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('similars',sims)
+        return msg_inst
+
+
+class RequestCompression(MsgDef):
+    afields = []
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return b''
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        return self.get_msg()
+
+
+class ResponseCompression(MsgDef):
+    afields = ['accepted']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_uint32(msg_inst.get_field('accepted'))
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,accepted = d_uint32(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('accepted',accepted)
+        return msg_inst
+
+
+# Chunked transfer of function data:
+# Functions whose data does not fit inside one frame are sent as a sequence of
+# messages: BeginAddFunction or BeginRequestSimilars, then any amount of
+# FuncDataChunk messages, and finally EndFuncData.
+
+class BeginAddFunction(MsgDef):
+    afields = ['func_name','func_comment']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
         resl = []
-        resl.append(s_uint32(len(sims)))
-        
-        for sim in sims:
-            resl.append(s_string(sim.name))
-            resl.append(s_string(sim.comment))
-            resl.append(s_uint32(sim.sim_grade))
+        resl.append(s_string(msg_inst.get_field('func_name')))
+        resl.append(s_string(msg_inst.get_field('func_comment')))
+        return b''.join(resl)
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,func_name = d_string(msg_data)
+        msg_data = msg_data[nl:]
+        nl,func_comment = d_string(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('func_name',func_name)
+        msg_inst.set_field('func_comment',func_comment)
+        return msg_inst
+
+
+class BeginRequestSimilars(MsgDef):
+    afields = ['num_similars']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_uint32(msg_inst.get_field('num_similars'))
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,num_similars = d_uint32(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('num_similars',num_similars)
+        return msg_inst
+
+
+class FuncDataChunk(MsgDef):
+    afields = ['data_chunk']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_blob(msg_inst.get_field('data_chunk'))
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,data_chunk = d_blob(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('data_chunk',data_chunk)
+        return msg_inst
+
+
+class EndFuncData(MsgDef):
+    afields = []
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return b''
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        return self.get_msg()
+
+
+# Signed messages:
+# The client calculates the strong hash (sha256) and the catalog1 signature of
+# the function data by itself, and sends them instead of the function data.
+# The server might challenge the client to send the data of some sampled
+# AddFunctionSigned messages (ChallengeFuncData), to verify the signature.
 
+class AddFunctionSigned(MsgDef):
+    afields = ['func_name','func_comment','func_hash','func_sig']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        resl = []
+        resl.append(s_string(msg_inst.get_field('func_name')))
+        resl.append(s_string(msg_inst.get_field('func_comment')))
+        resl.append(s_blob(msg_inst.get_field('func_hash')))
+        resl.append(s_uint32_list(msg_inst.get_field('func_sig')))
         return b''.join(resl)
 
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,func_name = d_string(msg_data)
+        msg_data = msg_data[nl:]
+        nl,func_comment = d_string(msg_data)
+        msg_data = msg_data[nl:]
+        nl,func_hash = d_blob(msg_data)
+        msg_data = msg_data[nl:]
+        nl,func_sig = d_uint32_list(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('func_name',func_name)
+        msg_inst.set_field('func_comment',func_comment)
+        msg_inst.set_field('func_hash',func_hash)
+        msg_inst.set_field('func_sig',func_sig)
+        return msg_inst
+
+
+class RequestSimilarsSigned(MsgDef):
+    afields = ['func_hash','func_sig','num_similars']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        resl = []
+        resl.append(s_blob(msg_inst.get_field('func_hash')))
+        resl.append(s_uint32_list(msg_inst.get_field('func_sig')))
+        resl.append(s_uint32(msg_inst.get_field('num_similars')))
+        return b''.join(resl)
 
     def deserialize(self,msg_data:bytes):
         """
         Deserialize data bytes into a msg_inst.
         """
-        # Read the amount of similars:
-        nl,num_sims = d_uint32(msg_data)
+        nl,func_hash = d_blob(msg_data)
         msg_data = msg_data[nl:]
+        nl,func_sig = d_uint32_list(msg_data)
+        msg_data = msg_data[nl:]
+        nl,num_similars = d_uint32(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('func_hash',func_hash)
+        msg_inst.set_field('func_sig',func_sig)
+        msg_inst.set_field('num_similars',num_similars)
+        return msg_inst
+
 
-        sims = []
-        for _ in range(num_sims):
-            nl,sim_name = d_string(msg_data)
-            msg_data = msg_data[nl:]
-            nl,sim_comment = d_string(msg_data)
-            msg_data = msg_data[nl:]
-            nl,sim_grade = d_uint32(msg_data)
-            msg_data = msg_data[nl:]
+class ChallengeFuncData(MsgDef):
+    afields = ['func_hash']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_blob(msg_inst.get_field('func_hash'))
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,func_hash = d_blob(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('func_hash',func_hash)
+        return msg_inst
+
+
+class ChallengeResponse(MsgDef):
+    afields = ['func_data']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_blob(msg_inst.get_field('func_data'))
 
-            sims.append(FSimilar(\
-                    name=sim_name,\
-                    comment=sim_comment,\
-                    sim_grade=sim_grade\
-                    ))
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,func_data = d_blob(msg_data)
 
         msg_inst = self.get_msg()
+        msg_inst.set_field('func_data',func_data)
+        return msg_inst
+
+
+# Bounded queries:
+# A client may send SetQueryLimits (Any time after ChooseDB). Later queries on
+# the connection take at most max_candidates candidates for every signature
+# value, and stop after deadline_ms milliseconds (0 means no limit). Their
+# results are sent as ResponseSimilarsApprox, where approximate is 1 if a limit
+# was hit, so more similar functions might exist.
+
+class SetQueryLimits(MsgDef):
+    afields = ['max_candidates','deadline_ms']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        resl = []
+        resl.append(s_uint32(msg_inst.get_field('max_candidates')))
+        resl.append(s_uint32(msg_inst.get_field('deadline_ms')))
+        return b''.join(resl)
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,max_candidates = d_uint32(msg_data)
+        msg_data = msg_data[nl:]
+        nl,deadline_ms = d_uint32(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('max_candidates',max_candidates)
+        msg_inst.set_field('deadline_ms',deadline_ms)
+        return msg_inst
+
+
+class ResponseSimilarsApprox(MsgDef):
+    afields = ['approximate','similars']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        resl = []
+        resl.append(s_uint32(msg_inst.get_field('approximate')))
+        resl.append(s_similars(msg_inst.get_field('similars')))
+        return b''.join(resl)
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,approximate = d_uint32(msg_data)
+        msg_data = msg_data[nl:]
+        nl,sims = d_similars(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('approximate',approximate)
         msg_inst.set_field('similars',sims)
         return msg_inst
 
 
+# Minimum grade:
+# A client may send SetMinGrade (Any time after ChooseDB). Later queries on the
+# connection only return functions with a grade of at least min_grade (0 means
+# no minimum), which lets the server search fewer candidates.
+
+class SetMinGrade(MsgDef):
+    afields = ['min_grade']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_uint32(msg_inst.get_field('min_grade'))
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,min_grade = d_uint32(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('min_grade',min_grade)
+        return msg_inst
+
+
+# Coarse queries:
+# A client may send SetQueryHashes (Any time after ChooseDB). Later queries on
+# the connection search and rank their candidates using only the first
+# num_hashes values of the signature, and refine the grades of the best
+# candidates over the whole signature (0 means the whole signature).
+
+class SetQueryHashes(MsgDef):
+    afields = ['num_hashes']
+    def serialize(self,msg_inst) -> bytes:
+        """
+        Serialize a msg_inst into bytes.
+        """
+        return s_uint32(msg_inst.get_field('num_hashes'))
+
+    def deserialize(self,msg_data:bytes):
+        """
+        Deserialize data bytes into a msg_inst.
+        """
+        nl,num_hashes = d_uint32(msg_data)
+
+        msg_inst = self.get_msg()
+        msg_inst.set_field('num_hashes',num_hashes)
+        return msg_inst
+
+
 class FCatalogProtoDef(ProtoDef):
     incoming_msgs = {\
         0:ChooseDB,\
         1:AddFunction,\
-        2:RequestSimilars}
-    outgoing_msgs = {3:ResponseSimilars}
+        2:RequestSimilars,\
+        4:RequestCompression,\
+        6:BeginAddFunction,\
+        7:BeginRequestSimilars,\
+        8:FuncDataChunk,\
+        9:EndFuncData,\
+        10:AddFunctionSigned,\
+        11:RequestSimilarsSigned,\
+        13:ChallengeResponse,\
+        14:SetQueryLimits,\
+        16:SetMinGrade,\
+        17:SetQueryHashes}
+    outgoing_msgs = {\
+        3:ResponseSimilars,\
+        5:ResponseCompression,\
+        12:ChallengeFuncData,\
+        15:ResponseSimilarsApprox}
 
 
 
@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import asyncio
+import logging
+
+from fcatalog.funcs_db import FuncsDB,FuncsDBError,DEFAULT_TUNING_PROFILE
+
+# Background maintenance of databases:
+# Every server process keeps the time of the last message of every database
+# it served since that database was last maintained. Every check_period
+# seconds, one such database that got no message for the last idle_time
+# seconds is maintained (See FuncsDB.maintain). Maintenance runs in a thread,
+# so that the event loop keeps serving other connections meanwhile.
+#
+# A database is maintained at most once every interval seconds, by any of
+# the server processes that share it. (The time of the last maintenance is
+# kept inside the database).
+
+# Default minimum time between maintenance runs of one database, in seconds:
+MAINTENANCE_INTERVAL = 3600.0
+
+# Default time without messages after which a database may be maintained, in
+# seconds:
+MAINTENANCE_IDLE_TIME = 30.0
+
+# Default time between checks for databases to maintain, in seconds:
+MAINTENANCE_CHECK_PERIOD = 10.0
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    def __init__(self,db_base_path,num_hashes,interval=MAINTENANCE_INTERVAL,\
+            idle_time=MAINTENANCE_IDLE_TIME,\
+            check_period=MAINTENANCE_CHECK_PERIOD,executor=None,\
+            tuning_profile=DEFAULT_TUNING_PROFILE,db_tuning_profiles=None,\
+            loop=None):
+        """
+        Maintain the databases in db_base_path that are used by this server
+        process. executor (concurrent.futures) runs the maintenance (The
+        default executor of the loop if None). Databases are opened with
+        their tuning profiles (See FuncsDB).
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._db_base_path = db_base_path
+        self._num_hashes = num_hashes
+        self._interval = interval
+        self._idle_time = idle_time
+        self._check_period = check_period
+        self._executor = executor
+        self._tuning_profile = tuning_profile
+        self._db_tuning_profiles = db_tuning_profiles or {}
+
+        # Time of the last message of every database that was used since it
+        # was maintained, by name:
+        self._last_used = {}
+        # Time of the last maintenance of every database by this process:
+        self._last_maintained = {}
+        self._task = None
+
+    def db_used(self,db_name):
+        """
+        A message of a connection to the database db_name was handled.
+        """
+        self._last_used[db_name] = self._loop.time()
+
+    def _due_db(self):
+        """
+        Get the name of a database that should be maintained now (The one
+        that is idle for the longest time), or None.
+        """
+        now = self._loop.time()
+        for db_name,last_used in sorted(self._last_used.items(),\
+                key=lambda item: item[1]):
+            if now - last_used < self._idle_time:
+                break
+            last_maintained = self._last_maintained.get(db_name)
+            if last_maintained is not None and \
+                    now - last_maintained < self._interval:
+                continue
+            return db_name
+        return None
+
+    @asyncio.coroutine
+    def maintain_once(self):
+        """
+        Maintain one database that should be maintained now, if there is one.
+        Returns (db_name,results), where results are the results of
+        FuncsDB.maintain, or None if no database was maintained.
+        """
+        db_name = self._due_db()
+        if db_name is None:
+            return None
+        del self._last_used[db_name]
+        self._last_maintained[db_name] = self._loop.time()
+
+        fut = self._loop.run_in_executor(self._executor,\
+                self._maintain_db,db_name)
+        try:
+            results = yield from asyncio.shield(fut,loop=self._loop)
+        except asyncio.CancelledError:
+            # The thread can not be stopped. Wait for it:
+            yield from asyncio.wait([fut],loop=self._loop)
+            raise
+        return db_name,results
+
+    def _maintain_db(self,db_name):
+        """
+        Maintain one database. (Runs in a thread of the executor).
+        """
+        db_path = os.path.join(self._db_base_path,db_name)
+        if not os.path.isfile(db_path):
+            return None
+        try:
+            fdb = FuncsDB(db_path,self._num_hashes,\
+                    tuning_profile=self._db_tuning_profiles.get(db_name,\
+                    self._tuning_profile))
+        except (FuncsDBError,sqlite3.Error) as e:
+            logger.warning('Could not open database %s for maintenance: %s',\
+                    db_name,e)
+            return None
+        try:
+            return fdb.maintain(min_interval=self._interval)
+        finally:
+            fdb.close()
+
+    @asyncio.coroutine
+    def _run(self):
+        while True:
+            yield from asyncio.sleep(self._check_period,loop=self._loop)
+            try:
+                res = yield from self.maintain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Database maintenance failed')
+                continue
+            if res is not None and res[1] is not None:
+                logger.info('Maintained database %s: %s',*res)
+
+    def start(self):
+        """
+        Start maintaining databases in the background.
+        """
+        self._task = self._loop.create_task(self._run())
+
+    @asyncio.coroutine
+    def stop(self):
+        """
+        Stop maintaining databases. Waits for a running maintenance to
+        finish.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        yield from asyncio.wait([self._task],loop=self._loop)
+        self._task = None
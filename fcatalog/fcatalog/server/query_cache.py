@@ -0,0 +1,123 @@
+import asyncio
+import collections
+
+from fcatalog.metrics import QUERY_CACHE_REQUESTS
+
+# Coalescing of similarity queries:
+# When a new sample circulates, many clients query the same functions within
+# seconds. Identical queries share one computation while it runs
+# (single-flight), and its result is kept for a short while.
+#
+# A result is only valid for the database state it was computed on. Every
+# database has a write generation (See FuncsDB.generation), bumped by every
+# commit that wrote functions. Results are kept together with their
+# generation, and a result of another generation is never returned. The
+# generation is kept inside the database, so writes of other server processes
+# invalidate results as well.
+#
+# Approximate results (Of queries that hit their limits, see
+# FuncsDB.get_similars_by_signature) are shared with identical queries that
+# are already waiting. They are kept only if the caller says so: A result
+# that was only cut by the hot value caps is the same for every query of the
+# same generation, but a result cut by a deadline depends on the load of the
+# server.
+
+# Default maximum amount of cached results:
+QUERY_CACHE_SIZE = 0x1000
+
+# Default time a result is kept, in seconds:
+QUERY_CACHE_TTL = 10.0
+
+# A cached result:
+_Entry = collections.namedtuple('_Entry',['generation','expiry','result'])
+
+
+class QueryCache:
+    def __init__(self,max_entries=QUERY_CACHE_SIZE,ttl=QUERY_CACHE_TTL,\
+            loop=None):
+        """
+        Keep at most max_entries results, each for ttl seconds.
+        The cache is shared by all the connections of one server process.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._max_entries = max_entries
+        self._ttl = ttl
+        # Cached results by key, least recently used first:
+        self._results = collections.OrderedDict()
+        # Futures of running computations, by (key,generation):
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._results)
+
+    def _lookup(self,key,generation):
+        """
+        Get a valid cached result, or None.
+        """
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry.generation != generation or \
+                entry.expiry <= self._loop.time():
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return entry.result
+
+    def _store(self,key,generation,result):
+        if self._max_entries <= 0:
+            return
+        self._results.pop(key,None)
+        self._results[key] = _Entry(generation=generation,\
+                expiry=self._loop.time() + self._ttl,result=result)
+        while len(self._results) > self._max_entries:
+            self._results.popitem(last=False)
+
+    @asyncio.coroutine
+    def get(self,key,generation,compute,keep_approximate=False):
+        """
+        Get the result of a query. key identifies the query (Including its
+        database), and generation is the current write generation of the
+        database.
+        If no valid result is cached and no identical query is running,
+        compute() (A coroutine function) is called to compute the result.
+        Results that are None are not cached. Approximate results are only
+        cached if keep_approximate is True. A result may be returned to a few
+        callers, so it must not be modified.
+        """
+        result = self._lookup(key,generation)
+        if result is not None:
+            QUERY_CACHE_REQUESTS.labels('hit').inc()
+            return result
+
+        inflight_key = (key,generation)
+        fut = self._inflight.get(inflight_key)
+        if fut is not None:
+            QUERY_CACHE_REQUESTS.labels('shared').inc()
+            # Cancelling one waiter should not cancel the computation:
+            return (yield from asyncio.shield(fut,loop=self._loop))
+
+        QUERY_CACHE_REQUESTS.labels('miss').inc()
+        fut = asyncio.Future(loop=self._loop)
+        self._inflight[inflight_key] = fut
+        try:
+            result = yield from compute()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # The exception is raised here. Waiters (If any) get it too:
+            fut.exception()
+            raise
+        finally:
+            del self._inflight[inflight_key]
+
+        fut.set_result(result)
+        if result is None:
+            return result
+        if keep_approximate or not getattr(result,'approximate',False):
+            self._store(key,generation,result)
+        return result
@@ -0,0 +1,169 @@
+import time
+import queue
+import random
+import logging
+import logging.handlers
+
+# Sampled per-request tracing:
+# A Tracer samples a fraction of the handled messages. A sampled message gets
+# a Trace that records the duration of every stage of its handling (Spans),
+# and writes one log record when the message was handled. Messages that were
+# not sampled get a NullTrace, which does nothing.
+#
+# Message payloads (For example function data) are only logged if explicitly
+# enabled, and are formatted only when the trace is written.
+
+# Logger for traces:
+trace_logger = logging.getLogger('fcatalog.trace')
+
+# Random source for sampling:
+trace_random = random.Random()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        pass
+
+
+class NullTrace:
+    """
+    The trace of a message that was not sampled.
+    """
+    _null_span = _NullSpan()
+
+    def span(self,stage):
+        return self._null_span
+
+    def add_payload(self,**fields):
+        pass
+
+    def finish(self):
+        pass
+
+NULL_TRACE = NullTrace()
+
+
+class _Span:
+    def __init__(self,trace,stage):
+        self._trace = trace
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self._trace.spans.append(\
+                (self._stage,time.perf_counter() - self._start))
+
+
+class Trace:
+    """
+    The trace of one sampled message.
+    """
+    def __init__(self,msg_name,conn_id,log_payloads):
+        self.msg_name = msg_name
+        self.conn_id = conn_id
+        self._log_payloads = log_payloads
+        self._start = time.perf_counter()
+        # List of (stage,duration):
+        self.spans = []
+        self.payload = {}
+
+    def span(self,stage):
+        """
+        A context manager that records the duration of a stage.
+        """
+        return _Span(self,stage)
+
+    def add_payload(self,**fields):
+        """
+        Attach payload fields of the message. They are logged only if
+        payload logging is enabled.
+        """
+        if self._log_payloads:
+            self.payload.update(fields)
+
+    def finish(self):
+        """
+        Write the trace to the log.
+        """
+        total = time.perf_counter() - self._start
+        spans = ' '.join('{}={:.6f}'.format(stage,duration) \
+                for stage,duration in self.spans)
+        if self._log_payloads:
+            trace_logger.info('conn=%s msg=%s total=%.6f %s payload=%r',\
+                    self.conn_id,self.msg_name,total,spans,self.payload)
+        else:
+            trace_logger.info('conn=%s msg=%s total=%.6f %s',\
+                    self.conn_id,self.msg_name,total,spans)
+
+
+class Tracer:
+    def __init__(self,sample_rate=0.0,log_payloads=False):
+        """
+        sample_rate is the fraction of messages to trace (0 disables
+        tracing). If log_payloads is True, traces include message payloads.
+        """
+        self._sample_rate = sample_rate
+        self._log_payloads = log_payloads
+
+    def start(self,msg_name,conn_id):
+        """
+        Start the trace of one message. Returns a Trace if the message was
+        sampled, or NULL_TRACE otherwise.
+        """
+        if self._sample_rate <= 0.0 or \
+                trace_random.random() >= self._sample_rate:
+            return NULL_TRACE
+        if not trace_logger.isEnabledFor(logging.INFO):
+            return NULL_TRACE
+        return Trace(msg_name,conn_id,self._log_payloads)
+
+
+class _LogListener(logging.handlers.QueueListener):
+    """
+    A QueueListener that respects the levels of its handlers. (Like
+    respect_handler_level=True, which only exists since Python 3.5).
+    """
+    def handle(self,record):
+        record = self.prepare(record)
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def start_log_listener():
+    """
+    Move the handlers of the root logger to a background thread: Log records
+    are put into a queue by a QueueHandler, and handled by a QueueListener
+    thread, so that the event loop never blocks on writing logs.
+    Returns the listener, to be given to stop_log_listener().
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.Queue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = _LogListener(log_queue,*handlers)
+    listener.start()
+    return listener
+
+
+def stop_log_listener(listener):
+    """
+    Handle the remaining log records, and give the handlers back to the root
+    logger.
+    """
+    listener.stop()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler,logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+
+# Running the server as a few worker processes:
+# A supervisor process forks the workers, restarts workers that have crashed,
+# and forwards termination signals to the workers.
+# The workers either bind their own listening sockets to the same port (Using
+# SO_REUSEPORT, which lets the kernel balance connections between them), or
+# share one listening socket inherited from the supervisor.
+
+class WorkersError(Exception): pass
+
+# Set up logger:
+logger = logging.getLogger(__name__)
+
+# Is SO_REUSEPORT supported on this platform:
+HAS_REUSEPORT = hasattr(socket,'SO_REUSEPORT')
+
+# Backlog of a listening socket:
+LISTEN_BACKLOG = 100
+
+# A worker that has crashed after running less than this amount of seconds is
+# restarted only after RESTART_DELAY seconds. (Avoid a busy restart loop):
+MIN_WORKER_UPTIME = 1.0
+RESTART_DELAY = 1.0
+
+
+def create_listen_socket(host,port,reuse_port=False):
+    """
+    Create a non blocking listening TCP socket, bound to host:port.
+    If reuse_port is True, other sockets may bind to the same port (Using
+    SO_REUSEPORT).
+    """
+    infos = socket.getaddrinfo(host,port,type=socket.SOCK_STREAM,\
+            flags=socket.AI_PASSIVE)
+    if len(infos) == 0:
+        raise WorkersError('Can not resolve {}:{}'.format(host,port))
+    family,stype,proto,_,addr = infos[0]
+
+    sock = socket.socket(family,stype,proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        if reuse_port:
+            if not HAS_REUSEPORT:
+                raise WorkersError('SO_REUSEPORT is not supported')
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+        sock.bind(addr)
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
+    except:
+        sock.close()
+        raise
+
+    return sock
+
+
+class Supervisor:
+    def __init__(self,num_workers,worker_main):
+        """
+        worker_main is a function that is called with the worker index inside
+        every worker process. The worker process exits when it returns.
+        """
+        if num_workers < 1:
+            raise WorkersError('num_workers must be at least 1')
+        self._num_workers = num_workers
+        self._worker_main = worker_main
+
+        # Maps pid to (worker index,start time):
+        self._workers = {}
+        self._stopping = False
+
+
+    def _spawn(self,worker_idx):
+        """
+        Fork a new worker process.
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Child process:
+            exit_code = 0
+            try:
+                # Signals are handled by the worker itself:
+                signal.signal(signal.SIGTERM,signal.SIG_DFL)
+                signal.signal(signal.SIGINT,signal.SIG_DFL)
+                self._worker_main(worker_idx)
+            except:
+                logger.exception('Unhandled exception in worker {}'.\
+                        format(worker_idx))
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        self._workers[pid] = (worker_idx,time.monotonic())
+        logger.info('Started worker {} with pid {}'.format(worker_idx,pid))
+
+
+    def _forward_signal(self,signum,frame):
+        """
+        Stop restarting workers, and forward the signal to all the workers.
+        """
+        self._stopping = True
+        for pid in list(self._workers):
+            try:
+                os.kill(pid,signum)
+            except ProcessLookupError:
+                pass
+
+
+    def run(self):
+        """
+        Start the workers, and supervise them until they all exit after a
+        SIGTERM or SIGINT.
+        """
+        old_handlers = {}
+        for signum in (signal.SIGTERM,signal.SIGINT):
+            old_handlers[signum] = \
+                    signal.signal(signum,self._forward_signal)
+
+        try:
+            for worker_idx in range(self._num_workers):
+                self._spawn(worker_idx)
+
+            while self._workers:
+                try:
+                    pid,status = os.wait()
+                except InterruptedError:
+                    # Python < 3.5 does not retry after a signal:
+                    continue
+                except ChildProcessError:
+                    break
+
+                if pid not in self._workers:
+                    continue
+                worker_idx,start_time = self._workers.pop(pid)
+
+                if self._stopping:
+                    continue
+
+                logger.warning('Worker {} (pid {}) exited with status {}.'
+                        ' Restarting.'.format(worker_idx,pid,status))
+                if time.monotonic() - start_time < MIN_WORKER_UPTIME:
+                    time.sleep(RESTART_DELAY)
+                if not self._stopping:
+                    self._spawn(worker_idx)
+        finally:
+            for signum,handler in old_handlers.items():
+                signal.signal(signum,handler)
@@ -1,6 +1,104 @@
 # Base path for databases:
 DB_BASE_PATH = '/var/lib/fcatalog/'
 
-# Amount of hashes for signature:
+# Amount of hashes for signature. A longer signature (For example 64) ranks
+# results more precisely. Clients may still ask for quick queries that search
+# using only a prefix of the signature (SetQueryHashes). Databases can only be
+# opened with the amount of hashes they were created with:
 NUM_HASHES = 16
 
+# Fraction of AddFunctionSigned messages whose signature is verified by
+# challenging the client to send the function data (0 disables checks):
+SPOT_CHECK_RATE = 0.0
+
+# Answer similarity queries using a signature index file kept beside every
+# database. The index is memory mapped, so all the worker processes share one
+# copy of it:
+USE_SIG_INDEX = False
+
+# Identical similarity queries on the same database share one computation, and
+# their results are reused for QUERY_CACHE_TTL seconds, until the database is
+# written to. At most QUERY_CACHE_SIZE results are kept by every worker
+# process (0 disables the cache):
+QUERY_CACHE_SIZE = 0x1000
+QUERY_CACHE_TTL = 10.0
+
+# Amount of threads running similarity queries, so that the event loop keeps
+# serving other connections while a query runs (0 runs queries on the event
+# loop):
+QUERY_THREADS = 4
+
+# SQLite tuning profile of the databases: 'small', 'large' (Many GB, mostly
+# read, on a server with plenty of RAM) or 'bulk' (See Tuning profiles in
+# fcatalog.funcs_db). DB_TUNING_PROFILES overrides it for some databases, by
+# database name. For example: {'big_catalog': 'large'}
+TUNING_PROFILE = 'small'
+DB_TUNING_PROFILES = {}
+
+# Databases are maintained in the background (Statistics for the query
+# planner, returning free pages to the file system and WAL checkpoints). A
+# database is maintained at most once every MAINTENANCE_INTERVAL seconds, after
+# it got no messages for MAINTENANCE_IDLE_TIME seconds (None disables
+# maintenance):
+MAINTENANCE_INTERVAL = 3600.0
+MAINTENANCE_IDLE_TIME = 30.0
+
+# Signature values that appear in more than HOT_VALUE_THRESHOLD functions of a
+# database are hot: A query takes at most HOT_VALUE_CAP candidates for each hot
+# value of its signature (None disables the limit):
+HOT_VALUE_THRESHOLD = 0x2000
+HOT_VALUE_CAP = 0x100
+
+# Maximum amount of connections served at the same time (Every served
+# connection holds a database handle):
+MAX_CONNECTIONS = 0x100
+# Connections beyond MAX_CONNECTIONS wait for a free slot. At most this amount
+# of connections may wait, for at most CONNECTION_QUEUE_TIMEOUT seconds.
+# Other connections are closed:
+MAX_QUEUED_CONNECTIONS = 0x100
+CONNECTION_QUEUE_TIMEOUT = 10.0
+
+# A connection is closed if no message arrives for IDLE_TIMEOUT seconds, if a
+# started message does not fully arrive within READ_TIMEOUT seconds, or if the
+# client does not read our messages for WRITE_TIMEOUT seconds:
+IDLE_TIMEOUT = 600.0
+READ_TIMEOUT = 30.0
+WRITE_TIMEOUT = 30.0
+
+# High-water mark (In bytes) of the write buffer of a connection:
+WRITE_BUFFER_LIMIT = 0x40000
+
+# Maximum amount of received requests of one connection waiting to be handled.
+# Reading from the connection is paused beyond this amount:
+MAX_INFLIGHT_REQUESTS = 0x40
+
+# Maximum amount of similars returned for one query:
+MAX_SIMILARS = 0x100
+
+# Metrics are served in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics (None disables the metrics server).
+# When running a few worker processes, worker i serves its metrics at port
+# METRICS_PORT + i:
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9337
+
+# Fraction of handled messages to trace. A trace logs the duration of every
+# stage of handling a message (0 disables tracing):
+TRACE_SAMPLE_RATE = 0.0
+# Include message payloads (Function names, data and signatures) in traces:
+TRACE_PAYLOADS = False
+
+# Path of the admin Unix socket, used for profiling a running server (None
+# disables it). {} is replaced by the worker index:
+ADMIN_SOCKET_PATH = '/home/ufcatalog/run/admin.{}.sock'
+# Directory for profiling output (.pstats files and tracemalloc snapshots):
+PROFILE_DIR = '/home/ufcatalog/profiles'
+
+# Path of a traffic capture log, for replaying the received messages with
+# fcatalog-replay (None disables capturing). {} is replaced by the worker
+# index. For example: '/home/ufcatalog/capture/capture.{}.bin'
+CAPTURE_PATH = None
+# Fraction of the connections that are captured:
+CAPTURE_SAMPLE_RATE = 1.0
+# Maximum size of a capture log, in bytes. Capturing stops when it is reached:
+CAPTURE_MAX_BYTES = 0x40000000
@@ -0,0 +1,267 @@
+import os
+import mmap
+import fcntl
+import struct
+import collections
+
+# A signature index kept in a memory mapped file beside a functions database.
+# All the server processes map the same file, so there is one copy of the
+# index in memory no matter how many processes serve queries.
+#
+# The index holds the catalog1 signature and the database rowid of every
+# inserted function. Rows are only appended. A single writer (Serialized by a
+# lock on the file) appends rows and then publishes them by incrementing the
+# generation counter in the header. Readers scan the rows below the
+# generation counter directly inside the mapping, without copying.
+#
+# File layout:
+#   Header (HEADER_LEN bytes):
+#       magic, num_hashes (uint32), block_rows (uint32),
+#       generation (uint64, the amount of published rows),
+#       last_rowid (int64, the largest rowid appended so far).
+#   Blocks of block_rows rows each:
+#       rowids (int64 * block_rows),
+#       column 1 (uint32 * block_rows), ... column num_hashes.
+#
+# Keeping every signature column packed lets a reader find all the rows that
+# match one signature value using a single search over the column.
+
+class SigIndexError(Exception): pass
+
+MAGIC = b'FCSIGIX1'
+
+# Header structure:
+HEADER_FMT = '<8sIIQq'
+HEADER_LEN = 0x40
+GENERATION_OFFSET = 0x10
+LAST_ROWID_OFFSET = 0x18
+
+ROWID_FMT = '<q'
+ROWID_LEN = 8
+VALUE_FMT = '<I'
+VALUE_LEN = 4
+
+# Amount of rows in one block:
+BLOCK_ROWS = 0x4000
+
+# File extension of an index beside a database file:
+SIG_INDEX_SUFFIX = '.sigidx'
+
+
+class SigIndex:
+    def __init__(self,index_path,num_hashes,block_rows=BLOCK_ROWS):
+        """
+        Open (Or create) the signature index at index_path.
+        """
+        self._index_path = index_path
+        self._num_hashes = num_hashes
+
+        self._fd = os.open(index_path,os.O_RDWR | os.O_CREAT,0o644)
+        self._mm = None
+        try:
+            with self._locked():
+                if os.fstat(self._fd).st_size == 0:
+                    # A new index:
+                    header = struct.pack(HEADER_FMT,MAGIC,num_hashes,\
+                            block_rows,0,0)
+                    os.write(self._fd,header.ljust(HEADER_LEN,b'\x00'))
+
+                header = os.pread(self._fd,HEADER_LEN,0)
+                magic,idx_num_hashes,idx_block_rows,_,_ = \
+                        struct.unpack_from(HEADER_FMT,header)
+
+            if magic != MAGIC:
+                raise SigIndexError('{} is not a signature index'.\
+                        format(index_path))
+            if idx_num_hashes != num_hashes:
+                raise SigIndexError('Index num_hashes {} does not match {}'.\
+                        format(idx_num_hashes,num_hashes))
+        except:
+            os.close(self._fd)
+            raise
+
+        self._block_rows = idx_block_rows
+        self._block_len = idx_block_rows * \
+                (ROWID_LEN + (num_hashes * VALUE_LEN))
+
+        self._remap()
+        self._is_open = True
+
+
+    def _locked(self):
+        """
+        A context manager holding the writer lock of the index.
+        """
+        return _FileLock(self._fd)
+
+
+    def _remap(self):
+        """
+        Map the whole index file.
+        (The file grows when other processes append rows).
+        """
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = mmap.mmap(self._fd,0)
+
+
+    def _check_is_open(self):
+        if not self._is_open:
+            raise SigIndexError('SigIndex instance is closed')
+
+
+    def close(self):
+        """
+        Unmap and close the index file.
+        """
+        self._check_is_open()
+        self._is_open = False
+        self._mm.close()
+        os.close(self._fd)
+
+
+    @property
+    def generation(self):
+        """
+        Amount of published rows.
+        """
+        return struct.unpack_from('<Q',self._mm,GENERATION_OFFSET)[0]
+
+
+    @property
+    def last_rowid(self):
+        """
+        The largest rowid appended to the index.
+        """
+        return struct.unpack_from('<q',self._mm,LAST_ROWID_OFFSET)[0]
+
+
+    def _rowids_offset(self,block):
+        return HEADER_LEN + (block * self._block_len)
+
+
+    def _column_offset(self,block,col):
+        return self._rowids_offset(block) + (self._block_rows * ROWID_LEN) + \
+                (col * self._block_rows * VALUE_LEN)
+
+
+    def _ensure_mapped(self,end_offset):
+        """
+        Make sure that the mapping reaches end_offset.
+        """
+        if len(self._mm) < end_offset:
+            self._remap()
+
+
+    def append(self,rows):
+        """
+        Append rows to the index, and publish them.
+        rows is an iterable of (rowid,func_sig) pairs.
+        """
+        self._check_is_open()
+        rows = list(rows)
+        if len(rows) == 0:
+            return
+
+        for rowid,func_sig in rows:
+            if len(func_sig) != self._num_hashes:
+                raise SigIndexError('Signature length {} does not match'
+                    ' num_hashes {}'.format(len(func_sig),self._num_hashes))
+
+        with self._locked():
+            generation = self.generation
+            new_generation = generation + len(rows)
+
+            # Grow the file to hold whole blocks:
+            num_blocks = (new_generation + self._block_rows - 1) // \
+                    self._block_rows
+            file_len = HEADER_LEN + (num_blocks * self._block_len)
+            if os.fstat(self._fd).st_size < file_len:
+                os.ftruncate(self._fd,file_len)
+            self._ensure_mapped(file_len)
+
+            last_rowid = self.last_rowid
+            for i,(rowid,func_sig) in enumerate(rows):
+                block,row = divmod(generation + i,self._block_rows)
+                struct.pack_into(ROWID_FMT,self._mm,\
+                        self._rowids_offset(block) + (row * ROWID_LEN),rowid)
+                for col,value in enumerate(func_sig):
+                    struct.pack_into(VALUE_FMT,self._mm,\
+                            self._column_offset(block,col) + \
+                            (row * VALUE_LEN),value)
+                last_rowid = max(last_rowid,rowid)
+
+            # Publish the new rows. The generation is written last:
+            struct.pack_into('<q',self._mm,LAST_ROWID_OFFSET,last_rowid)
+            struct.pack_into('<Q',self._mm,GENERATION_OFFSET,new_generation)
+
+
+    def find_candidates(self,func_sig,limits=None):
+        """
+        Find all the published rows that share at least one signature value
+        (At the same position) with func_sig.
+        limits may give the maximum amount of rows to find for every value of
+        func_sig (None for no limit).
+        Returns a Counter that maps rowid to the amount of matching values.
+        A rowid might appear more than once inside the index (For example,
+        after a rolled back insert), so the counts are only an upper bound.
+        """
+        self._check_is_open()
+        if len(func_sig) != self._num_hashes:
+            raise SigIndexError('Signature length {} does not match'
+                    ' num_hashes {}'.format(len(func_sig),self._num_hashes))
+        if limits is None:
+            limits = [None] * self._num_hashes
+        # Amount of rows left to find for every value (None for no limit):
+        left = list(limits)
+
+        generation = self.generation
+        num_blocks = (generation + self._block_rows - 1) // self._block_rows
+        self._ensure_mapped(HEADER_LEN + (num_blocks * self._block_len))
+
+        mm = self._mm
+        candidates = collections.Counter()
+        for block in range(num_blocks):
+            block_rows = min(self._block_rows,\
+                    generation - (block * self._block_rows))
+            rowids_offset = self._rowids_offset(block)
+
+            for col,value in enumerate(func_sig):
+                if left[col] == 0:
+                    continue
+                needle = struct.pack(VALUE_FMT,value)
+                col_start = self._column_offset(block,col)
+                col_end = col_start + (block_rows * VALUE_LEN)
+
+                pos = mm.find(needle,col_start,col_end)
+                while pos != -1:
+                    row,misalign = divmod(pos - col_start,VALUE_LEN)
+                    if misalign != 0:
+                        # The value was found across two values:
+                        pos = mm.find(needle,pos + 1,col_end)
+                        continue
+                    rowid = struct.unpack_from(ROWID_FMT,mm,\
+                            rowids_offset + (row * ROWID_LEN))[0]
+                    candidates[rowid] += 1
+                    if left[col] is not None:
+                        left[col] -= 1
+                        if left[col] == 0:
+                            break
+                    pos = mm.find(needle,pos + VALUE_LEN,col_end)
+
+        return candidates
+
+
+class _FileLock:
+    """
+    An exclusive advisory lock over a file descriptor.
+    """
+    def __init__(self,fd):
+        self._fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self._fd,fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        fcntl.flock(self._fd,fcntl.LOCK_UN)
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+
+from fcatalog.proto.frame_endpoint import TCPFrameEndpoint
+from fcatalog.proto.msg_endpoint import MsgFromFrame
+from fcatalog.server.fcatalog_logic import FCatalogServerLogic
+from fcatalog.server.fcatalog_proto import cser_serializer
+from fcatalog.client.fcatalog_client import open_client
+from fcatalog.client.sync_client import FCatalogSyncClient
+from fcatalog.tests.asyncio_util import run_timeout
+
+# Amount of hashes to be used:
+NUM_HASHES = 16
+
+ADDR,PORT = 'localhost',8767
+
+
+def start_test_server(db_base_path,loop,**kwargs):
+    """
+    Start a fcatalog server. Extra keyword arguments are passed to
+    FCatalogServerLogic.
+    """
+    @asyncio.coroutine
+    def client_handler(reader,writer):
+        frame_endpoint = TCPFrameEndpoint(reader,writer)
+        msg_endpoint = MsgFromFrame(cser_serializer,frame_endpoint)
+        sl = FCatalogServerLogic(db_base_path,NUM_HASHES,msg_endpoint,\
+                **kwargs)
+        yield from sl.client_handler()
+
+    start_server = asyncio.start_server(client_handler,host=ADDR,port=PORT,\
+            loop=loop,reuse_address=True)
+    return run_timeout(start_server,loop)
+
+
+def stop_test_server(server,loop):
+    server.close()
+    run_timeout(server.wait_closed(),loop=loop)
+
+
+def test_client_basic(tmpdir,tloop):
+    """
+    Add functions and request similars using FCatalogClient, with many
+    requests in flight.
+    """
+    server = start_test_server(tmpdir,tloop)
+
+    @asyncio.coroutine
+    def client_cor():
+        client = yield from open_client(ADDR,PORT,'my_db',loop=tloop)
+
+        for i in range(20):
+            yield from client.add_function('name{}'.format(i),\
+                    'comment{}'.format(i),\
+                    'This is the function{} data'.format(i).encode('ascii'))
+
+        # Many requests at once:
+        results = yield from asyncio.gather(*[\
+                client.get_similars(\
+                'This is the function{} data'.format(i).encode('ascii'),1) \
+                for i in range(20)],loop=tloop)
+
+        for i,sims in enumerate(results):
+            assert len(sims) == 1
+            assert sims[0].name == 'name{}'.format(i)
+            assert sims[0].sim_grade == NUM_HASHES
+
+        # A large function is sent using a chunked transfer:
+        big_data = b'\x55\x8b\xec' * 0x80000
+        yield from client.add_function('big','big comment',big_data)
+        sims = yield from client.get_similars(big_data,1)
+        assert sims[0].name == 'big'
+        assert sims[0].sim_grade == NUM_HASHES
+
+        yield from client.close()
+
+    run_timeout(client_cor(),tloop,timeout=10.0)
+    stop_test_server(server,tloop)
+
+
+def test_client_cache(tmpdir,tloop):
+    """
+    Repeated requests are answered from the local cache, until the client adds
+    a function.
+    """
+    server = start_test_server(tmpdir,tloop)
+
+    @asyncio.coroutine
+    def client_cor():
+        client = yield from open_client(ADDR,PORT,'my_db',loop=tloop)
+        yield from client.add_function('name1','comment1',b'function data 1')
+
+        sims1 = yield from client.get_similars(b'function data 1',3)
+        assert len(sims1) == 1
+        # Served from the cache, without any request:
+        sims2 = yield from client.get_similars(b'function data 1',3)
+        assert sims2 == sims1
+        assert len(client._pending) == 0
+
+        # Adding a function invalidates the cache:
+        yield from client.add_function('name2','comment2',b'function data 2')
+        sims3 = yield from client.get_similars(b'function data 1',3)
+        assert len(sims3) == 2
+
+        yield from client.close()
+
+    run_timeout(client_cor(),tloop,timeout=3.0)
+    stop_test_server(server,tloop)
+
+
+def test_client_query_limits(tmpdir,tloop):
+    """
+    Queries of a client with query limits are bounded by the server. Their
+    results are marked approximate, and are not cached.
+    """
+    server = start_test_server(tmpdir,tloop)
+
+    @asyncio.coroutine
+    def client_cor():
+        client = yield from open_client(ADDR,PORT,'my_db',loop=tloop,\
+                max_candidates=1,query_deadline=5.0)
+        for i in range(5):
+            yield from client.add_function('name{}'.format(i),'comment',\
+                    'This is the function{} data'.format(i).encode('ascii'))
+
+        sims = yield from client.get_similars(b'This is the function data',5)
+        assert sims.approximate
+        assert len(client._cache) == 0
+        yield from client.close()
+
+        client = yield from open_client(ADDR,PORT,'my_db',loop=tloop,\
+                max_candidates=100,query_deadline=5.0)
+        sims = yield from client.get_similars(b'This is the function data',5)
+        assert not sims.approximate
+        assert len(sims) == 5
+        assert len(client._cache) == 1
+        yield from client.close()
+
+    run_timeout(client_cor(),tloop,timeout=3.0)
+    stop_test_server(server,tloop)
+
+
+def test_client_min_grade(tmpdir,tloop):
+    """
+    A client with min_grade only gets functions with at least this grade.
+    """
+    server = start_test_server(tmpdir,tloop)
+
+    @asyncio.coroutine
+    def client_cor():
+        client = yield from open_client(ADDR,PORT,'my_db',loop=tloop,\
+                min_grade=NUM_HASHES)
+        for i in range(5):
+            yield from client.add_function('name{}'.format(i),'comment',\
+                    'This is the function{} data'.format(i).encode('ascii'))
+
+        sims = yield from client.get_similars(b'This is the function data',5)
+        assert all(sim.sim_grade == NUM_HASHES for sim in sims)
+        sims = yield from client.get_similars(\
+                b'This is the function3 data',5)
+        assert [sim.name for sim in sims] == ['name3']
+        yield from client.close()
+
+    run_timeout(client_cor(),tloop,timeout=3.0)
+    stop_test_server(server,tloop)
+
+
+def test_client_sign_locally(tmpdir,tloop):
+    """
+    Use client side signing, with a server that challenges every signed
+    function.
+    """
+    server = start_test_server(tmpdir,tloop,spot_check_rate=1.0)
+
+    @asyncio.coroutine
+    def client_cor():
+        client = yield from open_client(ADDR,PORT,'my_db',loop=tloop,\
+                sign_locally=True)
+        yield from client.add_function('name1','comment1',b'function data 1')
+        yield from client.add_function('name2','comment2',b'function data 2')
+
+        # The challenges are answered in the background, once they arrive.
+        # The first request makes sure the challenges have arrived:
+        yield from client.get_similars(b'unrelated data',1)
+        yield from client.flush()
+
+        sims = yield from client.get_similars(b'function data 1',3)
+        assert len(sims) >= 1
+        assert sims[0].name == 'name1'
+        assert sims[0].sim_grade == NUM_HASHES
+
+        yield from client.close()
+
+    run_timeout(client_cor(),tloop,timeout=3.0)
+    stop_test_server(server,tloop)
+
+
+def test_sync_client(tmpdir):
+    """
+    Use FCatalogSyncClient against a server running in another thread.
+    """
+    server_loop = asyncio.new_event_loop()
+    server = start_test_server(tmpdir,server_loop)
+    server_thread = threading.Thread(target=server_loop.run_forever)
+    server_thread.start()
+
+    try:
+        client = FCatalogSyncClient(ADDR,PORT,'my_db')
+        client.add_functions([\
+                ('name1','comment1',b'function data 1'),\
+                ('name2','comment2',b'other data 2')])
+        sims = client.get_similars(b'function data 1',3)
+        assert sims[0].name == 'name1'
+
+        results = client.get_similars_many(\
+                [b'function data 1',b'other data 2'],1)
+        assert [sims[0].name for sims in results] == ['name1','name2']
+        client.close()
+    finally:
+        server_loop.call_soon_threadsafe(server_loop.stop)
+        server_thread.join()
+        stop_test_server(server,server_loop)
+        server_loop.close()
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import platform
+
+import pytest
+
+# Performance regression suite:
+# Tests marked with perf measure the time of an operation, and compare it to a
+# baseline stored for this machine. A test fails if the operation became
+# slower than its baseline by more than the tolerance. Metrics without a
+# baseline are recorded.
+#
+# The suite is opt-in. Run it with:
+#   py.test -m perf fcatalog/tests/perf
+#
+# Environment variables:
+#   FCATALOG_PERF_MACHINE   - Tag of the baselines file (Default: A tag made of
+#                             the host name, architecture and python version).
+#   FCATALOG_PERF_BASELINES - Directory of the baselines files.
+#   FCATALOG_PERF_TOLERANCE - Allowed slowdown, as a fraction (Default: 0.25).
+#   FCATALOG_PERF_UPDATE    - If set to 1, overwrite the baselines with the
+#                             measured values.
+
+# Default allowed slowdown relative to the baseline:
+DEFAULT_TOLERANCE = 0.25
+
+# Default directory of the baselines files:
+DEFAULT_BASELINES_DIR = os.path.join(os.path.dirname(__file__),'baselines')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers',\
+            'perf: performance regression test (Run with -m perf)')
+
+
+def pytest_collection_modifyitems(config,items):
+    """
+    Skip perf tests, unless they were selected with -m perf.
+    """
+    if 'perf' in (config.getoption('markexpr') or ''):
+        return
+    skip_perf = pytest.mark.skip(reason='Performance test. Run with -m perf')
+    for item in items:
+        if 'perf' in item.keywords:
+            item.add_marker(skip_perf)
+
+
+def machine_tag():
+    """
+    Get a tag identifying this machine and python version.
+    """
+    tag = os.environ.get('FCATALOG_PERF_MACHINE')
+    if tag:
+        return tag
+    return '{}-{}-py{}.{}'.format(platform.node(),platform.machine(),\
+            sys.version_info[0],sys.version_info[1])
+
+
+def measure(func,number=1,repeat=5):
+    """
+    Call func number times, repeat times over. Returns the best time of one
+    call, in seconds.
+    """
+    best = None
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class Baselines:
+    def __init__(self,path,tolerance,update=False):
+        self._path = path
+        self._tolerance = tolerance
+        self._update = update
+        self._metrics = {}
+        if os.path.isfile(path):
+            with open(path,'r') as f:
+                self._metrics = json.load(f)['metrics']
+        self._changed = False
+
+    def check(self,name,value):
+        """
+        Compare a measured time (In seconds) to its baseline. Fails the test
+        if it regressed by more than the tolerance.
+        """
+        baseline = self._metrics.get(name)
+        if baseline is None or self._update:
+            self._metrics[name] = value
+            self._changed = True
+            return
+
+        limit = baseline * (1 + self._tolerance)
+        if value > limit:
+            pytest.fail('{} regressed: {:.6g}s, baseline {:.6g}s'
+                    ' (Limit {:.6g}s)'.format(name,value,baseline,limit))
+
+    def save(self):
+        if not self._changed:
+            return
+        dir_path = os.path.dirname(self._path)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        with open(self._path,'w') as f:
+            json.dump({'machine': machine_tag(),'metrics': self._metrics},\
+                    f,indent=2,sort_keys=True)
+            f.write('\n')
+
+
+@pytest.fixture(scope='session')
+def baselines(request):
+    """
+    The baselines of this machine. New metrics are saved at the end of the
+    session.
+    """
+    dir_path = os.environ.get('FCATALOG_PERF_BASELINES',DEFAULT_BASELINES_DIR)
+    bl = Baselines(os.path.join(dir_path,machine_tag() + '.json'),\
+            float(os.environ.get('FCATALOG_PERF_TOLERANCE',\
+            DEFAULT_TOLERANCE)),\
+            update=os.environ.get('FCATALOG_PERF_UPDATE') == '1')
+    request.addfinalizer(bl.save)
+    return bl
@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+from fcatalog.catalog1 import sign,slow_sign
+from fcatalog.tests.perf.conftest import measure
+
+pytestmark = pytest.mark.perf
+
+# Sizes of signed data:
+DATA_SIZES = (0x40,0x400,0x1000)
+# Amounts of permutations:
+NUM_PERMS = (16,64)
+
+
+def data_of_size(size):
+    rng = random.Random(size)
+    return bytes(rng.getrandbits(8) for i in range(size))
+
+
+@pytest.mark.parametrize('num_perms',NUM_PERMS)
+@pytest.mark.parametrize('size',DATA_SIZES)
+def test_perf_sign(baselines,size,num_perms):
+    data = data_of_size(size)
+    baselines.check('catalog1.sign.size={}.perms={}'.format(size,num_perms),\
+            measure(lambda: sign(data,num_perms),number=100))
+
+
+@pytest.mark.parametrize('num_perms',NUM_PERMS)
+@pytest.mark.parametrize('size',DATA_SIZES)
+def test_perf_slow_sign(baselines,size,num_perms):
+    data = data_of_size(size)
+    baselines.check('catalog1.slow_sign.size={}.perms={}'.\
+            format(size,num_perms),\
+            measure(lambda: slow_sign(data,num_perms),repeat=3))
@@ -0,0 +1,131 @@
+import os
+import random
+import shutil
+import tempfile
+
+import pytest
+
+from fcatalog.funcs_db import FuncsDB
+from fcatalog.catalog1 import strong_hash
+from fcatalog.tools.corpus import CorpusGenerator,ZipfChooser
+from fcatalog.tests.perf.conftest import measure
+
+pytestmark = pytest.mark.perf
+
+# Amount of hashes to be used:
+NUM_HASHES = 16
+
+# Amounts of rows in the database. (Override with FCATALOG_PERF_DB_SIZES, a
+# comma separated list):
+DB_SIZES = tuple(int(size) for size in \
+        os.environ.get('FCATALOG_PERF_DB_SIZES','10000,100000,1000000').\
+        split(','))
+
+# Signatures of real catalogues share many hash values (Compiler idioms). A
+# hash value of a synthetic signature is taken from a pool of common values
+# with this probability:
+COMMON_VALUE_PROB = 0.3
+# Amount of common hash values:
+NUM_COMMON_VALUES = 0x1000
+
+# Amount of functions added in one measurement:
+ADD_BATCH = 200
+# Amount of measurements of adding functions:
+ADD_REPEAT = 3
+# Amount of queries in one measurement:
+QUERY_BATCH = 20
+
+
+class SigSource:
+    """
+    Synthetic signatures with skewed hash values. Building the large
+    databases from real function data would take too long.
+    """
+    def __init__(self,seed=0):
+        self._rng = random.Random(seed)
+        self._common = ZipfChooser([self._rng.getrandbits(32) \
+                for i in range(NUM_COMMON_VALUES)],1.1)
+
+    def new_sig(self):
+        return [self._common.choose(self._rng) \
+                if self._rng.random() < COMMON_VALUE_PROB else \
+                self._rng.getrandbits(32) for i in range(NUM_HASHES)]
+
+    def near_sig(self,sig):
+        """
+        Get a signature that shares about half of its values with sig.
+        """
+        new_sig = self.new_sig()
+        return [x if self._rng.random() < 0.5 else y \
+                for x,y in zip(sig,new_sig)]
+
+
+@pytest.fixture(scope='module')
+def growing_db():
+    """
+    A database that grows to the requested amount of rows. (The sizes are
+    tested in increasing order, so every size reuses the rows of the previous
+    ones).
+    """
+    tmpdir = tempfile.mkdtemp()
+    fdb = FuncsDB(os.path.join(tmpdir,'perf.sqlite'),NUM_HASHES)
+    sigs = SigSource()
+    state = {'rows': 0,'samples': []}
+
+    def grow(num_rows):
+        while state['rows'] < num_rows:
+            sig = sigs.new_sig()
+            fdb.add_signature('f{}'.format(state['rows']),\
+                    strong_hash(str(state['rows']).encode('ascii')),sig,'')
+            if state['rows'] % 0x100 == 0:
+                state['samples'].append(sig)
+            state['rows'] += 1
+        fdb.commit_funcs()
+        # (The server builds the strong hash filter in the background):
+        if fdb.needs_hash_filter():
+            fdb.build_hash_filter()
+        return fdb,sigs,state['samples']
+
+    yield grow
+    fdb.close()
+    shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize('num_rows',DB_SIZES)
+def test_perf_funcs_db(baselines,growing_db,num_rows):
+    fdb,sigs,samples = growing_db(num_rows)
+    rng = random.Random(num_rows)
+
+    # Adding functions (Including signing their data). Every measurement adds
+    # functions that are not in the database yet:
+    funcs = []
+    seen_data = set()
+    for func in CorpusGenerator(seed=num_rows).generate(\
+            ADD_BATCH * ADD_REPEAT):
+        if func.data not in seen_data:
+            seen_data.add(func.data)
+            funcs.append(func)
+    batches = iter([funcs[i:i + ADD_BATCH] \
+            for i in range(0,ADD_BATCH * ADD_REPEAT,ADD_BATCH)])
+    def add_batch(batch):
+        for func in batch:
+            fdb.add_function(func.name,func.data,'')
+        fdb.commit_funcs()
+    baselines.check('funcs_db.add_function.rows={}'.format(num_rows),\
+            measure(lambda: add_batch(next(batches)),repeat=ADD_REPEAT) / \
+            ADD_BATCH)
+
+    # Uploading functions again, with the same names and comments:
+    baselines.check(\
+            'funcs_db.add_function_duplicate.rows={}'.format(num_rows),\
+            measure(lambda: add_batch(funcs[:ADD_BATCH]),repeat=3) / \
+            ADD_BATCH)
+
+    # Queries that have similar functions in the database:
+    query_sigs = [sigs.near_sig(rng.choice(samples)) \
+            for i in range(QUERY_BATCH)]
+    def query_batch():
+        for sig in query_sigs:
+            fdb.get_similars_by_signature(b'\x00' * 32,sig,5)
+    baselines.check('funcs_db.get_similars.rows={}'.format(num_rows),\
+            measure(query_batch,repeat=3) / QUERY_BATCH)
@@ -0,0 +1,63 @@
+import pytest
+
+from fcatalog.server.fcatalog_proto import cser_serializer,FSimilar,\
+        FCatalogProtoDef
+from fcatalog.client.fcatalog_client import client_serializer
+from fcatalog.tests.perf.conftest import measure
+
+pytestmark = pytest.mark.perf
+
+# Function data of typical size:
+FUNC_DATA = bytes(range(0x100)) * 4
+FUNC_HASH = bytes(range(0x20))
+FUNC_SIG = list(range(0x1000,0x1010))
+
+# Fields of every message:
+MSG_FIELDS = {
+    'ChooseDB': {'db_name': 'my_db'},
+    'AddFunction': {'func_name': 'sub_401000','func_comment': 'A comment',\
+            'func_data': FUNC_DATA},
+    'RequestSimilars': {'func_data': FUNC_DATA,'num_similars': 5},
+    'ResponseSimilars': {'similars': [FSimilar(name='sub_{}'.format(i),\
+            comment='A comment',sim_grade=16 - i) for i in range(5)]},
+    'RequestCompression': {},
+    'ResponseCompression': {'accepted': 1},
+    'BeginAddFunction': {'func_name': 'sub_401000',\
+            'func_comment': 'A comment'},
+    'BeginRequestSimilars': {'num_similars': 5},
+    'FuncDataChunk': {'data_chunk': FUNC_DATA},
+    'EndFuncData': {},
+    'AddFunctionSigned': {'func_name': 'sub_401000',\
+            'func_comment': 'A comment','func_hash': FUNC_HASH,\
+            'func_sig': FUNC_SIG},
+    'RequestSimilarsSigned': {'func_hash': FUNC_HASH,'func_sig': FUNC_SIG,\
+            'num_similars': 5},
+    'ChallengeFuncData': {'func_hash': FUNC_HASH},
+    'ChallengeResponse': {'func_data': FUNC_DATA},
+    'SetQueryLimits': {'max_candidates': 1000,'deadline_ms': 50},
+    'ResponseSimilarsApprox': {'approximate': 1,\
+            'similars': [FSimilar(name='sub_{}'.format(i),\
+            comment='A comment',sim_grade=16 - i) for i in range(5)]},
+    'SetMinGrade': {'min_grade': 12},
+    'SetQueryHashes': {'num_hashes': 8},
+}
+
+# (msg_name,sending serializer,receiving serializer) of every message:
+ROUND_TRIPS = \
+    [(msg_def.__name__,client_serializer,cser_serializer) \
+        for msg_def in FCatalogProtoDef.incoming_msgs.values()] + \
+    [(msg_def.__name__,cser_serializer,client_serializer) \
+        for msg_def in FCatalogProtoDef.outgoing_msgs.values()]
+
+
+@pytest.mark.parametrize('msg_name,sender,receiver',ROUND_TRIPS)
+def test_perf_round_trip(baselines,msg_name,sender,receiver):
+    msg_inst = sender.get_msg(msg_name)
+    for field,value in MSG_FIELDS[msg_name].items():
+        msg_inst.set_field(field,value)
+
+    def round_trip():
+        receiver.deserialize_msg(sender.serialize_msg(msg_inst))
+
+    baselines.check('serializer.round_trip.{}'.format(msg_name),\
+            measure(round_trip,number=1000))
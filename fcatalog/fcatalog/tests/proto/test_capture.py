@@ -0,0 +1,111 @@
+import os
+import asyncio
+
+import pytest
+
+from fcatalog.proto.capture import CaptureWriter,CaptureError,read_capture,\
+        RECORD_OPEN,RECORD_FRAME,RECORD_CLOSE,RECORD_HEADER,CAPTURE_MAGIC
+from fcatalog.proto.msg_endpoint import MsgFromFrame
+from fcatalog.server.fcatalog_proto import cser_serializer
+from fcatalog.client.fcatalog_client import client_serializer
+from fcatalog.tests.asyncio_util import run_timeout,MockFrameEndpoint
+
+
+def read_records(path):
+    with open(path,'rb') as f:
+        return list(read_capture(f))
+
+
+def test_capture_write_read(tmpdir):
+    path = os.path.join(tmpdir,'capture.bin')
+    writer = CaptureWriter(path)
+    conn1 = writer.start_connection()
+    conn2 = writer.start_connection()
+    conn1.frame(b'frame1')
+    conn2.frame(b'frame2')
+    conn1.close()
+    conn1.close()
+    conn1.frame(b'ignored')
+    writer.close()
+
+    records = read_records(path)
+    assert [(r.conn_id,r.kind,r.data) for r in records] == [\
+            (0,RECORD_OPEN,b''),(1,RECORD_OPEN,b''),\
+            (0,RECORD_FRAME,b'frame1'),(1,RECORD_FRAME,b'frame2'),\
+            (0,RECORD_CLOSE,b'')]
+    timestamps = [r.timestamp for r in records]
+    assert timestamps == sorted(timestamps)
+
+    # A new writer appends to the log:
+    writer = CaptureWriter(path)
+    writer.start_connection().frame(b'frame3')
+    writer.close()
+    records = read_records(path)
+    assert len(records) == 7
+    assert records[-1].data == b'frame3'
+
+    # A truncated record is ignored:
+    with open(path,'ab') as f:
+        f.write(RECORD_HEADER.pack(0.0,0,RECORD_FRAME,100) + b'abc')
+    assert len(read_records(path)) == 7
+
+
+def test_capture_invalid_log(tmpdir):
+    path = os.path.join(tmpdir,'capture.bin')
+    with open(path,'wb') as f:
+        f.write(b'Not a capture log')
+    with pytest.raises(CaptureError):
+        read_records(path)
+
+
+def test_capture_sampling(tmpdir):
+    writer = CaptureWriter(os.path.join(tmpdir,'capture.bin'),\
+            sample_rate=0.0)
+    assert writer.start_connection() is None
+    writer.close()
+
+
+def test_capture_max_bytes(tmpdir):
+    path = os.path.join(tmpdir,'capture.bin')
+    max_bytes = len(CAPTURE_MAGIC) + RECORD_HEADER.size * 3 + 10
+    writer = CaptureWriter(path,max_bytes=max_bytes)
+    conn = writer.start_connection()
+    conn.frame(b'0123456789')
+    # The log is full:
+    conn.frame(b'x')
+    conn.close()
+    assert writer.start_connection() is None
+    writer.close()
+
+    assert os.path.getsize(path) <= max_bytes
+    assert [r.kind for r in read_records(path)] == [RECORD_OPEN,RECORD_FRAME]
+
+
+def test_msg_from_frame_capture(tmpdir,tloop):
+    path = os.path.join(tmpdir,'capture.bin')
+    writer = CaptureWriter(path)
+
+    q = asyncio.Queue(loop=tloop)
+    sender = MsgFromFrame(client_serializer,MockFrameEndpoint(None,q.put))
+    receiver = MsgFromFrame(cser_serializer,MockFrameEndpoint(q.get,None),\
+            capture=writer.start_connection())
+
+    @asyncio.coroutine
+    def cor():
+        msg_inst = client_serializer.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from sender.send(msg_inst)
+        yield from q.put(None)
+
+        msg_inst = yield from receiver.recv()
+        assert msg_inst.get_field('db_name') == 'my_db'
+        assert (yield from receiver.recv()) is None
+
+    run_timeout(cor(),tloop)
+    writer.close()
+
+    records = read_records(path)
+    assert [r.kind for r in records] == \
+            [RECORD_OPEN,RECORD_FRAME,RECORD_CLOSE]
+    assert cser_serializer.deserialize_msg(records[1].data).\
+            get_field('db_name') == 'my_db'
@@ -1,8 +1,10 @@
 import struct
 import asyncio
+import zlib
 import pytest
 
-from fcatalog.proto.frame_endpoint import TCPFrameEndpoint
+from fcatalog.proto.frame_endpoint import TCPFrameEndpoint,\
+        COMPRESSED_FLAG,compress_frame,decompress_frame
 from fcatalog.tests.asyncio_util import run_timeout
 
 
@@ -228,3 +230,164 @@ def test_tcp_adapter_max_frame_len(tloop):
 
     assert res == ['send_large_frame','got_none','got_disconnected']
 
+
+def test_tcp_adapter_compression(tloop):
+    """
+    Test send/recv of compressed frames over TCP, after compression was enabled
+    on both sides.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    # A large frame that compresses well, and a small frame that is below the
+    # compression threshold:
+    BIG_FRAME = b'\x55\x8b\xec\x83\xec\x10' * 0x200
+    SMALL_FRAME = b'abc'
+
+    @asyncio.coroutine
+    def server_handler(reader,writer):
+        """Echo server"""
+
+        tfe = TCPFrameEndpoint(reader,writer)
+        tfe.enable_compression()
+
+        # Echo two frames back to the client:
+        for _ in range(2):
+            frame = yield from tfe.recv()
+            yield from tfe.send(frame)
+
+    @asyncio.coroutine
+    def client():
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port)
+
+        # Write BIG_FRAME compressed:
+        zframe = zlib.compress(BIG_FRAME)
+        writer.write(struct.pack('I',len(zframe) | COMPRESSED_FLAG) + zframe)
+        yield from writer.drain()
+
+        # The server should send it back compressed:
+        len_prefix = yield from reader.readexactly(4)
+        msg_len = struct.unpack('I',len_prefix)[0]
+        assert msg_len & COMPRESSED_FLAG
+        zframe = yield from reader.readexactly(msg_len & ~COMPRESSED_FLAG)
+        assert zlib.decompress(zframe) == BIG_FRAME
+
+        # Write SMALL_FRAME uncompressed:
+        writer.write(struct.pack('I',len(SMALL_FRAME)) + SMALL_FRAME)
+        yield from writer.drain()
+
+        # The server should send it back uncompressed:
+        len_prefix = yield from reader.readexactly(4)
+        msg_len = struct.unpack('I',len_prefix)[0]
+        assert msg_len == len(SMALL_FRAME)
+        frame = yield from reader.readexactly(msg_len)
+        assert frame == SMALL_FRAME
+
+        res.append(True)
+
+        # Close client:
+        writer.close()
+
+    # Start server:
+    start_server = asyncio.start_server(server_handler,host=addr,port=port,reuse_address=True)
+    server_task = run_timeout(start_server,tloop)
+
+    # Start client:
+    run_timeout(client(),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == [True]
+
+
+def test_tcp_adapter_timeouts(tloop):
+    """
+    A connection is closed if a frame does not arrive within idle_timeout, or
+    if a started frame is not completed within read_timeout.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    @asyncio.coroutine
+    def server_handler(reader,writer):
+        tfe = TCPFrameEndpoint(reader,writer,idle_timeout=0.2,\
+                read_timeout=0.1)
+
+        frame = yield from tfe.recv()
+        if frame == b'abc':
+            # The client sends half a frame and stalls:
+            frame = yield from tfe.recv()
+        assert frame is None
+        res.append('got_none')
+
+    @asyncio.coroutine
+    def client(first_frame):
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port)
+        writer.write(first_frame)
+        yield from writer.drain()
+
+        # We expect the server to disconnect us:
+        with pytest.raises(asyncio.IncompleteReadError):
+            yield from reader.readexactly(4)
+        res.append('got_disconnected')
+        writer.close()
+
+    # Start server:
+    start_server = asyncio.start_server(server_handler,host=addr,port=port,reuse_address=True)
+    server_task = run_timeout(start_server,tloop)
+
+    # An idle client:
+    run_timeout(client(b''),tloop)
+    # A client that stalls in the middle of a frame:
+    run_timeout(client(b'\x03\x00\x00\x00abc\x04\x00\x00\x00ab'),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == ['got_none','got_disconnected'] * 2
+
+
+def test_decompress_frame():
+    """
+    Check decompress_frame with valid data, invalid data and decompression
+    bombs.
+    """
+    data = b'1234' * 100
+    assert decompress_frame(zlib.compress(data),len(data)) == data
+
+    # Decompressed data is larger than max_frame_len:
+    assert decompress_frame(zlib.compress(data),len(data) - 1) is None
+    assert decompress_frame(zlib.compress(b'\x00' * 2**20),2**10) is None
+
+    # Invalid and truncated compressed data:
+    assert decompress_frame(b'This is not zlib data',len(data)) is None
+    assert decompress_frame(zlib.compress(data)[:-3],len(data)) is None
+
+
+def test_compress_frame():
+    """
+    Frames below the threshold or frames that don't compress well are sent as
+    is.
+    """
+    data = b'1234' * 100
+    len_prefix,payload = compress_frame(data,0x100,6)
+    assert len_prefix & COMPRESSED_FLAG
+    assert len_prefix & ~COMPRESSED_FLAG == len(payload)
+    assert zlib.decompress(payload) == data
+
+    # Below threshold:
+    assert compress_frame(data,len(data) + 1,6) == (len(data),data)
+
+    # Doesn't compress well:
+    assert compress_frame(b'12',0,6) == (2,b'12')
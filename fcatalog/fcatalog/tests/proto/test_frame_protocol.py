@@ -0,0 +1,308 @@
+import struct
+import asyncio
+import zlib
+import pytest
+
+if not hasattr(asyncio,'BufferedProtocol'):
+    pytest.skip('asyncio.BufferedProtocol requires Python 3.7',\
+            allow_module_level=True)
+
+from fcatalog.proto.frame_endpoint import COMPRESSED_FLAG
+from fcatalog.proto.frame_protocol import start_frame_server,\
+        open_frame_connection
+from fcatalog.tests.asyncio_util import run_timeout
+
+
+def test_buffered_frame_endpoint_basic(tloop):
+    """
+    Test basic interaction between two BufferedFrameEndpoints.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    @asyncio.coroutine
+    def server_handler(bfe):
+        """Echo server"""
+        # Read a frame:
+        frame = yield from bfe.recv()
+        # Send the frame back to client:
+        yield from bfe.send(frame)
+
+    @asyncio.coroutine
+    def client():
+        CLIENT_MESS = b'This is a mess'
+        bfe = yield from open_frame_connection(addr,port,loop=tloop)
+        yield from bfe.send(CLIENT_MESS)
+        frame = yield from bfe.recv()
+        assert frame == CLIENT_MESS
+        # Append True to list of results:
+        res.append(True)
+
+        # Close client:
+        yield from bfe.close()
+
+    # Start server:
+    server_task = run_timeout(start_frame_server(server_handler,\
+            addr,port,loop=tloop),tloop)
+
+    # Start client:
+    run_timeout(client(),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == [True]
+
+
+def test_buffered_frame_struct(tloop):
+    """
+    Test receiving of length prefixed frames that arrive in parts, or many
+    frames in one read.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    @asyncio.coroutine
+    def server_handler(bfe):
+        frame = yield from bfe.recv()
+        assert isinstance(frame,memoryview)
+        assert frame == b'abc'
+
+        frame = yield from bfe.recv()
+        assert frame == b''
+
+        frame = yield from bfe.recv()
+        assert frame == b'abcd'
+
+        frame = yield from bfe.recv()
+        assert frame == b'abcd'
+
+        # A frame larger than the initial receive buffer:
+        frame = yield from bfe.recv()
+        assert frame == b'x' * 0x20000
+
+        res.append('sending_frames')
+        # Frames sent in the same loop iteration are written together:
+        yield from bfe.send(b'1234')
+        yield from bfe.send(b'56')
+
+        # Last frame was cut in the middle (The connection was closed),
+        # therefore we expect to get a None here:
+        frame = yield from bfe.recv()
+        assert frame is None
+
+        res.append('got_none')
+
+    @asyncio.coroutine
+    def client():
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port)
+
+        # Write b'abc', an empty frame and b'abcd' at once:
+        writer.write(b'\x03\x00\x00\x00abc' + b'\x00\x00\x00\x00' + \
+                b'\x04\x00\x00\x00abcd')
+        yield from writer.drain()
+
+        # Write b'abcd' in two parts:
+        writer.write(b'\x04\x00\x00')
+        yield from writer.drain()
+        writer.write(b'\x00abcd')
+        yield from writer.drain()
+
+        # Write a large frame:
+        writer.write(struct.pack('I',0x20000) + b'x' * 0x20000)
+        yield from writer.drain()
+
+        # Read the two frames from the server:
+        for expected in [b'1234',b'56']:
+            len_prefix = yield from reader.readexactly(4)
+            msg_len = struct.unpack('I',len_prefix)[0]
+            frame = yield from reader.readexactly(msg_len)
+            assert frame == expected
+
+        # Send half a frame:
+        writer.write(b'\x00\x00\x00')
+        yield from writer.drain()
+
+        res.append('client_close')
+
+        # Close client:
+        writer.close()
+
+    # Start server:
+    server_task = run_timeout(start_frame_server(server_handler,\
+            addr,port,loop=tloop),tloop)
+
+    # Start client:
+    run_timeout(client(),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == ['sending_frames','client_close','got_none']
+
+
+def test_buffered_max_frame_len(tloop):
+    """
+    A frame longer than max_frame_len should close the connection.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    @asyncio.coroutine
+    def server_handler(bfe):
+        frame = yield from bfe.recv()
+        assert frame == b'abc'
+
+        # The next frame is too large for max_frame_len=4:
+        frame = yield from bfe.recv()
+        assert frame is None
+
+        res.append('got_none')
+
+    @asyncio.coroutine
+    def client():
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port)
+
+        writer.write(b'\x03\x00\x00\x00abc')
+        yield from writer.drain()
+
+        res.append('send_large_frame')
+
+        # Write b'abcdef', which is too large for max_frame_len=4:
+        writer.write(b'\x06\x00\x00\x00abcdef')
+        yield from writer.drain()
+
+        # We expect the server to disconnect us:
+        with pytest.raises(asyncio.IncompleteReadError):
+            yield from reader.readexactly(4)
+
+        res.append('got_disconnected')
+
+        writer.close()
+
+    # Start server:
+    server_task = run_timeout(start_frame_server(server_handler,\
+            addr,port,loop=tloop,max_frame_len=4),tloop)
+
+    # Start client:
+    run_timeout(client(),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == ['send_large_frame','got_none','got_disconnected']
+
+
+def test_buffered_compression(tloop):
+    """
+    Send and receive compressed frames after compression was enabled on both
+    sides.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    BIG_FRAME = b'\x55\x8b\xec\x83\xec\x10' * 0x200
+
+    @asyncio.coroutine
+    def server_handler(bfe):
+        """Echo server"""
+        bfe.enable_compression()
+        frame = yield from bfe.recv()
+        yield from bfe.send(bytes(frame))
+
+    @asyncio.coroutine
+    def client():
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port)
+
+        zframe = zlib.compress(BIG_FRAME)
+        writer.write(struct.pack('I',len(zframe) | COMPRESSED_FLAG) + zframe)
+        yield from writer.drain()
+
+        len_prefix = yield from reader.readexactly(4)
+        msg_len = struct.unpack('I',len_prefix)[0]
+        assert msg_len & COMPRESSED_FLAG
+        zframe = yield from reader.readexactly(msg_len & ~COMPRESSED_FLAG)
+        assert zlib.decompress(zframe) == BIG_FRAME
+
+        res.append(True)
+        writer.close()
+
+    # Start server:
+    server_task = run_timeout(start_frame_server(server_handler,\
+            addr,port,loop=tloop),tloop)
+
+    # Start client:
+    run_timeout(client(),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == [True]
+
+
+def test_buffered_timeouts(tloop):
+    """
+    A connection is closed if a frame does not arrive within idle_timeout, or
+    if a started frame is not completed within read_timeout.
+    """
+    # List of results:
+    res = []
+
+    addr,port = 'localhost',8767
+
+    @asyncio.coroutine
+    def server_handler(bfe):
+        frame = yield from bfe.recv()
+        if frame == b'abc':
+            # The client sends half a frame and stalls:
+            frame = yield from bfe.recv()
+        assert frame is None
+        res.append('got_none')
+
+    @asyncio.coroutine
+    def client(first_frame):
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port)
+        writer.write(first_frame)
+        yield from writer.drain()
+
+        # We expect the server to disconnect us:
+        with pytest.raises(asyncio.IncompleteReadError):
+            yield from reader.readexactly(4)
+        res.append('got_disconnected')
+        writer.close()
+
+    # Start server:
+    server_task = run_timeout(start_frame_server(server_handler,\
+            addr,port,loop=tloop,idle_timeout=0.2,read_timeout=0.1),tloop)
+
+    # An idle client:
+    run_timeout(client(b''),tloop)
+    # A client that stalls in the middle of a frame:
+    run_timeout(client(b'\x03\x00\x00\x00abc\x04\x00\x00\x00ab'),tloop)
+
+    # Close server:
+    server_task.close()
+    # Wait until server is closed:
+    run_timeout(server_task.wait_closed(),loop=tloop)
+
+    assert res == ['got_none','got_disconnected'] * 2
@@ -5,7 +5,7 @@ from fcatalog.proto.serializer import \
         SerializeError,DeserializeError,\
         pack_msg_type,unpack_msg_type,\
         s_string,d_string,\
-        s_blob,d_blob,s_uint32,d_uint32
+        s_blob,d_blob,s_uint32,d_uint32,s_uint32_list,d_uint32_list
 
 
 def test_serializer_helpers():
@@ -221,3 +221,37 @@ def test_serialize_deserialize_error():
         dummy_ser.deserialize_msg(rand_data)
 
 
+
+
+def test_serializer_helpers_memoryview():
+    """
+    The deserialize helpers should also work over a memoryview (As handed out
+    by the buffered frame transport).
+    """
+    data = memoryview(s_string('Hello') + s_blob(b'blob') + s_uint32(7))
+
+    nextl,my_str = d_string(data)
+    assert my_str == 'Hello'
+    data = data[nextl:]
+    nextl,my_blob = d_blob(data)
+    assert my_blob == b'blob'
+    assert isinstance(my_blob,bytes)
+    data = data[nextl:]
+    nextl,my_uint32 = d_uint32(data)
+    assert my_uint32 == 7
+
+
+def test_serializer_uint32_list():
+    """
+    Serialize and deserialize lists of uint32.
+    """
+    for xs in [[],[1],[0,0xffffffff,5,6]]:
+        data = s_uint32_list(xs) + b'rest'
+        nextl,xs2 = d_uint32_list(data)
+        assert xs2 == xs
+        assert data[nextl:] == b'rest'
+
+    # Too short, or the length prefix is too long:
+    for data in [b'',b'123',b'\x02\x00\x00\x00abcd']:
+        with pytest.raises(DeserializeError):
+            d_uint32_list(data)
@@ -0,0 +1,277 @@
+import os
+import pstats
+import asyncio
+import tracemalloc
+import concurrent.futures
+
+import pytest
+
+from fcatalog.server.admin import AdminServer,AdminError,profiling,\
+        connection_profile,start_admin_server,run_profiled,\
+        run_profiled_in_thread
+from fcatalog.tests.asyncio_util import run_timeout
+from fcatalog.funcs_db import FuncsDB
+
+# Amount of hashes to be used:
+NUM_HASHES = 16
+
+
+def test_admin_help_and_errors(tloop,tmpdir):
+    admin = AdminServer(tmpdir,loop=tloop)
+    assert 'profile start' in admin.handle_command(['help'])
+    assert admin.handle_command([]) == ''
+
+    with pytest.raises(AdminError):
+        admin.handle_command(['no_such_command'])
+    with pytest.raises(AdminError):
+        admin.handle_command(['profile','start','-3'])
+    with pytest.raises(AdminError):
+        admin.handle_command(['profile','stop'])
+
+
+def test_admin_profile(tloop,tmpdir):
+    admin = AdminServer(tmpdir,loop=tloop)
+    admin.handle_command(['profile','start','100'])
+    try:
+        with pytest.raises(AdminError):
+            # Profiling is already running:
+            admin.handle_command(['profile','start'])
+        sum(range(1000))
+    finally:
+        response = admin.handle_command(['profile','stop'])
+
+    pstats_path = response.split()[-1]
+    assert os.path.dirname(pstats_path) == tmpdir
+    pstats.Stats(pstats_path)
+
+
+def test_admin_profile_timeout(tloop,tmpdir):
+    admin = AdminServer(tmpdir,loop=tloop)
+    admin.handle_command(['profile','start','0.01'])
+    run_timeout(asyncio.sleep(0.05,loop=tloop),tloop)
+    assert not profiling.is_running
+    assert len([name for name in os.listdir(tmpdir) \
+            if name.endswith('.pstats')]) == 1
+
+
+def test_admin_profile_db(tloop,tmpdir):
+    admin = AdminServer(tmpdir,loop=tloop)
+    assert connection_profile('my_db') is None
+    admin.handle_command(['profile','db','my_db','100'])
+    try:
+        assert connection_profile('my_db') is not None
+        assert connection_profile('other_db') is None
+    finally:
+        admin.handle_command(['profile','stop'])
+    assert connection_profile('my_db') is None
+
+
+def profiled_work():
+    return sum(range(100))
+
+def unprofiled_work():
+    return sum(range(100))
+
+def thread_work():
+    return sum(range(100))
+
+def profiled_funcs(response):
+    """
+    Get the names of the functions in the stats written by profile stop.
+    """
+    stats = pstats.Stats(response.split()[-1])
+    return set(func_name for file_name,line,func_name in stats.stats)
+
+
+def test_admin_profile_db_steps(tloop,tmpdir):
+    """
+    Profiling of a database does not charge the code of other connections
+    that runs while a message handler waits. Queries of the database that run
+    in threads are profiled as well.
+    """
+    admin = AdminServer(tmpdir,loop=tloop)
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    @asyncio.coroutine
+    def handler(work):
+        for i in range(10):
+            work()
+            yield from asyncio.sleep(0,loop=tloop)
+        return 'done'
+
+    @asyncio.coroutine
+    def cor():
+        profile = connection_profile('my_db')
+        res = yield from asyncio.gather(\
+                run_profiled(handler(profiled_work),profile),\
+                handler(unprofiled_work),loop=tloop)
+        assert res == ['done','done']
+        yield from tloop.run_in_executor(executor,run_profiled_in_thread,\
+                'my_db',thread_work)
+        yield from tloop.run_in_executor(executor,run_profiled_in_thread,\
+                'other_db',unprofiled_work)
+
+    admin.handle_command(['profile','db','my_db','100'])
+    try:
+        run_timeout(cor(),tloop)
+    finally:
+        response = admin.handle_command(['profile','stop'])
+    executor.shutdown()
+
+    funcs = profiled_funcs(response)
+    assert 'profiled_work' in funcs
+    assert 'thread_work' in funcs
+    assert 'unprofiled_work' not in funcs
+
+
+def test_admin_profile_threads(tloop,tmpdir):
+    """
+    Profiling the process includes the queries that run in threads.
+    """
+    admin = AdminServer(tmpdir,loop=tloop)
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    admin.handle_command(['profile','start','100'])
+    try:
+        run_timeout(tloop.run_in_executor(executor,run_profiled_in_thread,\
+                'my_db',thread_work),tloop)
+    finally:
+        response = admin.handle_command(['profile','stop'])
+    executor.shutdown()
+    assert 'thread_work' in profiled_funcs(response)
+
+
+def test_admin_tracemalloc(tloop,tmpdir):
+    admin = AdminServer(tmpdir,loop=tloop)
+    with pytest.raises(AdminError):
+        admin.handle_command(['tracemalloc','snapshot'])
+
+    admin.handle_command(['tracemalloc','start'])
+    try:
+        response = admin.handle_command(['tracemalloc','snapshot'])
+        assert 'Top allocations' in response
+        keep = [bytes(0x100) for i in range(0x100)]
+        response = admin.handle_command(['tracemalloc','snapshot','5'])
+        assert 'since the previous snapshot' in response
+        assert len(response.splitlines()) <= 2 + 5
+    finally:
+        admin.handle_command(['tracemalloc','stop'])
+    assert not tracemalloc.is_tracing()
+    assert len([name for name in os.listdir(tmpdir) \
+            if name.endswith('.tracemalloc')]) == 2
+
+
+def test_admin_server_tasks(tloop,tmpdir):
+    sock_path = os.path.join(tmpdir,'admin.sock')
+
+    @asyncio.coroutine
+    def sleeper():
+        yield from asyncio.sleep(10,loop=tloop)
+
+    @asyncio.coroutine
+    def client():
+        server = yield from start_admin_server(sock_path,tmpdir,\
+                loop=tloop)
+        sleeper_task = asyncio.ensure_future(sleeper(),loop=tloop)
+        try:
+            assert os.stat(sock_path).st_mode & 0o077 == 0
+            reader,writer = yield from asyncio.open_unix_connection(\
+                    sock_path,loop=tloop)
+            writer.write(b'tasks\n')
+            writer.write_eof()
+            response = yield from reader.read()
+            writer.close()
+            assert 'sleeper' in response.decode('UTF-8')
+        finally:
+            sleeper_task.cancel()
+            server.close()
+            yield from server.wait_closed()
+
+    run_timeout(client(),tloop)
+
+
+def test_admin_hot(tloop,tmpdir):
+    fdb = FuncsDB(os.path.join(tmpdir,'my_db'),NUM_HASHES)
+    for i in range(0x50):
+        fdb.add_signature('f' + str(i),bytes([i]) * 32,\
+                [5] + [i] * (NUM_HASHES - 1),'comment')
+    fdb.close()
+
+    admin = AdminServer(tmpdir,loop=tloop,db_base_path=tmpdir,\
+            num_hashes=NUM_HASHES)
+    lines = admin.handle_command(['hot','my_db','3']).splitlines()
+    assert lines == ['1 hot values of database my_db:','c1 0x00000005 80']
+
+    with pytest.raises(AdminError):
+        admin.handle_command(['hot','no_such_db'])
+    with pytest.raises(AdminError):
+        admin.handle_command(['hot','../my_db'])
+    with pytest.raises(AdminError):
+        AdminServer(tmpdir,loop=tloop).handle_command(['hot','my_db'])
+
+
+class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    An executor that counts the functions submitted to it.
+    """
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.submitted = 0
+
+    def submit(self,*args,**kwargs):
+        self.submitted += 1
+        return super().submit(*args,**kwargs)
+
+
+def test_admin_server_db_commands(tloop,tmpdir):
+    """
+    Commands that open a database run in the executor.
+    """
+    FuncsDB(os.path.join(tmpdir,'my_db'),NUM_HASHES).close()
+    sock_path = os.path.join(tmpdir,'admin.sock')
+    executor = CountingExecutor(1)
+
+    @asyncio.coroutine
+    def client():
+        server = yield from start_admin_server(sock_path,tmpdir,\
+                loop=tloop,db_base_path=tmpdir,num_hashes=NUM_HASHES,\
+                executor=executor)
+        try:
+            reader,writer = yield from asyncio.open_unix_connection(\
+                    sock_path,loop=tloop)
+            writer.write(b'hot my_db\nhot no_such_db\nstats my_db\n')
+            writer.write_eof()
+            response = yield from reader.read()
+            writer.close()
+            lines = response.decode('UTF-8').splitlines()
+            assert lines[0] == '0 hot values of database my_db:'
+            assert lines[1].startswith('Error: No database')
+            assert lines[2] == 'Settings of database my_db:'
+        finally:
+            server.close()
+            yield from server.wait_closed()
+
+    try:
+        run_timeout(client(),tloop)
+    finally:
+        executor.shutdown()
+    assert executor.submitted == 3
+
+
+def test_admin_stats(tloop,tmpdir):
+    FuncsDB(os.path.join(tmpdir,'my_db'),NUM_HASHES,\
+            tuning_profile='large').close()
+    FuncsDB(os.path.join(tmpdir,'other_db'),NUM_HASHES).close()
+
+    admin = AdminServer(tmpdir,loop=tloop,db_base_path=tmpdir,\
+            num_hashes=NUM_HASHES,db_tuning_profiles={'my_db': 'large'})
+    lines = admin.handle_command(['stats','my_db']).splitlines()
+    assert lines[0] == 'Settings of database my_db:'
+    assert 'tuning_profile large' in lines
+    assert 'page_size 8192' in lines
+    assert 'journal_mode wal' in lines
+    lines = admin.handle_command(['stats','other_db']).splitlines()
+    assert 'tuning_profile small' in lines
+    assert 'page_size 4096' in lines
+
+    with pytest.raises(AdminError):
+        admin.handle_command(['stats','no_such_db'])
@@ -0,0 +1,39 @@
+import asyncio
+
+from fcatalog.server.admission import AdmissionControl
+from fcatalog.tests.asyncio_util import run_timeout
+
+
+def test_admission_control(tloop):
+    adm = AdmissionControl(max_connections=2,max_queued=1,\
+            queue_timeout=0.1,loop=tloop)
+
+    @asyncio.coroutine
+    def scenario():
+        assert (yield from adm.acquire())
+        assert (yield from adm.acquire())
+        assert adm.active == 2
+
+        # The third connection waits for a slot:
+        waiting = asyncio.ensure_future(adm.acquire(),loop=tloop)
+        yield from asyncio.sleep(0,loop=tloop)
+        assert adm.queued == 1
+
+        # The queue is full. The fourth connection is rejected:
+        assert not (yield from adm.acquire())
+
+        # The slot of a served connection is handed to the waiting one:
+        adm.release()
+        assert (yield from waiting)
+        assert adm.active == 2
+        assert adm.queued == 0
+
+        # No slot is freed in time:
+        assert not (yield from adm.acquire())
+        assert adm.queued == 0
+
+        adm.release()
+        adm.release()
+        assert adm.active == 0
+
+    run_timeout(scenario(),tloop)
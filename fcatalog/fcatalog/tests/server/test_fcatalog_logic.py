@@ -1,26 +1,52 @@
 import asyncio
 import os
+import concurrent.futures
 
 from fcatalog.proto.msg_endpoint import MsgFromFrame
 from fcatalog.tests.asyncio_util import run_timeout,MockFrameEndpoint
 
-from fcatalog.server.fcatalog_logic import FCatalogServerLogic
+from fcatalog.server.fcatalog_logic import FCatalogServerLogic,\
+        MAX_PENDING_CHALLENGES
+from fcatalog.funcs_db import FuncsDB,_hash_filters as hash_filters
+from fcatalog.server.query_cache import QueryCache
+from fcatalog.metrics import QUERY_CACHE_REQUESTS
 
 
 from fcatalog.server.fcatalog_proto import cser_serializer,\
         ChooseDB,AddFunction,RequestSimilars,ResponseSimilars,\
-        FSimilar
+        RequestCompression,ResponseCompression,\
+        BeginAddFunction,BeginRequestSimilars,FuncDataChunk,EndFuncData,\
+        AddFunctionSigned,RequestSimilarsSigned,ChallengeFuncData,\
+        ChallengeResponse,SetQueryLimits,ResponseSimilarsApprox,SetMinGrade,\
+        SetQueryHashes,FSimilar
+
+from fcatalog.catalog1 import sign,strong_hash
 
 from fcatalog.proto.serializer import Serializer,ProtoDef
 
 
 # A protocol definition for a catalog1 client:
 class CatalogClientProtoDef(ProtoDef):
-    incoming_msgs = {3:ResponseSimilars}
+    incoming_msgs = {\
+        3:ResponseSimilars,\
+        5:ResponseCompression,\
+        12:ChallengeFuncData,\
+        15:ResponseSimilarsApprox}
     outgoing_msgs = {\
         0:ChooseDB,\
         1:AddFunction,\
-        2:RequestSimilars}
+        2:RequestSimilars,\
+        4:RequestCompression,\
+        6:BeginAddFunction,\
+        7:BeginRequestSimilars,\
+        8:FuncDataChunk,\
+        9:EndFuncData,\
+        10:AddFunctionSigned,\
+        11:RequestSimilarsSigned,\
+        13:ChallengeResponse,\
+        14:SetQueryLimits,\
+        16:SetMinGrade,\
+        17:SetQueryHashes}
 
 # Build a client serializer:
 client_ser = Serializer(CatalogClientProtoDef)
@@ -168,3 +194,729 @@ def test_basic_catalog1_logic(tmpdir):
 
     asyncio.async(client_cor2(),loop=my_loop)
     run_timeout(transac_fin,loop=my_loop,timeout=3.0)
+
+
+def test_request_compression_logic(tmpdir):
+    """
+    Negotiate compression before ChooseDB. The mock frame endpoint can not
+    compress, so we expect the server to decline.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1)
+    server_task = asyncio.async(sl.client_handler(),loop=my_loop)
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('RequestCompression')
+        yield from mff2.send(msg_inst)
+
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseCompression'
+        assert msg_inst.get_field('accepted') == 0
+
+        # The connection continues as usual:
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        msg_inst = client_ser.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',b'function data example')
+        msg_inst.set_field('num_similars',1)
+        yield from mff2.send(msg_inst)
+
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseSimilars'
+        assert msg_inst.get_field('similars') == []
+
+        # Close the connection with the server:
+        yield from mff2.close()
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_chunked_transfer_logic(tmpdir):
+    """
+    Add a function and request similars using chunked transfers.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1)
+    server_task = asyncio.async(sl.client_handler(),loop=my_loop)
+
+    func_data = b'This is a rather long function data. ' * 50
+
+    @asyncio.coroutine
+    def send_chunked(begin_msg,data,chunk_len):
+        """
+        Send data using a chunked transfer.
+        """
+        yield from mff2.send(begin_msg)
+        for i in range(0,len(data),chunk_len):
+            msg_inst = client_ser.get_msg('FuncDataChunk')
+            msg_inst.set_field('data_chunk',data[i:i+chunk_len])
+            yield from mff2.send(msg_inst)
+        yield from mff2.send(client_ser.get_msg('EndFuncData'))
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        # Add a function in chunks:
+        msg_inst = client_ser.get_msg('BeginAddFunction')
+        msg_inst.set_field('func_name','name1')
+        msg_inst.set_field('func_comment','comment1')
+        yield from send_chunked(msg_inst,func_data,100)
+
+        # The chunked function matches the same function sent at once:
+        msg_inst = client_ser.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',func_data)
+        msg_inst.set_field('num_similars',3)
+        yield from mff2.send(msg_inst)
+
+        msg_inst = yield from mff2.recv()
+        sims = msg_inst.get_field('similars')
+        assert len(sims) == 1
+        assert sims[0].name == 'name1'
+        assert sims[0].comment == 'comment1'
+        assert sims[0].sim_grade == NUM_HASHES
+
+        # Request similars in chunks:
+        msg_inst = client_ser.get_msg('BeginRequestSimilars')
+        msg_inst.set_field('num_similars',3)
+        yield from send_chunked(msg_inst,func_data,33)
+
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseSimilars'
+        sims = msg_inst.get_field('similars')
+        assert len(sims) == 1
+        assert sims[0].name == 'name1'
+        assert sims[0].sim_grade == NUM_HASHES
+
+        # A chunk without a beginning closes the connection:
+        msg_inst = client_ser.get_msg('FuncDataChunk')
+        msg_inst.set_field('data_chunk',b'1234')
+        yield from mff2.send(msg_inst)
+
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_signed_msgs_logic(tmpdir):
+    """
+    Add functions and request similars using client side signatures. Every
+    AddFunctionSigned is challenged (spot_check_rate=1.0).
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,spot_check_rate=1.0)
+    server_task = asyncio.async(sl.client_handler(),loop=my_loop)
+
+    func_data1 = b'This is the function1 data'
+    func_data2 = b'This is the function2 data'
+
+    def add_signed_msg(func_name,func_data,func_sig):
+        msg_inst = client_ser.get_msg('AddFunctionSigned')
+        msg_inst.set_field('func_name',func_name)
+        msg_inst.set_field('func_comment','comment')
+        msg_inst.set_field('func_hash',strong_hash(func_data))
+        msg_inst.set_field('func_sig',func_sig)
+        return msg_inst
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        yield from mff2.send(add_signed_msg('name1',func_data1,\
+                sign(func_data1,NUM_HASHES)))
+
+        # We expect to be challenged:
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ChallengeFuncData'
+        assert msg_inst.get_field('func_hash') == strong_hash(func_data1)
+
+        msg_inst = client_ser.get_msg('ChallengeResponse')
+        msg_inst.set_field('func_data',func_data1)
+        yield from mff2.send(msg_inst)
+
+        # The function was added:
+        msg_inst = client_ser.get_msg('RequestSimilarsSigned')
+        msg_inst.set_field('func_hash',strong_hash(func_data1))
+        msg_inst.set_field('func_sig',sign(func_data1,NUM_HASHES))
+        msg_inst.set_field('num_similars',3)
+        yield from mff2.send(msg_inst)
+
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseSimilars'
+        sims = msg_inst.get_field('similars')
+        assert len(sims) == 1
+        assert sims[0].name == 'name1'
+        assert sims[0].sim_grade == NUM_HASHES
+
+        # Send a wrong signature:
+        yield from mff2.send(add_signed_msg('name2',func_data2,\
+                [1] * NUM_HASHES))
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ChallengeFuncData'
+
+        msg_inst = client_ser.get_msg('ChallengeResponse')
+        msg_inst.set_field('func_data',func_data2)
+        yield from mff2.send(msg_inst)
+
+        # The server should close the connection:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_unanswered_challenges_logic(tmpdir):
+    """
+    A client that never answers challenges can not get its signatures added.
+    The connection is closed once too many challenges are pending.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,spot_check_rate=1.0)
+    server_task = asyncio.async(sl.client_handler(),loop=my_loop)
+
+    def add_forged_msg(i,func_sig):
+        msg_inst = client_ser.get_msg('AddFunctionSigned')
+        msg_inst.set_field('func_name','name{}'.format(i))
+        msg_inst.set_field('func_comment','comment')
+        msg_inst.set_field('func_hash',\
+                strong_hash('function data {}'.format(i).encode('ascii')))
+        msg_inst.set_field('func_sig',func_sig)
+        return msg_inst
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        for i in range(MAX_PENDING_CHALLENGES):
+            yield from mff2.send(add_forged_msg(i,[i] * NUM_HASHES))
+        # A function that is already challenged is not added either:
+        yield from mff2.send(add_forged_msg(0,[5] * NUM_HASHES))
+        assert not server_task.done()
+
+        # The table of pending challenges is full. The server should close
+        # the connection:
+        yield from mff2.send(add_forged_msg(MAX_PENDING_CHALLENGES,\
+                [1] * NUM_HASHES))
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+        # Every message was challenged, and nothing was added:
+        assert q12.qsize() == MAX_PENDING_CHALLENGES
+        fdb = FuncsDB(os.path.join(tmpdir,'my_db'),NUM_HASHES)
+        assert fdb.get_similars_by_signature(b'x' * 32,[5] * NUM_HASHES,\
+                0x10) == []
+        fdb.close()
+
+    run_timeout(client_cor(),loop=my_loop,timeout=10.0)
+
+
+def test_challenge_timeout_logic(tmpdir):
+    """
+    A challenge that is not answered in time closes the connection.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,spot_check_rate=1.0,\
+            challenge_timeout=0.1)
+    server_task = asyncio.async(sl.client_handler(),loop=my_loop)
+
+    func_data = b'This is the function1 data'
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        msg_inst = client_ser.get_msg('AddFunctionSigned')
+        msg_inst.set_field('func_name','name1')
+        msg_inst.set_field('func_comment','comment')
+        msg_inst.set_field('func_hash',strong_hash(func_data))
+        msg_inst.set_field('func_sig',sign(func_data,NUM_HASHES))
+        yield from mff2.send(msg_inst)
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ChallengeFuncData'
+
+        # Answer too late:
+        yield from asyncio.sleep(0.2,loop=my_loop)
+        msg_inst = client_ser.get_msg('ChallengeResponse')
+        msg_inst.set_field('func_data',func_data)
+        yield from mff2.send(msg_inst)
+
+        # The server should close the connection:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+        fdb = FuncsDB(os.path.join(tmpdir,'my_db'),NUM_HASHES)
+        assert fdb.get_similars(func_data,1) == []
+        fdb.close()
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_max_similars_logic(tmpdir):
+    """
+    The amount of similars returned for one query is capped by max_similars.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,max_similars=2)
+    server_task = asyncio.async(sl.client_handler(),loop=my_loop)
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        for i in range(4):
+            msg_inst = client_ser.get_msg('AddFunction')
+            msg_inst.set_field('func_name','name' + str(i))
+            msg_inst.set_field('func_comment','comment')
+            msg_inst.set_field('func_data',b'This is the function data' + \
+                    bytes([i]))
+            yield from mff2.send(msg_inst)
+
+        msg_inst = client_ser.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',b'This is the function data')
+        msg_inst.set_field('num_similars',0xffffffff)
+        yield from mff2.send(msg_inst)
+
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseSimilars'
+        assert len(msg_inst.get_field('similars')) == 2
+
+        # Close the connection with the server:
+        yield from mff2.close()
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_query_cache_logic(tmpdir):
+    """
+    Identical queries of different connections share results, until the
+    database is written to. Queries run on an executor.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+    query_cache = QueryCache(loop=my_loop)
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    def connect():
+        # Messages from player 1 to player 2
+        q12 = asyncio.Queue(loop=my_loop)
+        # Messages from player 2 to player 1
+        q21 = asyncio.Queue(loop=my_loop)
+        mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+        mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+        sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,\
+                query_cache=query_cache,query_executor=executor)
+        server_task = asyncio.ensure_future(sl.client_handler(),loop=my_loop)
+        return mff2,server_task
+
+    @asyncio.coroutine
+    def choose_db(mff):
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff.send(msg_inst)
+
+    @asyncio.coroutine
+    def add_function(mff,name,func_data):
+        msg_inst = client_ser.get_msg('AddFunction')
+        msg_inst.set_field('func_name',name)
+        msg_inst.set_field('func_comment','comment')
+        msg_inst.set_field('func_data',func_data)
+        yield from mff.send(msg_inst)
+
+    @asyncio.coroutine
+    def request_similars(mff,func_data):
+        msg_inst = client_ser.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',func_data)
+        msg_inst.set_field('num_similars',5)
+        yield from mff.send(msg_inst)
+        msg_inst = yield from mff.recv()
+        assert msg_inst.msg_name == 'ResponseSimilars'
+        return sorted(sim.name for sim in msg_inst.get_field('similars'))
+
+    hits = QUERY_CACHE_REQUESTS.labels('hit')
+
+    @asyncio.coroutine
+    def client_cor():
+        mff_a,task_a = connect()
+        mff_b,task_b = connect()
+        yield from choose_db(mff_a)
+        yield from choose_db(mff_b)
+
+        yield from add_function(mff_a,'name1',b'This is the function1 data')
+        assert (yield from request_similars(mff_a,\
+                b'This is the function data')) == ['name1']
+
+        # The other connection gets the cached result:
+        hits_before = hits.value
+        assert (yield from request_similars(mff_b,\
+                b'This is the function data')) == ['name1']
+        assert hits.value == hits_before + 1
+
+        # A write invalidates the result:
+        yield from add_function(mff_a,'name2',b'This is the function2 data')
+        assert (yield from request_similars(mff_b,\
+                b'This is the function data')) == ['name1','name2']
+        assert hits.value == hits_before + 1
+
+        for mff,task in ((mff_a,task_a),(mff_b,task_b)):
+            yield from mff.close()
+            yield from asyncio.wait_for(task,timeout=None,loop=my_loop)
+
+    try:
+        run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+    finally:
+        executor.shutdown()
+
+
+def test_hash_filter_logic(tmpdir):
+    """
+    The strong hash filter of a chosen database is built on the query
+    executor, and is then used by the connection.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,query_executor=executor)
+    server_task = asyncio.ensure_future(sl.client_handler(),loop=my_loop)
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        # Wait until the build on the executor is done:
+        while sl._fdb is None or sl._fdb._hash_filter_key not in hash_filters:
+            yield from asyncio.sleep(0.01,loop=my_loop)
+        fdb = sl._fdb
+        assert fdb._hash_filter is None
+
+        msg_inst = client_ser.get_msg('AddFunction')
+        msg_inst.set_field('func_name','name1')
+        msg_inst.set_field('func_comment','comment')
+        msg_inst.set_field('func_data',b'This is the function1 data')
+        yield from mff2.send(msg_inst)
+        msg_inst = client_ser.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',b'This is the function1 data')
+        msg_inst.set_field('num_similars',1)
+        yield from mff2.send(msg_inst)
+        yield from mff2.recv()
+
+        assert fdb._hash_filter.might_contain(\
+                strong_hash(b'This is the function1 data'))
+
+        # Close the connection with the server:
+        yield from mff2.close()
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    try:
+        run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+    finally:
+        executor.shutdown()
+
+
+def test_query_limits_logic(tmpdir):
+    """
+    After SetQueryLimits, queries are bounded and answered with
+    ResponseSimilarsApprox.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,\
+            query_cache=QueryCache(loop=my_loop))
+    server_task = asyncio.ensure_future(sl.client_handler(),loop=my_loop)
+
+    # All the functions share their first signature value:
+    sig = [1] + [j + 2 for j in range(NUM_HASHES-1)]
+
+    @asyncio.coroutine
+    def set_limits(max_candidates,deadline_ms):
+        msg_inst = client_ser.get_msg('SetQueryLimits')
+        msg_inst.set_field('max_candidates',max_candidates)
+        msg_inst.set_field('deadline_ms',deadline_ms)
+        yield from mff2.send(msg_inst)
+
+    @asyncio.coroutine
+    def request_similars():
+        msg_inst = client_ser.get_msg('RequestSimilarsSigned')
+        msg_inst.set_field('func_hash',b'\x00' * 32)
+        msg_inst.set_field('func_sig',sig)
+        msg_inst.set_field('num_similars',20)
+        yield from mff2.send(msg_inst)
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseSimilarsApprox'
+        return msg_inst
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        for i in range(10):
+            msg_inst = client_ser.get_msg('AddFunctionSigned')
+            msg_inst.set_field('func_name','name' + str(i))
+            msg_inst.set_field('func_comment','comment')
+            msg_inst.set_field('func_hash',bytes([i + 1]) * 32)
+            msg_inst.set_field('func_sig',[1] + \
+                    [i * NUM_HASHES + j + 100 for j in range(NUM_HASHES-1)])
+            yield from mff2.send(msg_inst)
+
+        yield from set_limits(3,0)
+        msg_inst = yield from request_similars()
+        assert msg_inst.get_field('approximate') == 1
+        assert len(msg_inst.get_field('similars')) == 3
+
+        # Limits that are not hit give exact results:
+        yield from set_limits(100,1000)
+        msg_inst = yield from request_similars()
+        assert msg_inst.get_field('approximate') == 0
+        assert len(msg_inst.get_field('similars')) == 10
+
+        # Close the connection with the server:
+        yield from mff2.close()
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_hot_value_cache_logic(tmpdir):
+    """
+    Results that only hit the hot value caps are cached. Results that hit the
+    limits of the client are not.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,\
+            query_cache=QueryCache(loop=my_loop),hot_threshold=5,hot_cap=3)
+    server_task = asyncio.ensure_future(sl.client_handler(),loop=my_loop)
+
+    # All the functions share their first signature value, which is hot:
+    sig = [1] + [j + 2 for j in range(NUM_HASHES-1)]
+    hits = QUERY_CACHE_REQUESTS.labels('hit')
+
+    @asyncio.coroutine
+    def request_similars():
+        msg_inst = client_ser.get_msg('RequestSimilarsSigned')
+        msg_inst.set_field('func_hash',b'\x00' * 32)
+        msg_inst.set_field('func_sig',sig)
+        msg_inst.set_field('num_similars',20)
+        yield from mff2.send(msg_inst)
+        msg_inst = yield from mff2.recv()
+        return msg_inst
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        for i in range(10):
+            msg_inst = client_ser.get_msg('AddFunctionSigned')
+            msg_inst.set_field('func_name','name' + str(i))
+            msg_inst.set_field('func_comment','comment')
+            msg_inst.set_field('func_hash',bytes([i + 1]) * 32)
+            msg_inst.set_field('func_sig',[1] + \
+                    [i * NUM_HASHES + j + 100 for j in range(NUM_HASHES-1)])
+            yield from mff2.send(msg_inst)
+
+        hits_before = hits.value
+        msg_inst = yield from request_similars()
+        assert len(msg_inst.get_field('similars')) == 3
+        msg_inst = yield from request_similars()
+        assert len(msg_inst.get_field('similars')) == 3
+        assert hits.value == hits_before + 1
+
+        msg_inst = client_ser.get_msg('SetQueryLimits')
+        msg_inst.set_field('max_candidates',2)
+        msg_inst.set_field('deadline_ms',0)
+        yield from mff2.send(msg_inst)
+        for i in range(2):
+            msg_inst = yield from request_similars()
+            assert msg_inst.get_field('approximate') == 1
+            assert len(msg_inst.get_field('similars')) == 2
+        assert hits.value == hits_before + 1
+
+        # Close the connection with the server:
+        yield from mff2.close()
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
+
+
+def test_min_grade_logic(tmpdir):
+    """
+    After SetMinGrade, queries only return functions with a grade of at least
+    min_grade. SetQueryHashes makes queries search using a prefix of the
+    signature.
+    """
+    my_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(None)
+
+    # Messages from player 1 to player 2
+    q12 = asyncio.Queue(loop=my_loop)
+    # Messages from player 2 to player 1
+    q21 = asyncio.Queue(loop=my_loop)
+
+    mff1 = MsgFromFrame(cser_serializer,MockFrameEndpoint(q21.get,q12.put))
+    mff2 = MsgFromFrame(client_ser,MockFrameEndpoint(q12.get,q21.put))
+
+    sl = FCatalogServerLogic(tmpdir,NUM_HASHES,mff1,\
+            query_cache=QueryCache(loop=my_loop))
+    server_task = asyncio.ensure_future(sl.client_handler(),loop=my_loop)
+
+    sig = [j + 1 for j in range(NUM_HASHES)]
+
+    @asyncio.coroutine
+    def request_similars():
+        msg_inst = client_ser.get_msg('RequestSimilarsSigned')
+        msg_inst.set_field('func_hash',b'\x00' * 32)
+        msg_inst.set_field('func_sig',sig)
+        msg_inst.set_field('num_similars',20)
+        yield from mff2.send(msg_inst)
+        msg_inst = yield from mff2.recv()
+        assert msg_inst.msg_name == 'ResponseSimilars'
+        return sorted(sim.sim_grade for sim in msg_inst.get_field('similars'))
+
+    @asyncio.coroutine
+    def client_cor():
+        msg_inst = client_ser.get_msg('ChooseDB')
+        msg_inst.set_field('db_name','my_db')
+        yield from mff2.send(msg_inst)
+
+        # Function i matches the first i values of sig:
+        for i in range(1,NUM_HASHES+1):
+            msg_inst = client_ser.get_msg('AddFunctionSigned')
+            msg_inst.set_field('func_name','name' + str(i))
+            msg_inst.set_field('func_comment','comment')
+            msg_inst.set_field('func_hash',bytes([i]) * 32)
+            msg_inst.set_field('func_sig',sig[:i] + \
+                    [i * NUM_HASHES + j + 100 for j in range(NUM_HASHES-i)])
+            yield from mff2.send(msg_inst)
+
+        assert (yield from request_similars()) == \
+                list(range(1,NUM_HASHES+1))
+
+        msg_inst = client_ser.get_msg('SetMinGrade')
+        msg_inst.set_field('min_grade',10)
+        yield from mff2.send(msg_inst)
+        assert (yield from request_similars()) == \
+                list(range(10,NUM_HASHES+1))
+
+        # Candidates are searched using the first 8 values only, and graded
+        # over the whole signature:
+        msg_inst = client_ser.get_msg('SetQueryHashes')
+        msg_inst.set_field('num_hashes',8)
+        yield from mff2.send(msg_inst)
+        assert (yield from request_similars()) == \
+                list(range(10,NUM_HASHES+1))
+
+        # Close the connection with the server:
+        yield from mff2.close()
+        # Wait for the server coroutine to finish:
+        yield from asyncio.wait_for(server_task,timeout=None,loop=my_loop)
+
+    run_timeout(client_cor(),loop=my_loop,timeout=3.0)
@@ -1,6 +1,9 @@
 from fcatalog.server.fcatalog_proto import \
         ChooseDB,AddFunction,RequestSimilars,ResponseSimilars,\
-        FSimilar
+        RequestCompression,ResponseCompression,\
+        BeginAddFunction,BeginRequestSimilars,FuncDataChunk,EndFuncData,\
+        AddFunctionSigned,RequestSimilarsSigned,ChallengeFuncData,\
+        ChallengeResponse,FSimilar
 
 from fcatalog.proto.serializer import Serializer,ProtoDef
 
@@ -12,12 +15,32 @@ class FullCatalog1ProtoDef(ProtoDef):
         0:ChooseDB,\
         1:AddFunction,\
         2:RequestSimilars,\
-        3:ResponseSimilars}
+        3:ResponseSimilars,\
+        4:RequestCompression,\
+        5:ResponseCompression,\
+        6:BeginAddFunction,\
+        7:BeginRequestSimilars,\
+        8:FuncDataChunk,\
+        9:EndFuncData,\
+        10:AddFunctionSigned,\
+        11:RequestSimilarsSigned,\
+        12:ChallengeFuncData,\
+        13:ChallengeResponse}
     outgoing_msgs = {\
         0:ChooseDB,\
         1:AddFunction,\
         2:RequestSimilars,\
-        3:ResponseSimilars}
+        3:ResponseSimilars,\
+        4:RequestCompression,\
+        5:ResponseCompression,\
+        6:BeginAddFunction,\
+        7:BeginRequestSimilars,\
+        8:FuncDataChunk,\
+        9:EndFuncData,\
+        10:AddFunctionSigned,\
+        11:RequestSimilarsSigned,\
+        12:ChallengeFuncData,\
+        13:ChallengeResponse}
 
 ser = Serializer(FullCatalog1ProtoDef)
 
@@ -80,3 +103,82 @@ def test_response_similars_msg():
     msg_data = ser.serialize_msg(msg_inst)
     msg_data2 = ser.serialize_msg(ser.deserialize_msg(msg_data))
     assert msg_data == msg_data2
+
+
+def test_compression_msgs():
+    """
+    Verify serialization/deserialization of RequestCompression and
+    ResponseCompression messages.
+    """
+    msg_inst = ser.get_msg('RequestCompression')
+    msg_data = ser.serialize_msg(msg_inst)
+    msg_data2 = ser.serialize_msg(ser.deserialize_msg(msg_data))
+    assert msg_data == msg_data2
+
+    msg_inst = ser.get_msg('ResponseCompression')
+    msg_inst.set_field('accepted',1)
+    msg_data = ser.serialize_msg(msg_inst)
+    msg_inst2 = ser.deserialize_msg(msg_data)
+    assert msg_inst2.get_field('accepted') == 1
+    assert msg_data == ser.serialize_msg(msg_inst2)
+
+
+def test_chunked_transfer_msgs():
+    """
+    Verify serialization/deserialization of the chunked transfer messages.
+    """
+    msg_inst = ser.get_msg('BeginAddFunction')
+    msg_inst.set_field('func_name','function name')
+    msg_inst.set_field('func_comment','comment')
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
+
+    msg_inst = ser.get_msg('BeginRequestSimilars')
+    msg_inst.set_field('num_similars',8)
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
+
+    msg_inst = ser.get_msg('FuncDataChunk')
+    msg_inst.set_field('data_chunk',b'Part of the function data')
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
+
+    msg_inst = ser.get_msg('EndFuncData')
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
+
+
+def test_signed_msgs():
+    """
+    Verify serialization/deserialization of the signed messages and the
+    challenge messages.
+    """
+    func_hash = b'\x12' * 32
+    func_sig = list(range(1000,1016))
+
+    msg_inst = ser.get_msg('AddFunctionSigned')
+    msg_inst.set_field('func_name','function name')
+    msg_inst.set_field('func_comment','comment')
+    msg_inst.set_field('func_hash',func_hash)
+    msg_inst.set_field('func_sig',func_sig)
+    msg_data = ser.serialize_msg(msg_inst)
+    msg_inst2 = ser.deserialize_msg(msg_data)
+    assert msg_inst2.get_field('func_sig') == func_sig
+    assert msg_data == ser.serialize_msg(msg_inst2)
+
+    msg_inst = ser.get_msg('RequestSimilarsSigned')
+    msg_inst.set_field('func_hash',func_hash)
+    msg_inst.set_field('func_sig',func_sig)
+    msg_inst.set_field('num_similars',8)
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
+
+    msg_inst = ser.get_msg('ChallengeFuncData')
+    msg_inst.set_field('func_hash',func_hash)
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
+
+    msg_inst = ser.get_msg('ChallengeResponse')
+    msg_inst.set_field('func_data',b'This is the data')
+    msg_data = ser.serialize_msg(msg_inst)
+    assert msg_data == ser.serialize_msg(ser.deserialize_msg(msg_data))
@@ -0,0 +1,102 @@
+import os
+import asyncio
+
+from fcatalog.tests.asyncio_util import run_timeout
+from fcatalog.funcs_db import FuncsDB
+from fcatalog.server.maintenance import Maintenance
+
+# Num hashes used for testing purposes:
+NUM_HASHES = 16
+
+
+def make_db(tmpdir,db_name):
+    fdb = FuncsDB(os.path.join(tmpdir,db_name),NUM_HASHES)
+    fdb.add_function('name1',b'This is the function1 data','comment1')
+    fdb.close()
+
+
+def test_maintain_idle_dbs(tmpdir,tloop):
+    """
+    Only databases that are idle are maintained, at most once in interval
+    seconds.
+    """
+    make_db(tmpdir,'db1')
+    make_db(tmpdir,'db2')
+    maintenance = Maintenance(tmpdir,NUM_HASHES,interval=3600,idle_time=0.1,\
+            loop=tloop)
+
+    @asyncio.coroutine
+    def cor():
+        # No database was used:
+        assert (yield from maintenance.maintain_once()) is None
+
+        maintenance.db_used('db1')
+        # Not idle yet:
+        assert (yield from maintenance.maintain_once()) is None
+        yield from asyncio.sleep(0.2,loop=tloop)
+        maintenance.db_used('db2')
+        db_name,results = yield from maintenance.maintain_once()
+        assert db_name == 'db1'
+        assert results['analyze'] == 'done'
+        assert (yield from maintenance.maintain_once()) is None
+
+        yield from asyncio.sleep(0.2,loop=tloop)
+        db_name,results = yield from maintenance.maintain_once()
+        assert db_name == 'db2'
+
+        # Used again, but maintained recently:
+        maintenance.db_used('db1')
+        yield from asyncio.sleep(0.2,loop=tloop)
+        assert (yield from maintenance.maintain_once()) is None
+
+    run_timeout(cor(),tloop)
+
+
+def test_maintain_shared_db(tmpdir,tloop):
+    """
+    A database that another process maintained recently is not maintained
+    again. A database that does not exist is ignored.
+    """
+    make_db(tmpdir,'db1')
+    maintenance1 = Maintenance(tmpdir,NUM_HASHES,interval=3600,idle_time=0,\
+            loop=tloop)
+    maintenance2 = Maintenance(tmpdir,NUM_HASHES,interval=3600,idle_time=0,\
+            loop=tloop)
+
+    @asyncio.coroutine
+    def cor():
+        maintenance1.db_used('db1')
+        maintenance2.db_used('db1')
+        db_name,results = yield from maintenance1.maintain_once()
+        assert results is not None
+        db_name,results = yield from maintenance2.maintain_once()
+        assert db_name == 'db1'
+        assert results is None
+
+        maintenance1.db_used('no_such_db')
+        db_name,results = yield from maintenance1.maintain_once()
+        assert db_name == 'no_such_db'
+        assert results is None
+        assert not os.path.exists(os.path.join(tmpdir,'no_such_db'))
+
+    run_timeout(cor(),tloop)
+
+
+def test_maintenance_start_stop(tmpdir,tloop):
+    make_db(tmpdir,'db1')
+    maintenance = Maintenance(tmpdir,NUM_HASHES,interval=3600,idle_time=0,\
+            check_period=0.05,loop=tloop)
+
+    @asyncio.coroutine
+    def cor():
+        maintenance.start()
+        maintenance.db_used('db1')
+        yield from asyncio.sleep(0.3,loop=tloop)
+        yield from maintenance.stop()
+        # Maintained by the background task:
+        assert (yield from maintenance.maintain_once()) is None
+        fdb = FuncsDB(os.path.join(tmpdir,'db1'),NUM_HASHES)
+        assert fdb.maintain(min_interval=3600) is None
+        fdb.close()
+
+    run_timeout(cor(),tloop)
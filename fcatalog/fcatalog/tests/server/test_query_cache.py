@@ -0,0 +1,168 @@
+import asyncio
+import pytest
+
+from fcatalog.tests.asyncio_util import run_timeout
+from fcatalog.server.query_cache import QueryCache
+from fcatalog.funcs_db import Similars
+
+
+class Computation:
+    """
+    A query computation that counts its calls, and may be held until
+    released.
+    """
+    def __init__(self,result,loop):
+        self.result = result
+        self.calls = 0
+        self.release = asyncio.Event(loop=loop)
+        self.release.set()
+
+    @asyncio.coroutine
+    def __call__(self):
+        self.calls += 1
+        yield from self.release.wait()
+        if isinstance(self.result,Exception):
+            raise self.result
+        return self.result
+
+
+def test_query_cache_hit(tloop):
+    qc = QueryCache(loop=tloop)
+    comp = Computation(['sim'],tloop)
+
+    @asyncio.coroutine
+    def cor():
+        assert (yield from qc.get(('db',b'h',5),0,comp)) == ['sim']
+        assert (yield from qc.get(('db',b'h',5),0,comp)) == ['sim']
+        assert comp.calls == 1
+        # Another key is computed:
+        assert (yield from qc.get(('db',b'h',6),0,comp)) == ['sim']
+        assert comp.calls == 2
+
+    run_timeout(cor(),loop=tloop)
+
+
+def test_query_cache_generation(tloop):
+    """
+    A result of an older write generation is never returned.
+    """
+    qc = QueryCache(loop=tloop)
+    comp = Computation(['sim'],tloop)
+
+    @asyncio.coroutine
+    def cor():
+        yield from qc.get(('db',b'h',5),0,comp)
+        yield from qc.get(('db',b'h',5),1,comp)
+        assert comp.calls == 2
+        yield from qc.get(('db',b'h',5),1,comp)
+        assert comp.calls == 2
+
+    run_timeout(cor(),loop=tloop)
+
+
+def test_query_cache_ttl(tloop):
+    qc = QueryCache(ttl=0.05,loop=tloop)
+    comp = Computation(['sim'],tloop)
+
+    @asyncio.coroutine
+    def cor():
+        yield from qc.get(('db',b'h',5),0,comp)
+        yield from asyncio.sleep(0.1,loop=tloop)
+        yield from qc.get(('db',b'h',5),0,comp)
+        assert comp.calls == 2
+
+    run_timeout(cor(),loop=tloop)
+
+
+def test_query_cache_max_entries(tloop):
+    qc = QueryCache(max_entries=2,loop=tloop)
+    comp = Computation(['sim'],tloop)
+
+    @asyncio.coroutine
+    def cor():
+        for key in ('a','b','a','c'):
+            yield from qc.get(key,0,comp)
+        assert len(qc) == 2
+        assert comp.calls == 3
+        # 'b' was the least recently used:
+        yield from qc.get('a',0,comp)
+        assert comp.calls == 3
+        yield from qc.get('b',0,comp)
+        assert comp.calls == 4
+
+    run_timeout(cor(),loop=tloop)
+
+
+def test_query_cache_single_flight(tloop):
+    """
+    Identical queries that arrive while the query runs share its result.
+    """
+    qc = QueryCache(max_entries=0,loop=tloop)
+    comp = Computation(['sim'],tloop)
+    comp.release.clear()
+
+    @asyncio.coroutine
+    def cor():
+        tasks = [asyncio.ensure_future(qc.get('key',0,comp),loop=tloop) \
+                for i in range(5)]
+        yield from asyncio.sleep(0.01,loop=tloop)
+        comp.release.set()
+        results = yield from asyncio.gather(*tasks,loop=tloop)
+        assert results == [['sim']] * 5
+        assert comp.calls == 1
+        # Nothing is kept when max_entries is 0:
+        assert len(qc) == 0
+        yield from qc.get('key',0,comp)
+        assert comp.calls == 2
+
+    run_timeout(cor(),loop=tloop)
+
+
+def test_query_cache_error(tloop):
+    """
+    An error of a query is raised to all its waiters, and is not cached.
+    None results are not cached either.
+    """
+    qc = QueryCache(loop=tloop)
+    comp = Computation(ValueError('query failed'),tloop)
+    comp.release.clear()
+
+    @asyncio.coroutine
+    def cor():
+        tasks = [asyncio.ensure_future(qc.get('key',0,comp),loop=tloop) \
+                for i in range(2)]
+        yield from asyncio.sleep(0.01,loop=tloop)
+        comp.release.set()
+        for task in tasks:
+            with pytest.raises(ValueError):
+                yield from task
+        assert comp.calls == 1
+        assert len(qc) == 0
+
+        comp.result = None
+        assert (yield from qc.get('key',0,comp)) is None
+        assert (yield from qc.get('key',0,comp)) is None
+        assert comp.calls == 3
+
+    run_timeout(cor(),loop=tloop)
+
+
+def test_query_cache_approximate(tloop):
+    """
+    Approximate results are only kept with keep_approximate.
+    """
+    qc = QueryCache(loop=tloop)
+    comp = Computation(Similars(['sim'],approximate=True),tloop)
+
+    @asyncio.coroutine
+    def cor():
+        yield from qc.get('key',0,comp)
+        yield from qc.get('key',0,comp)
+        assert comp.calls == 2
+        assert len(qc) == 0
+
+        yield from qc.get('key',0,comp,keep_approximate=True)
+        yield from qc.get('key',0,comp,keep_approximate=True)
+        assert comp.calls == 3
+
+    run_timeout(cor(),loop=tloop)
@@ -0,0 +1,84 @@
+import logging
+import logging.handlers
+
+from fcatalog.server.tracing import Tracer,NULL_TRACE,trace_logger,\
+        start_log_listener,stop_log_listener
+
+
+class ListHandler(logging.Handler):
+    """
+    Keep all the handled records in a list.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self,record):
+        self.records.append(record)
+
+
+def trace_messages(tracer):
+    """
+    Trace one message, and return the messages logged by the trace.
+    """
+    handler = ListHandler()
+    trace_logger.addHandler(handler)
+    old_level = trace_logger.level
+    trace_logger.setLevel(logging.INFO)
+    try:
+        trace = tracer.start('AddFunction',7)
+        trace.add_payload(func_name='name1',func_data=b'secret data')
+        with trace.span('db'):
+            pass
+        trace.finish()
+    finally:
+        trace_logger.removeHandler(handler)
+        trace_logger.setLevel(old_level)
+    return [record.getMessage() for record in handler.records]
+
+
+def test_tracer_sampling():
+    assert Tracer(0.0).start('AddFunction',7) is NULL_TRACE
+    assert trace_messages(Tracer(0.0)) == []
+
+    msgs = trace_messages(Tracer(1.0))
+    assert len(msgs) == 1
+    assert msgs[0].startswith('conn=7 msg=AddFunction total=')
+    assert ' db=' in msgs[0]
+    # Payloads are not logged by default:
+    assert 'secret data' not in msgs[0]
+
+
+def test_tracer_payloads():
+    msgs = trace_messages(Tracer(1.0,log_payloads=True))
+    assert len(msgs) == 1
+    assert "b'secret data'" in msgs[0]
+
+
+def test_log_listener():
+    root = logging.getLogger()
+    handler = ListHandler()
+    # A handler of errors only:
+    error_handler = ListHandler()
+    error_handler.setLevel(logging.ERROR)
+    old_handlers = root.handlers[:]
+    for old_handler in old_handlers:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.addHandler(error_handler)
+    try:
+        listener = start_log_listener()
+        assert len(root.handlers) == 1
+        assert isinstance(root.handlers[0],logging.handlers.QueueHandler)
+
+        logging.getLogger('fcatalog.test').warning('value=%s',5)
+
+        stop_log_listener(listener)
+        assert root.handlers == [handler,error_handler]
+        assert [r.getMessage() for r in handler.records] == ['value=5']
+        assert error_handler.records == []
+    finally:
+        root.removeHandler(handler)
+        root.removeHandler(error_handler)
+        for old_handler in old_handlers:
+            root.addHandler(old_handler)
@@ -0,0 +1,35 @@
+import socket
+import pytest
+
+from fcatalog.server.workers import create_listen_socket,Supervisor,\
+        WorkersError,HAS_REUSEPORT
+
+
+def test_create_listen_socket():
+    sock = create_listen_socket('localhost',8768)
+    try:
+        assert sock.getsockname()[1] == 8768
+        assert sock.gettimeout() == 0.0
+        # Another socket can not bind the same port without SO_REUSEPORT:
+        with pytest.raises(OSError):
+            create_listen_socket('localhost',8768)
+    finally:
+        sock.close()
+
+
+@pytest.mark.skipif(not HAS_REUSEPORT,reason='SO_REUSEPORT is not supported')
+def test_create_listen_socket_reuse_port():
+    sock1 = create_listen_socket('localhost',8768,reuse_port=True)
+    sock2 = create_listen_socket('localhost',8768,reuse_port=True)
+    try:
+        # Connections are accepted by one of the sockets:
+        conn = socket.create_connection(('localhost',8768))
+        conn.close()
+    finally:
+        sock1.close()
+        sock2.close()
+
+
+def test_supervisor_num_workers():
+    with pytest.raises(WorkersError):
+        Supervisor(0,lambda worker_idx: None)
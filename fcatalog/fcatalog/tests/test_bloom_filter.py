@@ -0,0 +1,34 @@
+import pytest
+
+from fcatalog.bloom_filter import BloomFilter,BloomFilterError
+
+
+def test_bloom_filter_basic():
+    bf = BloomFilter(1000)
+    keys = [i.to_bytes(32,'little') for i in range(1000)]
+    # (A few keys might be reported as added before, and are not counted):
+    assert sum(1 for key in keys if bf.add(key)) == 1000 - bf.count
+    assert bf.count > 990
+    count = bf.count
+    assert bf.add(keys[0])
+    assert bf.count == count
+    assert not bf.is_full()
+
+    # Added keys are never missed:
+    assert all(bf.might_contain(key) for key in keys)
+
+    # Other keys are rarely reported:
+    others = [(i + 5000).to_bytes(32,'little') for i in range(10000)]
+    wrong = sum(1 for key in others if bf.might_contain(key))
+    assert wrong < 300
+
+    for i in range(20):
+        bf.add(b'more' + bytes([i]))
+    assert bf.is_full()
+
+
+def test_bloom_filter_invalid():
+    with pytest.raises(BloomFilterError):
+        BloomFilter(0)
+    with pytest.raises(BloomFilterError):
+        BloomFilter(10,error_rate=1.0)
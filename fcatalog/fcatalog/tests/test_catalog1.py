@@ -1,6 +1,7 @@
 import pytest
 
-from fcatalog.catalog1 import slow_sign,sign,strong_hash,Catalog1Error
+from fcatalog.catalog1 import slow_sign,sign,strong_hash,Catalog1Error,\
+        Catalog1Signer,strong_hasher
 
 def isdword(x):
     """
@@ -152,3 +153,37 @@ def test_short_input():
     sign(b'1234',16)
     slow_sign(b'1234',16)
 
+
+##############################################
+##############################################
+
+def test_incremental_signer():
+    """
+    Signing data in parts should give the same result as signing it at once.
+    """
+    data = b'349085092384590903485309485kslajflksajfaiosueroiqwuroiqwer' * 7
+
+    for part_len in [1,2,3,4,5,17,len(data)]:
+        signer = Catalog1Signer(16)
+        hasher = strong_hasher()
+        for i in range(0,len(data),part_len):
+            signer.update(data[i:i+part_len])
+            hasher.update(data[i:i+part_len])
+
+        assert signer.data_len == len(data)
+        assert signer.digest() == sign(data,16)
+        assert hasher.digest() == strong_hash(data)
+
+
+def test_incremental_signer_short_input():
+    """
+    The incremental signer needs at least 4 bytes, like sign.
+    """
+    signer = Catalog1Signer(16)
+    signer.update(b'12')
+    signer.update(b'3')
+    with pytest.raises(Catalog1Error):
+        signer.digest()
+
+    signer.update(b'4')
+    assert signer.digest() == sign(b'1234',16)
@@ -4,8 +4,13 @@ import sqlite3
 import random
 import string
 import os
+import time
+import threading
 
-from fcatalog.funcs_db import FuncsDB
+from fcatalog.funcs_db import FuncsDB,FuncsDBError,CANDIDATES_SAMPLE_PERIOD
+from fcatalog.metrics import QUERY_CANDIDATES
+from fcatalog.bloom_filter import BloomFilter
+from fcatalog.sig_index import SIG_INDEX_SUFFIX
 from fcatalog.catalog1 import sign,strong_hash
 
 
@@ -329,3 +334,641 @@ def test_get_similars_few_similars(fdb_mem):
     assert len(res) == 1
     assert res[0].func_name == 'f7'
 
+
+
+def test_two_connections(tmpdir):
+    """
+    Two FuncsDB instances (Possibly in different server processes) share one
+    database file. Committed functions of one are seen by the other.
+    """
+    db_path = os.path.join(tmpdir,'shared_db')
+    fdb1 = DebugFuncsDB(db_path,NUM_HASHES)
+    fdb2 = DebugFuncsDB(db_path,NUM_HASHES)
+
+    fdb1.add_function('name1',b'This is the function1 data','comment1')
+    # The reader does not block the writer from committing:
+    assert fdb2.count() == 0
+    fdb1.commit_funcs()
+
+    # fdb2 sees the new function after its own snapshot is refreshed:
+    fdb2.commit_funcs()
+    assert fdb2.count() == 1
+    fdb2.add_function('name2',b'This is the function2 data','comment2')
+    fdb2.close()
+
+    assert fdb1.count() == 2
+    fdb1.close()
+
+
+def test_get_similars_sig_index(tmpdir):
+    """
+    Queries using the signature index give the same results as queries using
+    the database indices.
+    """
+    db_path = os.path.join(tmpdir,'indexed_db')
+    # Add a few functions before the index exists:
+    fdb = DebugFuncsDB(db_path,NUM_HASHES)
+    f1 = rand_bytes(0x100)
+    fdb.add_function('f1',f1,'f1')
+    fdb.close()
+
+    fdb = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=True)
+    funcs = [f1]
+    for i in range(2,20):
+        func = change_random_byte(funcs[-1])
+        fdb.add_function('f' + str(i),func,'f' + str(i))
+        funcs.append(func)
+    # Replace an existing function:
+    fdb.add_function('f5_new',funcs[4],'f5')
+    fdb.commit_funcs()
+
+    fdb_plain = DebugFuncsDB(db_path,NUM_HASHES)
+    for func in [funcs[0],funcs[4],funcs[-1],rand_bytes(0x100)]:
+        res = fdb.get_similars(func,5)
+        res_plain = fdb_plain.get_similars(func,5)
+        assert sorted(r.func_grade for r in res) == \
+                sorted(r.func_grade for r in res_plain)
+
+    # The exact match is always first:
+    res = fdb.get_similars(funcs[4],20)
+    assert res[0].func_name == 'f5_new'
+
+    fdb_plain.close()
+    fdb.close()
+
+
+def test_generation(tmpdir):
+    """
+    The write generation changes on commits that wrote functions (Of any
+    connection), and only on them.
+    """
+    db_path = os.path.join(tmpdir,'gen_db')
+    fdb1 = DebugFuncsDB(db_path,NUM_HASHES)
+    fdb2 = DebugFuncsDB(db_path,NUM_HASHES)
+
+    gen = fdb1.generation()
+    assert gen is not None
+    fdb1.get_similars(b'This is the function1 data',5)
+    fdb1.commit_funcs()
+    assert fdb1.generation() == gen
+
+    fdb2.add_function('name1',b'This is the function1 data','comment1')
+    fdb2.commit_funcs()
+    # fdb1 sees the new generation after its own snapshot is refreshed:
+    fdb1.commit_funcs()
+    gen2 = fdb1.generation()
+    assert gen2 != gen
+    assert fdb2.generation() == gen2
+
+    fdb2.add_function('name2',b'This is the function2 data','comment2')
+    fdb2.close()
+    fdb1.commit_funcs()
+    assert fdb1.generation() not in (gen,gen2)
+    fdb1.close()
+
+
+def test_generation_old_db(tmpdir):
+    """
+    A database created without the meta table gets one when it is opened.
+    """
+    db_path = os.path.join(tmpdir,'old_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES)
+    fdb.add_function('name1',b'This is the function1 data','comment1')
+    fdb.close()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute('DROP TABLE meta')
+    conn.commit()
+    conn.close()
+
+    fdb = DebugFuncsDB(db_path,NUM_HASHES)
+    assert fdb.generation() is not None
+    assert fdb.count() == 1
+    fdb.close()
+
+
+def test_value_counts(tmpdir):
+    """
+    value_counts is updated on inserts and replacements, and matches a
+    rebuild.
+    """
+    db_path = os.path.join(tmpdir,'counts_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES)
+
+    def counts():
+        c = fdb._conn.cursor()
+        c.execute('SELECT col,value,count FROM value_counts WHERE count > 0')
+        return sorted(c.fetchall())
+
+    common = [7] * NUM_HASHES
+    for i in range(10):
+        fdb.add_signature('f' + str(i),bytes([i]) * 32,\
+                common[:8] + [i + 100] * 8,'comment')
+    # Replace a function:
+    fdb.add_signature('f0_new',bytes([0]) * 32,common,'comment')
+    fdb.commit_funcs()
+
+    assert fdb.count() == 10
+    c7 = dict(((col,value),count) for col,value,count in counts())
+    assert c7[(1,7)] == 10
+    assert c7[(9,7)] == 1
+    # The values of the replaced function are not counted:
+    assert (9,100) not in c7
+    assert c7[(9,101)] == 1
+
+    before = counts()
+    fdb.rebuild_value_counts()
+    assert counts() == before
+    fdb.close()
+
+
+def test_hot_values(tmpdir):
+    """
+    Hot values give at most hot_cap candidates, and are listed by
+    hot_values(). Candidates are graded using all their values.
+    """
+    db_path = os.path.join(tmpdir,'hot_db')
+    for use_sig_index in (False,True):
+        fdb = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=use_sig_index,\
+                hot_threshold=50,hot_cap=5)
+        # 100 functions share their first signature value:
+        for i in range(100):
+            sig = [1] + [i * NUM_HASHES + j + 2 for j in range(NUM_HASHES-1)]
+            fdb.add_signature('f' + str(i),bytes([i]) * 32,sig,'comment')
+        fdb.commit_funcs()
+
+        assert fdb.hot_values(3) == [(1,1,100)]
+
+        sig = [1] + [j + 2 for j in range(NUM_HASHES-1)]
+        res = fdb.get_similars_by_signature(b'no such hash',sig,200)
+        assert len(res) == 5
+        # The function that shares other values is always a candidate:
+        assert res[0].func_name == 'f0'
+        assert res[0].func_grade == NUM_HASHES
+
+        # Without a threshold, all the functions are candidates:
+        fdb_all = DebugFuncsDB(db_path,NUM_HASHES,\
+                use_sig_index=use_sig_index,hot_threshold=None)
+        assert len(fdb_all.get_similars_by_signature(b'no such hash',\
+                sig,200)) == 100
+        fdb_all.close()
+        fdb.close()
+        os.unlink(db_path)
+
+
+def test_bounded_query(tmpdir):
+    """
+    Bounded queries take at most max_candidates candidates for every value,
+    and stop at their deadline. Results are marked approximate when a limit
+    was hit.
+    """
+    db_path = os.path.join(tmpdir,'bounded_db')
+    for use_sig_index in (False,True):
+        fdb = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=use_sig_index)
+        # 100 functions share their first signature value:
+        for i in range(100):
+            sig = [1] + [i * NUM_HASHES + j + 2 for j in range(NUM_HASHES-1)]
+            fdb.add_signature('f' + str(i),bytes([i]) * 32,sig,'comment')
+        fdb.commit_funcs()
+
+        sig = [1] + [j + 2 for j in range(NUM_HASHES-1)]
+        res = fdb.get_similars_by_signature(b'no such hash',sig,200)
+        assert len(res) == 100
+        assert not res.approximate
+
+        res = fdb.get_similars_by_signature(b'no such hash',sig,200,\
+                max_candidates=5)
+        assert res.approximate
+        assert len(res) <= 6
+        # The function that shares other values is always a candidate:
+        assert res[0].func_name == 'f0'
+        assert res[0].func_grade == NUM_HASHES
+
+        # Limits that are not hit give exact results:
+        res = fdb.get_similars_by_signature(b'no such hash',sig,200,\
+                max_candidates=100,deadline=time.monotonic() + 60)
+        assert len(res) == 100
+        assert not res.approximate
+
+        # A deadline that has passed gives only the exact match:
+        res = fdb.get_similars_by_signature(bytes([3]) * 32,sig,200,\
+                deadline=time.monotonic() - 1)
+        assert res.approximate
+        assert [sim.func_name for sim in res] == ['f3']
+
+        fdb.close()
+        os.unlink(db_path)
+
+
+def test_min_grade(tmpdir):
+    """
+    Queries with min_grade return exactly the functions with a grade of at
+    least min_grade, although only some of the values are searched.
+    """
+    rand = random.Random(4)
+    db_path = os.path.join(tmpdir,'min_grade_db')
+    base_sig = [rand.randrange(2**32) for j in range(NUM_HASHES)]
+    sigs = []
+    for i in range(200):
+        # Change a random amount of values of the base signature. Some values
+        # are changed to a common value:
+        sig = list(base_sig)
+        for j in rand.sample(range(NUM_HASHES),rand.randrange(NUM_HASHES+1)):
+            sig[j] = rand.choice([7,rand.randrange(2**32)])
+        sigs.append(sig)
+
+    def grade(sig):
+        return sum(a == b for a,b in zip(sig,base_sig))
+
+    for use_sig_index in (False,True):
+        fdb = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=use_sig_index)
+        for i,sig in enumerate(sigs):
+            fdb.add_signature('f' + str(i),i.to_bytes(32,'little'),sig,'')
+        fdb.commit_funcs()
+
+        for min_grade in (1,5,10,16,17):
+            expected = sorted('f' + str(i) for i,sig in enumerate(sigs) \
+                    if grade(sig) >= min_grade)
+            for bounds in ({},{'max_candidates': 1000}):
+                res = fdb.get_similars_by_signature(b'no such hash',\
+                        base_sig,1000,min_grade=min_grade,**bounds)
+                assert sorted(sim.func_name for sim in res) == expected
+                assert not res.approximate
+
+        # The exact match is returned with any min_grade:
+        res = fdb.get_similars_by_signature((3).to_bytes(32,'little'),\
+                base_sig,1000,min_grade=17)
+        assert [sim.func_name for sim in res] == ['f3']
+
+        fdb.close()
+        os.unlink(db_path)
+
+
+def test_coarse_query(tmpdir):
+    """
+    Coarse queries search using a prefix of the signature, and grade their
+    results over the whole signature.
+    """
+    num_hashes = 64
+    rand = random.Random(5)
+    db_path = os.path.join(tmpdir,'coarse_db')
+    base_sig = [rand.randrange(2**32) for j in range(num_hashes)]
+
+    for use_sig_index in (False,True):
+        fdb = DebugFuncsDB(db_path,num_hashes,use_sig_index=use_sig_index)
+        # Function i matches base_sig at the first 16 values, and at 10 * i
+        # of the other values:
+        for i in range(5):
+            sig = base_sig[:16 + 10 * i] + [rand.randrange(2**32) \
+                    for j in range(num_hashes - 16 - 10 * i)]
+            fdb.add_signature('f' + str(i),i.to_bytes(32,'little'),sig,'')
+        # Functions that match half of the prefix:
+        for i in range(20):
+            sig = base_sig[:8] + [rand.randrange(2**32) \
+                    for j in range(num_hashes - 8)]
+            fdb.add_signature('h' + str(i),(200 + i).to_bytes(32,'little'),\
+                    sig,'')
+        # Functions that do not match the prefix:
+        for i in range(10):
+            sig = [rand.randrange(2**32) for j in range(16)] + base_sig[16:]
+            fdb.add_signature('g' + str(i),(100 + i).to_bytes(32,'little'),\
+                    sig,'')
+        fdb.commit_funcs()
+
+        for bounds in ({},{'max_candidates': 1000}):
+            res = fdb.get_similars_by_signature(b'no such hash',base_sig,3,\
+                    coarse_hashes=16,**bounds)
+            assert [sim.func_name for sim in res] == ['f4','f3','f2']
+            assert [sim.func_grade for sim in res] == [56,46,36]
+
+            # The whole signature finds the other functions too:
+            res = fdb.get_similars_by_signature(b'no such hash',base_sig,3,\
+                    **bounds)
+            assert [sim.func_grade for sim in res] == [56,48,48]
+            res = fdb.get_similars_by_signature(b'no such hash',base_sig,\
+                    1000,min_grade=48,**bounds)
+            assert 'g0' in [sim.func_name for sim in res]
+            res = fdb.get_similars_by_signature(b'no such hash',base_sig,\
+                    1000,min_grade=48,coarse_hashes=16,**bounds)
+            assert [sim.func_name for sim in res] == ['f4']
+
+        fdb.close()
+
+        # The database may not be opened with another amount of hashes:
+        with pytest.raises(FuncsDBError):
+            DebugFuncsDB(db_path,16)
+        os.unlink(db_path)
+
+
+def test_add_duplicates(tmpdir):
+    """
+    Re-added functions are skipped when nothing changed, and only have their
+    name and comment updated when only these changed. Functions added by
+    another process (Missing from the strong hash filter) are handled too.
+    """
+    db_path = os.path.join(tmpdir,'dup_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=True)
+
+    def row(func_hash):
+        c = fdb._conn.cursor()
+        c.execute('SELECT rowid,func_name,func_comment FROM funcs'
+                ' WHERE func_hash=?',(func_hash,))
+        return c.fetchone()
+
+    def counts():
+        c = fdb._conn.cursor()
+        c.execute('SELECT col,value,count FROM value_counts WHERE count > 0')
+        return sorted(c.fetchall())
+
+    sig = [i + 1 for i in range(NUM_HASHES)]
+    fdb.add_signature('f','f_hash'.encode('ascii') * 5,sig,'comment')
+    fdb.commit_funcs()
+    func_hash = 'f_hash'.encode('ascii') * 5
+    rowid = row(func_hash)[0]
+    generation = fdb.generation()
+
+    # Nothing changed, so nothing is written:
+    fdb.add_signature('f',func_hash,sig,'comment')
+    fdb.commit_funcs()
+    assert fdb.generation() == generation
+    assert row(func_hash) == (rowid,'f','comment')
+
+    # Only the name changed. The row is updated in place:
+    fdb.add_signature('f_new',func_hash,sig,'comment')
+    fdb.commit_funcs()
+    assert fdb.generation() == generation + 1
+    assert row(func_hash) == (rowid,'f_new','comment')
+
+    # Another signature replaces the row:
+    sig2 = [i + 100 for i in range(NUM_HASHES)]
+    fdb.add_signature('f_new',func_hash,sig2,'comment')
+    fdb.commit_funcs()
+    assert row(func_hash)[0] != rowid
+    assert fdb.count() == 1
+    res = fdb.get_similars_by_signature(b'no such hash',sig2,5)
+    assert [sim.func_name for sim in res] == ['f_new']
+
+    # A function added by another process, unknown to our filter:
+    fdb2 = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=True)
+    fdb2._hash_filter = BloomFilter(10)
+    fdb2.add_signature('f_other',func_hash,sig2,'comment')
+    fdb2.add_signature('g',b'g' * 32,sig,'comment')
+    fdb2.commit_funcs()
+    fdb2.close()
+    # Start a new transaction, that sees the writes of fdb2:
+    fdb.commit_funcs()
+    assert row(func_hash)[1:] == ('f_other','comment')
+    assert fdb.count() == 2
+
+    before = counts()
+    fdb.rebuild_value_counts()
+    assert counts() == before
+    fdb.close()
+
+
+def test_hash_filter(tmpdir):
+    """
+    The strong hash filter is built on demand, in another thread, and is then
+    used by all the FuncsDB instances of the database. Until it is built,
+    added functions are looked up.
+    """
+    db_path = os.path.join(tmpdir,'filter_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES)
+    assert fdb.needs_hash_filter()
+    sig = [i + 1 for i in range(NUM_HASHES)]
+    fdb.add_signature('f',b'f' * 32,sig,'comment')
+    fdb.add_signature('f',b'f' * 32,sig,'comment')
+    fdb.commit_funcs()
+    assert fdb.count() == 1
+
+    thread = threading.Thread(target=fdb.build_hash_filter)
+    thread.start()
+    thread.join()
+    assert not fdb.needs_hash_filter()
+
+    # Taken by the next add, and by new instances:
+    fdb.add_signature('g',b'g' * 32,sig,'comment')
+    fdb.commit_funcs()
+    assert fdb._hash_filter.might_contain(b'f' * 32)
+    assert fdb._hash_filter.might_contain(b'g' * 32)
+    fdb2 = DebugFuncsDB(db_path,NUM_HASHES)
+    assert fdb2._hash_filter is fdb._hash_filter
+
+    # A full filter is built again:
+    fdb._hash_filter.count = fdb._hash_filter.capacity + 1
+    assert fdb2.needs_hash_filter()
+    fdb2.build_hash_filter()
+    assert not fdb.needs_hash_filter()
+    fdb2.close()
+    fdb.close()
+
+    # A database in memory has a filter of its own:
+    fdb_mem = DebugFuncsDB(':memory:',NUM_HASHES)
+    assert not fdb_mem.needs_hash_filter()
+    fdb_mem.close()
+
+
+def test_clusters(tmpdir):
+    """
+    Functions with the same signature share one row in sigs. Queries return
+    the members of the best signatures, like a database that is not
+    clustered.
+    """
+    rand = random.Random(6)
+    base_sig = [rand.randrange(2**32) for j in range(NUM_HASHES)]
+    # 3 signatures, with 30, 1 and 5 functions:
+    sigs = [base_sig,base_sig[:12] + [1,2,3,4],base_sig[:8] + [5] * 8]
+    funcs = []
+    for i,num_funcs in enumerate((30,1,5)):
+        for j in range(num_funcs):
+            funcs.append(('f{}_{}'.format(i,j),\
+                    (i * 100 + j).to_bytes(32,'little'),sigs[i]))
+
+    for use_sig_index in (False,True):
+        db_path = os.path.join(tmpdir,'clusters_db')
+        flat_path = os.path.join(tmpdir,'flat_db')
+        fdb = DebugFuncsDB(db_path,NUM_HASHES,use_sig_index=use_sig_index)
+        fdb_flat = DebugFuncsDB(flat_path,NUM_HASHES,\
+                use_sig_index=use_sig_index,clustered=False)
+        for func_name,func_hash,sig in funcs:
+            fdb.add_signature(func_name,func_hash,sig,'')
+            fdb_flat.add_signature(func_name,func_hash,sig,'')
+        fdb.commit_funcs()
+        fdb_flat.commit_funcs()
+
+        def clusters():
+            c = fdb._conn.cursor()
+            c.execute('SELECT num_funcs FROM sigs ORDER BY sig_id')
+            return [row[0] for row in c.fetchall()]
+
+        assert fdb.count() == 36
+        assert clusters() == [30,1,5]
+
+        for bounds in ({},{'max_candidates': 100}):
+            for func_hash in (b'no such hash',funcs[3][1],funcs[30][1]):
+                for num_similars in (1,5,31,40):
+                    res = fdb.get_similars_by_signature(func_hash,base_sig,\
+                            num_similars,**bounds)
+                    res_flat = fdb_flat.get_similars_by_signature(func_hash,\
+                            base_sig,num_similars,**bounds)
+                    assert [sim.func_grade for sim in res] == \
+                            [sim.func_grade for sim in res_flat]
+                    assert len(res) == min(num_similars,36)
+                    if func_hash == funcs[3][1]:
+                        # The exact match first, among its cluster:
+                        assert res[0].func_hash == func_hash
+
+        # A function that moves to another signature leaves its cluster. An
+        # empty cluster is deleted:
+        fdb.add_signature('f1_0',funcs[30][1],sigs[0],'')
+        fdb.add_signature('f0_0',funcs[0][1],[9] * NUM_HASHES,'')
+        fdb.commit_funcs()
+        assert sorted(clusters()) == [1,5,30]
+        res = fdb.get_similars_by_signature(b'no such hash',[9] * NUM_HASHES,5)
+        assert [sim.func_name for sim in res] == ['f0_0']
+
+        # value_counts counts signatures:
+        c = fdb._conn.cursor()
+        c.execute('SELECT count FROM value_counts WHERE col=1 AND value=?',\
+                (base_sig[0],))
+        assert c.fetchone()[0] == 2
+        fdb.close()
+        fdb_flat.close()
+
+        # An existing database keeps its layout:
+        fdb_flat = DebugFuncsDB(flat_path,NUM_HASHES)
+        assert not fdb_flat._has_table('sigs')
+        fdb_flat.close()
+
+        for path in (db_path,flat_path):
+            os.unlink(path)
+            if use_sig_index:
+                os.unlink(path + SIG_INDEX_SUFFIX)
+
+
+def test_tuning_profiles(tmpdir):
+    """
+    The settings of a tuning profile are applied to every connection. The
+    page size is only set when the database is created.
+    """
+    db_path = os.path.join(tmpdir,'tuned_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES,tuning_profile='bulk')
+    settings = fdb.settings()
+    assert settings['tuning_profile'] == 'bulk'
+    assert settings['page_size'] == 0x2000
+    assert settings['cache_size'] == -0x80000
+    assert settings['synchronous'] == 0
+    assert settings['busy_timeout'] == 60000
+    assert settings['journal_mode'] == 'wal'
+    fdb.add_function('name1',b'This is the function1 data','comment1')
+    fdb.close()
+
+    fdb = DebugFuncsDB(db_path,NUM_HASHES,busy_timeout=1.0)
+    settings = fdb.settings()
+    assert settings['tuning_profile'] == 'small'
+    assert settings['page_size'] == 0x2000
+    assert settings['cache_size'] == -0x800
+    assert settings['synchronous'] == 1
+    assert settings['busy_timeout'] == 1000
+    assert fdb.count() == 1
+    fdb.close()
+
+    with pytest.raises(FuncsDBError):
+        DebugFuncsDB(db_path,NUM_HASHES,tuning_profile='no such profile')
+
+
+def test_maintain(tmpdir):
+    """
+    Maintenance gathers statistics, returns free pages to the file system and
+    truncates the WAL. It runs at most once in min_interval seconds.
+    """
+    db_path = os.path.join(tmpdir,'maintained_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES)
+    # Long comments take overflow pages, which are freed when the comments
+    # are updated:
+    for i in range(100):
+        fdb.add_function('name{}'.format(i),\
+                'function data {}'.format(i).encode('ascii'),'x' * 0x4000)
+    fdb.commit_funcs()
+    for i in range(100):
+        fdb.add_function('name{}'.format(i),\
+                'function data {}'.format(i).encode('ascii'),'short')
+    fdb.commit_funcs()
+    assert fdb.settings()['freelist_count'] > 0
+
+    results = fdb.maintain(min_interval=3600)
+    assert results == {'analyze': 'done','vacuum': 'done',\
+            'checkpoint': 'done'}
+    assert fdb.settings()['freelist_count'] == 0
+    assert os.path.getsize(db_path + '-wal') == 0
+    c = fdb._conn.cursor()
+    c.execute('SELECT COUNT(*) FROM sqlite_stat1')
+    assert c.fetchone()[0] > 0
+
+    # Maintained recently, also by another connection:
+    assert fdb.maintain(min_interval=3600) is None
+    fdb2 = DebugFuncsDB(db_path,NUM_HASHES)
+    assert fdb2.maintain(min_interval=3600) is None
+    fdb2.close()
+
+    # Nothing to vacuum. The database is still usable:
+    results = fdb.maintain()
+    assert results['vacuum'] == 'skipped'
+    fdb.add_function('name_new',b'new function data','comment')
+    assert fdb.count() == 101
+    fdb.close()
+
+
+def test_maintain_checkpoint_busy(tmpdir):
+    """
+    A checkpoint that has to wait for a reader gives up after a short wait,
+    instead of the busy timeout of the connection.
+    """
+    db_path = os.path.join(tmpdir,'busy_db')
+    fdb = DebugFuncsDB(db_path,NUM_HASHES,busy_timeout=10.0)
+    fdb.add_function('name1',b'function data 1','comment')
+    fdb.commit_funcs()
+
+    # A reader that keeps an older snapshot of the database:
+    reader = sqlite3.connect(db_path,isolation_level=None)
+    reader.execute('BEGIN')
+    reader.execute('SELECT COUNT(*) FROM funcs').fetchone()
+    fdb.add_function('name2',b'function data 2','comment')
+    fdb.commit_funcs()
+
+    start = time.monotonic()
+    results = fdb.maintain()
+    assert results['checkpoint'] == 'busy'
+    assert time.monotonic() - start < 5.0
+    c = fdb._conn.cursor()
+    c.execute('PRAGMA busy_timeout')
+    assert c.fetchone()[0] == 10000
+
+    reader.execute('COMMIT')
+    reader.close()
+    assert fdb.maintain()['checkpoint'] == 'done'
+    fdb.close()
+
+
+def test_query_candidates_metric(tmpdir):
+    """
+    The candidates of a sampled fraction of the queries without the
+    signature index are counted.
+    """
+    fdb = DebugFuncsDB(os.path.join(tmpdir,'counted_db'),NUM_HASHES)
+    fdb.add_signature('name1',b'a' * 32,[1] * NUM_HASHES,'comment')
+    fdb.add_signature('name2',b'b' * 32,[1] + [2] * (NUM_HASHES - 1),\
+            'comment')
+    fdb.add_signature('name3',b'c' * 32,[3] * NUM_HASHES,'comment')
+    fdb.commit_funcs()
+
+    histogram = QUERY_CANDIDATES._default_child()
+    count_before = sum(histogram._counts)
+    sum_before = histogram._sum
+    for i in range(CANDIDATES_SAMPLE_PERIOD):
+        res = fdb.get_similars_by_signature(b'x' * 32,[1] * NUM_HASHES,10)
+        assert [sim.func_name for sim in res] == ['name1','name2']
+    # Exactly one query was sampled:
+    assert sum(histogram._counts) == count_before + 1
+    assert histogram._sum == sum_before + 2
+    fdb.close()
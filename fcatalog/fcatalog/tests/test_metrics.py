@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import pytest
+
+from fcatalog.metrics import Registry,Counter,Gauge,Histogram,MetricsError,\
+        start_metrics_server
+from fcatalog.tests.asyncio_util import run_timeout
+
+
+def test_render():
+    reg = Registry()
+    msgs = Counter('msgs_total','Messages',['msg_name'],registry=reg)
+    conns = Gauge('conns','Connections',registry=reg)
+    lat = Histogram('lat_seconds','Latency',buckets=[0.1,1],registry=reg)
+
+    msgs.labels('AddFunction').inc()
+    msgs.labels('AddFunction').inc(2)
+    msgs.labels('ChooseDB').inc()
+    conns.inc()
+    conns.inc()
+    conns.dec()
+    lat.observe(0.05)
+    lat.observe(0.5)
+    lat.observe(5)
+
+    assert reg.render().splitlines() == [
+        '# HELP conns Connections',
+        '# TYPE conns gauge',
+        'conns 1.0',
+        '# HELP lat_seconds Latency',
+        '# TYPE lat_seconds histogram',
+        'lat_seconds_bucket{le="0.1"} 1',
+        'lat_seconds_bucket{le="1.0"} 2',
+        'lat_seconds_bucket{le="+Inf"} 3',
+        'lat_seconds_sum 5.55',
+        'lat_seconds_count 3',
+        '# HELP msgs_total Messages',
+        '# TYPE msgs_total counter',
+        'msgs_total{msg_name="AddFunction"} 3.0',
+        'msgs_total{msg_name="ChooseDB"} 1.0',
+    ]
+
+    with pytest.raises(MetricsError):
+        msgs.labels()
+    with pytest.raises(MetricsError):
+        Counter('conns','Duplicate name',registry=reg)
+
+
+def test_histogram_timer():
+    reg = Registry()
+    lat = Histogram('lat_seconds','Latency',registry=reg)
+    with lat.time():
+        pass
+    assert 'lat_seconds_count 1' in reg.render()
+
+
+def test_threads():
+    """
+    Metrics may be updated from a few threads at once.
+    """
+    reg = Registry()
+    msgs = Counter('msgs_total','Messages',['msg_name'],registry=reg)
+    sizes = Histogram('sizes','Sizes',buckets=(1,10),registry=reg)
+
+    def update():
+        for i in range(10000):
+            msgs.labels('a').inc()
+            sizes.observe(5)
+
+    threads = [threading.Thread(target=update) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    text = reg.render()
+    assert 'msgs_total{msg_name="a"} 40000.0' in text
+    assert 'sizes_count 40000' in text
+    assert 'sizes_sum 200000.0' in text
+
+
+def test_metrics_server(tloop):
+    reg = Registry()
+    Counter('msgs_total','Messages',registry=reg).inc()
+
+    addr,port = 'localhost',8767
+
+    @asyncio.coroutine
+    def get(path):
+        reader, writer = yield from \
+                asyncio.open_connection(host=addr,port=port,loop=tloop)
+        writer.write('GET {} HTTP/1.0\r\n\r\n'.format(path).encode('ascii'))
+        response = yield from reader.read()
+        writer.close()
+        return response
+
+    server = run_timeout(start_metrics_server(addr,port,registry=reg,\
+            loop=tloop),tloop)
+
+    response = run_timeout(get('/metrics'),tloop)
+    assert response.startswith(b'HTTP/1.0 200 OK\r\n')
+    assert response.endswith(b'\r\n\r\n' + reg.render().encode('UTF-8'))
+
+    response = run_timeout(get('/other'),tloop)
+    assert response.startswith(b'HTTP/1.0 404 Not Found\r\n')
+
+    server.close()
+    run_timeout(server.wait_closed(),loop=tloop)
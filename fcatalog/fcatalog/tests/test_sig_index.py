@@ -0,0 +1,89 @@
+import os
+import pytest
+
+from fcatalog.sig_index import SigIndex,SigIndexError
+
+
+# Num hashes used for testing purposes:
+NUM_HASHES = 4
+
+def test_sig_index_basic(tmpdir):
+    index_path = os.path.join(tmpdir,'db.sigidx')
+    sidx = SigIndex(index_path,NUM_HASHES)
+    assert sidx.generation == 0
+    assert sidx.find_candidates([1,2,3,4]) == {}
+
+    sidx.append([(1,[1,2,3,4]),(2,[1,2,7,8]),(3,[5,6,7,8])])
+    assert sidx.generation == 3
+    assert sidx.last_rowid == 3
+
+    assert sidx.find_candidates([1,2,3,4]) == {1:4,2:2}
+    # Values are only matched at the same position:
+    assert sidx.find_candidates([4,3,2,1]) == {}
+    assert sidx.find_candidates([0,6,7,0]) == {2:1,3:2}
+
+    with pytest.raises(SigIndexError):
+        sidx.append([(4,[1,2,3])])
+
+    sidx.close()
+
+    # The rows are kept after reopening:
+    sidx = SigIndex(index_path,NUM_HASHES)
+    assert sidx.generation == 3
+    assert sidx.find_candidates([5,0,0,0]) == {3:1}
+    sidx.close()
+
+    # num_hashes must match the index:
+    with pytest.raises(SigIndexError):
+        SigIndex(index_path,NUM_HASHES + 1)
+
+
+def test_sig_index_limits(tmpdir):
+    """
+    A limit on the amount of rows found for a value, across blocks.
+    """
+    sidx = SigIndex(os.path.join(tmpdir,'db.sigidx'),NUM_HASHES,block_rows=2)
+    sidx.append([(i,[1,i,0,0]) for i in range(1,6)])
+    assert sidx.find_candidates([1,3,5,5],[None,None,None,None]) == \
+            {1:1,2:1,3:2,4:1,5:1}
+    assert len(sidx.find_candidates([1,9,9,9],[3,None,None,None])) == 3
+    # Candidates from other values are still found:
+    assert sidx.find_candidates([1,3,9,9],[0,None,None,None]) == {3:1}
+    sidx.close()
+
+
+def test_sig_index_unaligned(tmpdir):
+    """
+    A value that appears across two neighbouring values is not a match.
+    """
+    sidx = SigIndex(os.path.join(tmpdir,'db.sigidx'),NUM_HASHES)
+    # Little endian: 0x22221111,0x44443333 contain 0x33332222 across them:
+    sidx.append([(1,[0x22221111,0,0,0]),(2,[0x44443333,0,0,0])])
+    assert sidx.find_candidates([0x33332222,1,1,1]) == {}
+    assert sidx.find_candidates([0x44443333,1,1,1]) == {2:1}
+    sidx.close()
+
+
+def test_sig_index_shared(tmpdir):
+    """
+    Two instances over the same file (As in two server processes) see each
+    other's rows, also after the file has grown by a few blocks.
+    """
+    index_path = os.path.join(tmpdir,'db.sigidx')
+    writer = SigIndex(index_path,NUM_HASHES,block_rows=3)
+    reader = SigIndex(index_path,NUM_HASHES)
+
+    writer.append([(1,[1,1,1,1])])
+    assert reader.find_candidates([1,0,0,0]) == {1:1}
+
+    writer.append([(i,[i,i,9,9]) for i in range(2,12)])
+    assert reader.generation == 11
+    expected = {i:1 for i in range(2,12)}
+    expected[10] = 2
+    assert reader.find_candidates([10,0,9,0]) == expected
+
+    reader.append([(12,[12,1,1,1])])
+    assert writer.find_candidates([12,1,0,0]) == {1:1,12:2}
+
+    writer.close()
+    reader.close()
@@ -0,0 +1,102 @@
+import os
+import json
+import random
+import sqlite3
+
+import pytest
+
+from fcatalog.tools.bench import RandomFuncs,BenchError,percentile,\
+        summarize,run_bench,main
+from fcatalog.tools.corpus import CorpusGenerator
+from fcatalog.tests.client.test_fcatalog_client import start_test_server,\
+        stop_test_server,ADDR,PORT
+from fcatalog.tests.asyncio_util import run_timeout
+
+
+def test_percentile():
+    values = list(range(1,101))
+    assert percentile(values,50) == 50
+    assert percentile(values,99) == 99
+    assert percentile(values,100) == 100
+    assert percentile([7],50) == 7
+    assert percentile([],50) is None
+
+
+def test_summarize():
+    report = summarize({'A': [0.3,0.1,0.2], 'B': [1.0]},2.0)
+    assert report['messages'] == 4
+    assert report['throughput'] == 2.0
+    assert report['latency']['A']['p50'] == 0.2
+    assert report['latency']['A']['max'] == 0.3
+    assert report['latency']['B']['count'] == 1
+
+
+def test_random_funcs():
+    funcs = RandomFuncs(0x10,0x100)
+    rng = random.Random(1)
+    lens = [len(funcs.new_func(rng)) for i in range(200)]
+    assert min(lens) >= 0x10
+    assert max(lens) <= 0x100
+
+    # The workload is deterministic:
+    assert funcs.new_func(random.Random(2)) == funcs.new_func(random.Random(2))
+
+    with pytest.raises(BenchError):
+        RandomFuncs(0x100,0x10)
+
+
+def test_run_bench(tmpdir,tloop):
+    server = start_test_server(tmpdir,tloop)
+    report = run_timeout(run_bench(ADDR,PORT,num_clients=3,\
+            num_requests=20,catalog_size=30,query_ratio=0.5,\
+            funcs=RandomFuncs(0x40,0x100),loop=tloop),tloop,timeout=10.0)
+    stop_test_server(server,tloop)
+
+    assert report['messages'] == 3 * 20
+    assert set(report['latency']) == {'AddFunction','RequestSimilars'}
+    assert sum(summary['count'] for summary in \
+            report['latency'].values()) == 3 * 20
+    assert report['config']['clients'] == 3
+
+
+def test_run_bench_adds_handled(tmpdir,tloop):
+    """
+    The run ends after the server handled all the added functions.
+    """
+    server = start_test_server(tmpdir,tloop)
+    report = run_timeout(run_bench(ADDR,PORT,num_clients=2,\
+            num_requests=10,catalog_size=10,query_ratio=0.0,\
+            funcs=RandomFuncs(0x40,0x100),loop=tloop),tloop,timeout=10.0)
+
+    conn = sqlite3.connect(os.path.join(tmpdir,'bench'))
+    assert conn.execute('SELECT COUNT(*) FROM funcs').fetchone()[0] == \
+            10 + 2 * 10
+    conn.close()
+    stop_test_server(server,tloop)
+
+    # The closing queries are not measured:
+    assert set(report['latency']) == {'AddFunction'}
+    assert report['latency']['AddFunction']['count'] == 2 * 10
+
+
+def test_run_bench_corpus(tmpdir,tloop):
+    server = start_test_server(tmpdir,tloop)
+    report = run_timeout(run_bench(ADDR,PORT,num_clients=2,\
+            num_requests=10,catalog_size=20,\
+            funcs=CorpusGenerator(max_len=0x100),loop=tloop),\
+            tloop,timeout=10.0)
+    stop_test_server(server,tloop)
+
+    assert report['messages'] == 2 * 10
+    assert report['config']['workload'] == 'CorpusGenerator'
+
+
+def test_main_local_server(tmpdir):
+    output_path = os.path.join(tmpdir,'report.json')
+    main(['--clients','2','--requests','10','--catalog-size','10',\
+            '--max-func-len','256',\
+            '--output',output_path])
+    with open(output_path,'r') as f:
+        report = json.load(f)
+    assert report['messages'] == 2 * 10
+    assert report['config']['server'] == 'local'
@@ -0,0 +1,86 @@
+import os
+import itertools
+
+import pytest
+
+from fcatalog.tools.corpus import CorpusGenerator,CorpusError,\
+        rename_register,family_recall,dump_corpus,load_corpus,main
+from fcatalog.catalog1 import sign
+
+# Amount of hashes to be used:
+NUM_HASHES = 16
+
+
+def test_generate_deterministic():
+    funcs = CorpusGenerator(seed=3).generate(20)
+    assert funcs == CorpusGenerator(seed=3).generate(20)
+    assert funcs != CorpusGenerator(seed=4).generate(20)
+
+    # A family does not depend on the amount of families generated:
+    assert [f for f in funcs if f.family < 5] == \
+            CorpusGenerator(seed=3).generate(5)
+
+
+def test_family_sizes():
+    gen = CorpusGenerator(min_family_size=2,max_family_size=4)
+    funcs = gen.generate(30)
+    sizes = [len(list(members)) for family,members in \
+            itertools.groupby(funcs,key=lambda f: f.family)]
+    assert len(sizes) == 30
+    assert min(sizes) >= 2
+    assert max(sizes) <= 4
+    assert len(set(f.name for f in funcs)) == len(funcs)
+
+    with pytest.raises(CorpusError):
+        CorpusGenerator(min_family_size=3,max_family_size=2)
+
+
+def test_rename_register():
+    # mov eax,ecx ; push ebp:
+    assert rename_register(b'\x8b\xc1\x55',0,1) == b'\x8b\xc8\x55'
+    assert rename_register(b'\x8b\xc1\x55',2,3) == b'\x8b\xc1\x55'
+
+
+def test_families_are_similar():
+    """
+    Functions of the same family have much higher catalog1 similarity grades
+    than functions of different families.
+    """
+    funcs = CorpusGenerator(seed=1).generate(40)
+    sigs = {f.name: sign(f.data,NUM_HASHES) for f in funcs}
+
+    same,other = [],[]
+    for a,b in itertools.combinations(funcs,2):
+        grade = sum(x == y for x,y in zip(sigs[a.name],sigs[b.name]))
+        (same if a.family == b.family else other).append(grade)
+
+    assert sum(same) / len(same) > 4 * (sum(other) / len(other))
+    # Shared snippets make some functions of different families share hash
+    # values:
+    assert any(grade > 0 for grade in other)
+
+
+def test_family_recall():
+    funcs = CorpusGenerator(min_family_size=3,max_family_size=3).generate(2)
+    names = [f.name for f in funcs]
+    # Perfect results:
+    results = {name: names[:3] if i < 3 else names[3:] \
+            for i,name in enumerate(names)}
+    assert family_recall(funcs,results) == 1.0
+    # Only one of the two other members is found:
+    results = {names[0]: [names[0],names[1]]}
+    assert family_recall(funcs,results) == 0.5
+    assert family_recall(funcs,{}) is None
+
+
+def test_dump_load_corpus(tmpdir):
+    funcs = CorpusGenerator().generate(10)
+    path = os.path.join(tmpdir,'corpus.jsonl')
+    with open(path,'w') as f:
+        dump_corpus(funcs,f)
+    with open(path,'r') as f:
+        assert load_corpus(f) == funcs
+
+    main([path,'--families','3','--seed','2'])
+    with open(path,'r') as f:
+        assert load_corpus(f) == CorpusGenerator(seed=2).generate(3)
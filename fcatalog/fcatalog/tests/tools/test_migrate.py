@@ -0,0 +1,56 @@
+import os
+import json
+
+from fcatalog.funcs_db import FuncsDB
+from fcatalog.sig_index import SIG_INDEX_SUFFIX
+from fcatalog.tools.migrate import main
+
+# Amount of hashes to be used:
+NUM_HASHES = 16
+
+
+def test_migrate(tmpdir,capsys):
+    db_path = os.path.join(tmpdir,'my_db')
+    fdb = FuncsDB(db_path,NUM_HASHES,use_sig_index=True,clustered=False)
+    # 0x40 functions with 8 distinct signatures:
+    for i in range(0x40):
+        fdb.add_signature('f' + str(i),bytes([i]) * 32,\
+                [5] + [i % 8] * (NUM_HASHES - 1),'comment' + str(i))
+    fdb.commit_funcs()
+    queries = [(bytes([i]) * 32,[5] + [i] * (NUM_HASHES - 1)) \
+            for i in (0,3,0x50)]
+    before = [fdb.get_similars_by_signature(func_hash,sig,0x10) \
+            for func_hash,sig in queries]
+    fdb.close()
+    assert os.path.isfile(db_path + SIG_INDEX_SUFFIX)
+
+    main([db_path])
+    report = json.loads(capsys.readouterr().out)
+    assert report['migrated']
+    assert report['functions'] == 0x40
+    assert report['signatures'] == 8
+    assert not os.path.isfile(db_path + SIG_INDEX_SUFFIX)
+
+    fdb = FuncsDB(db_path,NUM_HASHES,use_sig_index=True)
+    assert fdb.is_clustered()
+    # Incremental auto vacuum (See Maintenance in fcatalog.funcs_db):
+    assert fdb.settings()['auto_vacuum'] == 2
+    for (func_hash,sig),res_before in zip(queries,before):
+        res = fdb.get_similars_by_signature(func_hash,sig,0x10)
+        assert [sim.func_grade for sim in res] == \
+                [sim.func_grade for sim in res_before]
+        assert [sim.func_hash for sim in res[:1]] == \
+                [sim.func_hash for sim in res_before[:1]]
+    # Counts are of signatures:
+    assert fdb.hot_values(1) == []
+    fdb.add_signature('new',b'n' * 32,[5] * NUM_HASHES,'comment')
+    fdb.commit_funcs()
+    assert fdb.get_similars_by_signature(b'n' * 32,[5] * NUM_HASHES,1)[0].\
+            func_name == 'new'
+    fdb.close()
+
+    # A clustered database is left as is:
+    main([db_path,'--no-vacuum'])
+    report = json.loads(capsys.readouterr().out)
+    assert not report['migrated']
+    assert report['functions'] == 0x41
@@ -0,0 +1,120 @@
+import os
+import json
+
+from fcatalog.proto.capture import CaptureWriter
+from fcatalog.funcs_db import FuncsDB
+from fcatalog.catalog1 import sign,strong_hash
+from fcatalog.client.fcatalog_client import client_serializer
+from fcatalog.tools.replay import load_sessions,run_replay,main
+from fcatalog.tests.client.test_fcatalog_client import start_test_server,\
+        stop_test_server,ADDR,PORT,NUM_HASHES
+from fcatalog.tests.asyncio_util import run_timeout
+
+
+def frame(msg_name,**fields):
+    msg_inst = client_serializer.get_msg(msg_name)
+    for field,value in fields.items():
+        msg_inst.set_field(field,value)
+    return client_serializer.serialize_msg(msg_inst)
+
+
+def write_capture(path):
+    """
+    Capture two sessions: One adds functions, the other queries them.
+    """
+    writer = CaptureWriter(path)
+    adder = writer.start_connection()
+    querier = writer.start_connection()
+    adder.frame(frame('ChooseDB',db_name='my_db'))
+    querier.frame(frame('ChooseDB',db_name='my_db'))
+    for i in range(10):
+        adder.frame(frame('AddFunction',func_name='name{}'.format(i),\
+                func_comment='',func_data='function{} data'.format(i).\
+                encode('ascii')))
+    adder.close()
+    for i in range(3):
+        querier.frame(frame('RequestSimilars',\
+                func_data='function{} data'.format(i).encode('ascii'),\
+                num_similars=1))
+    # A chunked query:
+    querier.frame(frame('BeginRequestSimilars',num_similars=1))
+    querier.frame(frame('FuncDataChunk',data_chunk=b'function3'))
+    querier.frame(frame('FuncDataChunk',data_chunk=b' data'))
+    querier.frame(frame('EndFuncData'))
+    querier.close()
+    writer.close()
+
+
+def test_load_sessions(tmpdir):
+    path = os.path.join(tmpdir,'capture.bin')
+    write_capture(path)
+    with open(path,'rb') as f:
+        sessions = load_sessions([f])
+    assert [len(session.frames) for session in sessions] == [11,8]
+
+
+def test_run_replay(tmpdir,tloop):
+    path = os.path.join(tmpdir,'capture.bin')
+    write_capture(path)
+    with open(path,'rb') as f:
+        sessions = load_sessions([f])
+
+    server = start_test_server(tmpdir,tloop)
+    report = run_timeout(run_replay(ADDR,PORT,sessions,speed=0,loop=tloop),\
+            tloop,timeout=10.0)
+    stop_test_server(server,tloop)
+
+    assert report['sessions'] == 2
+    assert report['frames'] == 19
+    assert report['latency']['RequestSimilars']['count'] == 3
+    assert report['latency']['BeginRequestSimilars']['count'] == 1
+    assert report['closed_early'] == 0
+    assert report['timeouts'] == 0
+
+    # The functions were added by the replay:
+    fdb = FuncsDB(os.path.join(tmpdir,'my_db'),NUM_HASHES)
+    assert len(fdb.get_similars(b'function5 data',1)) == 1
+    fdb.close()
+
+
+def test_run_replay_challenge_responses(tmpdir,tloop):
+    """
+    Captured answers to challenges of the original server are not replayed.
+    """
+    path = os.path.join(tmpdir,'capture.bin')
+    writer = CaptureWriter(path)
+    session = writer.start_connection()
+    session.frame(frame('ChooseDB',db_name='my_db'))
+    for i in range(3):
+        func_data = 'function{} data'.format(i).encode('ascii')
+        session.frame(frame('AddFunctionSigned',func_name='name{}'.format(i),\
+                func_comment='',func_hash=strong_hash(func_data),\
+                func_sig=sign(func_data,NUM_HASHES)))
+        session.frame(frame('ChallengeResponse',func_data=func_data))
+    session.frame(frame('RequestSimilars',func_data=b'function1 data',\
+            num_similars=1))
+    session.close()
+    writer.close()
+    with open(path,'rb') as f:
+        sessions = load_sessions([f])
+
+    server = start_test_server(tmpdir,tloop)
+    report = run_timeout(run_replay(ADDR,PORT,sessions,speed=0,loop=tloop),\
+            tloop,timeout=10.0)
+    stop_test_server(server,tloop)
+
+    assert report['skipped_challenge_responses'] == 3
+    assert report['frames'] == 5
+    # The server did not close the connection before the query:
+    assert report['closed_early'] == 0
+    assert report['latency']['RequestSimilars']['count'] == 1
+
+
+def test_main_local_server(tmpdir):
+    path = os.path.join(tmpdir,'capture.bin')
+    write_capture(path)
+    output_path = os.path.join(tmpdir,'report.json')
+    main([path,'--speed','0','--output',output_path])
+    with open(output_path,'r') as f:
+        report = json.load(f)
+    assert report['sessions'] == 2
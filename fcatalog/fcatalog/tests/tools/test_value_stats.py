@@ -0,0 +1,26 @@
+import os
+import json
+
+from fcatalog.funcs_db import FuncsDB
+from fcatalog.tools.value_stats import main
+
+# Amount of hashes to be used:
+NUM_HASHES = 16
+
+
+def test_value_stats_rebuild(tmpdir,capsys):
+    db_path = os.path.join(tmpdir,'my_db')
+    fdb = FuncsDB(db_path,NUM_HASHES)
+    for i in range(0x50):
+        fdb.add_signature('f' + str(i),bytes([i]) * 32,\
+                [5] + [i] * (NUM_HASHES - 1),'comment')
+    # Lose the counts, as in a database created before value_counts existed:
+    fdb._conn.execute('DELETE FROM value_counts')
+    fdb.close()
+
+    main([db_path])
+    assert json.loads(capsys.readouterr().out) == []
+
+    main([db_path,'--rebuild','--top','5'])
+    assert json.loads(capsys.readouterr().out) == \
+            [{'col': 1,'value': 5,'count': 0x50}]
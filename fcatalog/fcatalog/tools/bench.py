@@ -0,0 +1,463 @@
+import math
+import json
+import time
+import shutil
+import signal
+import random
+import asyncio
+import argparse
+import tempfile
+import collections
+import multiprocessing
+
+from fcatalog.proto.frame_endpoint import TCPFrameEndpoint
+from fcatalog.proto.msg_endpoint import MsgFromFrame
+from fcatalog.server.fcatalog_logic import FCatalogServerLogic
+from fcatalog.server.fcatalog_proto import cser_serializer
+from fcatalog.server.workers import create_listen_socket
+from fcatalog.server.admin import all_tasks
+from fcatalog.client.fcatalog_client import client_serializer
+from fcatalog.tools.corpus import CorpusGenerator,log_uniform_len,rand_bytes
+
+# fcatalog-bench: A load generator and latency benchmark for the fcatalog
+# server.
+# M clients connect to a server (A local server started by the benchmark, or a
+# running one) and send a random mix of AddFunction and RequestSimilars
+# messages through the TCPFrameEndpoint/MsgFromFrame stack. Every client waits
+# for the response of a query before sending its next message.
+# The result is a JSON report with the throughput, and latency percentiles for
+# every message type.
+#
+# AddFunction has no response. The server handles the messages of a connection
+# in order, so an AddFunction was handled once the response of the next query
+# arrived. Its latency is the time until that response. Every client ends with
+# a query (Not measured) after its last AddFunction, so the measured duration
+# includes all the messages the server handled.
+
+class BenchError(Exception): pass
+
+# Default amount of concurrent clients:
+DEFAULT_CLIENTS = 8
+# Default amount of messages sent by every client:
+DEFAULT_REQUESTS = 200
+# Default amount of functions added to the database before measuring:
+DEFAULT_CATALOG_SIZE = 1000
+# Default fraction of the messages that are queries:
+DEFAULT_QUERY_RATIO = 0.8
+# Default range of function lengths. Lengths are distributed uniformly on a log
+# scale between these:
+DEFAULT_MIN_FUNC_LEN = 0x40
+DEFAULT_MAX_FUNC_LEN = 0x1000
+# Default amount of similars asked for in a query:
+DEFAULT_NUM_SIMILARS = 5
+# Amount of hashes used by a local server:
+NUM_HASHES = 16
+
+# Reported latency percentiles:
+PERCENTILES = (50,95,99)
+
+# Amount of messages sent together while filling the catalogue:
+FILL_BATCH_SIZE = 0x100
+
+# asyncio.BufferedProtocol is available since Python 3.7. A local server uses
+# the same frame endpoint as fcatalog_server:
+HAS_BUFFERED_PROTOCOL = hasattr(asyncio,'BufferedProtocol')
+if HAS_BUFFERED_PROTOCOL:
+    from fcatalog.proto.frame_protocol import start_frame_server
+
+
+###################################################################
+# Workload:
+
+class RandomFuncs:
+    """
+    Function data made of random bytes, with lengths distributed uniformly on
+    a log scale between min_len and max_len.
+    (Random functions share almost no hash values. Use a CorpusGenerator for a
+    more realistic workload).
+    """
+    def __init__(self,min_len=DEFAULT_MIN_FUNC_LEN,\
+            max_len=DEFAULT_MAX_FUNC_LEN):
+        if not (0 < min_len <= max_len):
+            raise BenchError('Invalid function lengths range {}..{}'.\
+                    format(min_len,max_len))
+        self._min_len = min_len
+        self._max_len = max_len
+
+    def catalog(self,rng,size):
+        """
+        Get the data of size functions.
+        """
+        return [self.new_func(rng) for i in range(size)]
+
+    def new_func(self,rng):
+        """
+        Get the data of a new function.
+        """
+        return rand_bytes(rng,log_uniform_len(rng,self._min_len,self._max_len))
+
+    def query_func(self,rng,catalog):
+        """
+        Get the data of a function to look for.
+        """
+        return rng.choice(catalog)
+
+
+def percentile(sorted_values,pct):
+    """
+    Get a percentile (Nearest rank) of a sorted list of values.
+    """
+    if len(sorted_values) == 0:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank,1) - 1]
+
+
+def summarize(latencies,duration):
+    """
+    Summarize lists of latencies (By message name) measured during duration
+    seconds.
+    """
+    msgs = {}
+    for msg_name,values in sorted(latencies.items()):
+        values = sorted(values)
+        summary = {
+            'count': len(values),
+            'throughput': len(values) / duration,
+            'mean': sum(values) / len(values),
+            'max': values[-1],
+        }
+        for pct in PERCENTILES:
+            summary['p{}'.format(pct)] = percentile(values,pct)
+        msgs[msg_name] = summary
+
+    total = sum(len(values) for values in latencies.values())
+    return {
+        'duration': duration,
+        'messages': total,
+        'throughput': total / duration,
+        'latency': msgs,
+    }
+
+
+###################################################################
+# Clients:
+
+@asyncio.coroutine
+def _connect(host,port,db_name,loop):
+    """
+    Connect to the server and choose a database.
+    Returns a message endpoint.
+    """
+    reader,writer = yield from asyncio.open_connection(host=host,port=port,\
+            loop=loop)
+    msg_endpoint = MsgFromFrame(client_serializer,\
+            TCPFrameEndpoint(reader,writer))
+    msg_inst = client_serializer.get_msg('ChooseDB')
+    msg_inst.set_field('db_name',db_name)
+    yield from msg_endpoint.send(msg_inst)
+    return msg_endpoint
+
+
+def _add_function_msg(func_name,func_data):
+    msg_inst = client_serializer.get_msg('AddFunction')
+    msg_inst.set_field('func_name',func_name)
+    msg_inst.set_field('func_comment','')
+    msg_inst.set_field('func_data',func_data)
+    return msg_inst
+
+
+@asyncio.coroutine
+def _fill_catalog(host,port,db_name,catalog,loop):
+    """
+    Add the functions of the catalogue to the database.
+    """
+    msg_endpoint = yield from _connect(host,port,db_name,loop)
+    try:
+        for i in range(0,len(catalog),FILL_BATCH_SIZE):
+            yield from msg_endpoint.send_many([\
+                    _add_function_msg('catalog_{}'.format(j),func_data) \
+                    for j,func_data in \
+                    enumerate(catalog[i:i+FILL_BATCH_SIZE],i)])
+
+        # The server handles messages in order. Once a query is answered, all
+        # the functions were added:
+        msg_inst = client_serializer.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',catalog[0])
+        msg_inst.set_field('num_similars',1)
+        yield from msg_endpoint.send(msg_inst)
+        if (yield from msg_endpoint.recv()) is None:
+            raise BenchError('Connection was closed while filling the'
+                    ' catalogue')
+    finally:
+        yield from msg_endpoint.close()
+
+
+@asyncio.coroutine
+def _bench_client(client_idx,host,port,db_name,catalog,funcs,rng,\
+        num_requests,query_ratio,num_similars,latencies,loop):
+    """
+    Run the messages of one client, and record their latencies.
+    """
+    # Send times of the AddFunction messages that were not handled yet:
+    add_starts = []
+
+    @asyncio.coroutine
+    def query(func_data):
+        """
+        Send a query and wait for its response. Returns the time it took.
+        """
+        msg_inst = client_serializer.get_msg('RequestSimilars')
+        msg_inst.set_field('func_data',func_data)
+        msg_inst.set_field('num_similars',num_similars)
+        start = time.perf_counter()
+        yield from msg_endpoint.send(msg_inst)
+        resp = yield from msg_endpoint.recv()
+        if resp is None:
+            raise BenchError('Connection of client {} was closed'.\
+                    format(client_idx))
+        end = time.perf_counter()
+        if len(add_starts) > 0:
+            # The functions added before the query were handled:
+            latencies['AddFunction'] += [end - add_start \
+                    for add_start in add_starts]
+            del add_starts[:]
+        return end - start
+
+    msg_endpoint = yield from _connect(host,port,db_name,loop)
+    try:
+        for i in range(num_requests):
+            if len(catalog) > 0 and rng.random() < query_ratio:
+                latencies['RequestSimilars'].append(\
+                        (yield from query(funcs.query_func(rng,catalog))))
+            else:
+                msg_inst = _add_function_msg(\
+                        'client_{}_{}'.format(client_idx,i),\
+                        funcs.new_func(rng))
+                add_starts.append(time.perf_counter())
+                yield from msg_endpoint.send(msg_inst)
+
+        if len(add_starts) > 0:
+            # Wait until the server handled the last functions:
+            yield from query(funcs.new_func(rng))
+    finally:
+        yield from msg_endpoint.close()
+
+
+@asyncio.coroutine
+def run_bench(host,port,db_name='bench',num_clients=DEFAULT_CLIENTS,\
+        num_requests=DEFAULT_REQUESTS,catalog_size=DEFAULT_CATALOG_SIZE,\
+        query_ratio=DEFAULT_QUERY_RATIO,funcs=None,\
+        num_similars=DEFAULT_NUM_SIMILARS,seed=0,loop=None):
+    """
+    Fill the database db_name with catalog_size functions, and then run
+    num_clients concurrent clients, each sending num_requests messages.
+    funcs generates the function data (RandomFuncs by default, or a
+    CorpusGenerator).
+    Returns the report of the measured phase.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if funcs is None:
+        funcs = RandomFuncs()
+
+    rng = random.Random(seed)
+    catalog = funcs.catalog(rng,catalog_size)
+    if catalog_size > 0:
+        yield from _fill_catalog(host,port,db_name,catalog,loop)
+
+    # Every client gets its own random source, so that the workload does not
+    # depend on scheduling:
+    latencies = collections.defaultdict(list)
+    clients = [_bench_client(i,host,port,db_name,catalog,funcs,\
+            random.Random('{}-{}'.format(seed,i)),num_requests,query_ratio,\
+            num_similars,latencies,loop) for i in range(num_clients)]
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*clients,loop=loop)
+    duration = time.perf_counter() - start
+
+    report = summarize(latencies,duration)
+    report['config'] = {
+        'clients': num_clients,
+        'requests_per_client': num_requests,
+        'catalog_size': catalog_size,
+        'query_ratio': query_ratio,
+        'num_similars': num_similars,
+        'seed': seed,
+        'workload': type(funcs).__name__,
+    }
+    return report
+
+
+###################################################################
+# Local server:
+
+def _local_server_main(sock,db_base_path,num_hashes,use_sig_index):
+    """
+    Serve fcatalog clients on sock until SIGTERM is received.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    @asyncio.coroutine
+    def client_handler(frame_endpoint):
+        try:
+            msg_endpoint = MsgFromFrame(cser_serializer,frame_endpoint)
+            sl = FCatalogServerLogic(db_base_path,num_hashes,msg_endpoint,\
+                    use_sig_index=use_sig_index)
+            yield from sl.client_handler()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            yield from frame_endpoint.close()
+
+    @asyncio.coroutine
+    def stream_client_handler(reader,writer):
+        yield from client_handler(TCPFrameEndpoint(reader,writer))
+
+    if HAS_BUFFERED_PROTOCOL:
+        coro = start_frame_server(client_handler,host=None,port=None,\
+                loop=loop,sock=sock)
+    else:
+        coro = asyncio.start_server(stream_client_handler,loop=loop,\
+                sock=sock)
+    server = loop.run_until_complete(coro)
+
+    loop.add_signal_handler(signal.SIGTERM,loop.stop)
+    loop.run_forever()
+
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    tasks = all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.wait(tasks,loop=loop))
+    loop.close()
+
+
+class LocalServer:
+    """
+    A fcatalog server running in a child process, on a free port of
+    127.0.0.1.
+    """
+    def __init__(self,db_base_path,num_hashes=NUM_HASHES,use_sig_index=False):
+        self.host = '127.0.0.1'
+        sock = create_listen_socket(self.host,0)
+        self.port = sock.getsockname()[1]
+        self._process = multiprocessing.get_context('fork').Process(\
+                target=_local_server_main,\
+                args=(sock,db_base_path,num_hashes,use_sig_index))
+        self._process.start()
+        # The child process has its own copy of the listening socket:
+        sock.close()
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+###################################################################
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='fcatalog-bench',\
+            description='Load generator and latency benchmark for the'
+            ' fcatalog server. Prints a JSON report.')
+    parser.add_argument('--host',default='127.0.0.1',\
+            help='Server host (Used with --port)')
+    parser.add_argument('--port',type=int,default=None,\
+            help='Benchmark a running server on this port. By default a'
+            ' local server is started, with a temporary database directory')
+    parser.add_argument('--db-name',default='bench',\
+            help='Database to use (Default: bench)')
+    parser.add_argument('--clients',type=int,default=DEFAULT_CLIENTS,\
+            help='Amount of concurrent clients (Default: {})'.\
+            format(DEFAULT_CLIENTS))
+    parser.add_argument('--requests',type=int,default=DEFAULT_REQUESTS,\
+            help='Amount of messages sent by every client (Default: {})'.\
+            format(DEFAULT_REQUESTS))
+    parser.add_argument('--catalog-size',type=int,\
+            default=DEFAULT_CATALOG_SIZE,\
+            help='Amount of functions added before measuring'
+            ' (Default: {})'.format(DEFAULT_CATALOG_SIZE))
+    parser.add_argument('--query-ratio',type=float,\
+            default=DEFAULT_QUERY_RATIO,\
+            help='Fraction of the messages that are queries. The rest add'
+            ' functions (Default: {})'.format(DEFAULT_QUERY_RATIO))
+    parser.add_argument('--workload',choices=('random','corpus'),\
+            default='random',\
+            help='Function data: random bytes, or function families of a'
+            ' synthetic corpus (Default: random)')
+    parser.add_argument('--min-func-len',type=int,\
+            default=DEFAULT_MIN_FUNC_LEN,\
+            help='Minimum function length (Default: {})'.\
+            format(DEFAULT_MIN_FUNC_LEN))
+    parser.add_argument('--max-func-len',type=int,\
+            default=DEFAULT_MAX_FUNC_LEN,\
+            help='Maximum function length (Default: {})'.\
+            format(DEFAULT_MAX_FUNC_LEN))
+    parser.add_argument('--num-similars',type=int,\
+            default=DEFAULT_NUM_SIMILARS,\
+            help='Amount of similars asked for in a query (Default: {})'.\
+            format(DEFAULT_NUM_SIMILARS))
+    parser.add_argument('--seed',type=int,default=0,\
+            help='Seed of the workload (Default: 0)')
+    parser.add_argument('--use-sig-index',action='store_true',\
+            help='Local server only: Answer queries using the signature'
+            ' index')
+    parser.add_argument('--output',default=None,\
+            help='Write the report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.clients < 1 or args.requests < 0 or args.catalog_size < 0:
+        parser.error('Invalid amounts of clients, requests or functions')
+    if not (0.0 <= args.query_ratio <= 1.0):
+        parser.error('--query-ratio must be between 0 and 1')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    local_server = None
+    db_base_path = None
+    host,port = args.host,args.port
+    if port is None:
+        db_base_path = tempfile.mkdtemp(prefix='fcatalog-bench-')
+        local_server = LocalServer(db_base_path,\
+                use_sig_index=args.use_sig_index)
+        host,port = local_server.host,local_server.port
+
+    if args.workload == 'corpus':
+        funcs = CorpusGenerator(seed=args.seed,min_len=args.min_func_len,\
+                max_len=args.max_func_len)
+    else:
+        funcs = RandomFuncs(args.min_func_len,args.max_func_len)
+
+    loop = asyncio.new_event_loop()
+    try:
+        report = loop.run_until_complete(run_bench(host,port,\
+                db_name=args.db_name,num_clients=args.clients,\
+                num_requests=args.requests,catalog_size=args.catalog_size,\
+                query_ratio=args.query_ratio,\
+                funcs=funcs,\
+                num_similars=args.num_similars,seed=args.seed,loop=loop))
+    finally:
+        loop.close()
+        if local_server is not None:
+            local_server.stop()
+            shutil.rmtree(db_base_path)
+
+    report['config']['server'] = \
+            'local' if local_server is not None else '{}:{}'.format(host,port)
+    text = json.dumps(report,indent=2,sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output,'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+import math
+import json
+import bisect
+import random
+import argparse
+import collections
+
+# A synthetic corpus of functions, for benchmarks and recall measurements:
+# Random bytes share almost no catalog1 hash values. Real catalogues are
+# different: compilers emit the same idioms (Prologues, epilogues, common
+# instruction sequences) in many functions, and many functions are variants of
+# each other (Different versions or builds of the same code).
+#
+# The corpus is made of families. The first function of a family (The base
+# function) is built from a prologue/epilogue template, snippets taken from a
+# shared pool with a Zipfian distribution (A few snippets are very common) and
+# unique bytes. The other functions of the family are mutations of the base
+# function: renamed registers, byte edits, inserted snippets and deleted
+# bytes.
+#
+# The family of every function is the ground truth: Functions of the same
+# family are similar, functions of different families are not.
+#
+# The corpus is deterministic: The same parameters and seed give the same
+# functions.
+
+class CorpusError(Exception): pass
+
+# Default range of function lengths. Lengths are distributed uniformly on a log
+# scale between these:
+DEFAULT_MIN_FUNC_LEN = 0x40
+DEFAULT_MAX_FUNC_LEN = 0x1000
+
+# Default amount of snippets in the shared pool:
+DEFAULT_NUM_SNIPPETS = 0x400
+# Default exponent of the Zipfian distribution of snippets. (The k-th most
+# common snippet is chosen with probability proportional to 1/k^skew):
+DEFAULT_SNIPPET_SKEW = 1.1
+# Default fraction of the function body made of shared snippets:
+DEFAULT_SNIPPET_RATIO = 0.5
+# Default amount of mutations applied to create a family member, relative to
+# the length of the function:
+DEFAULT_MUTATION_RATE = 0.02
+# Default range of family sizes:
+DEFAULT_MIN_FAMILY_SIZE = 1
+DEFAULT_MAX_FAMILY_SIZE = 8
+
+# Probability that two registers are renamed in a family member:
+RENAME_PROB = 0.25
+
+# Lengths of snippets in the pool:
+MIN_SNIPPET_LEN = 2
+MAX_SNIPPET_LEN = 16
+
+# Common x86 prologue and epilogue templates. The first ones are more common:
+TEMPLATES = [
+    # push ebp; mov ebp,esp ... pop ebp; ret
+    (b'\x55\x8b\xec',b'\x5d\xc3'),
+    # push ebp; mov ebp,esp; sub esp,imm8 ... leave; ret
+    (b'\x55\x8b\xec\x83\xec\x10',b'\xc9\xc3'),
+    # push ebx; push esi; push edi ... pop edi; pop esi; pop ebx; ret
+    (b'\x53\x56\x57',b'\x5f\x5e\x5b\xc3'),
+    # push rbp; mov rbp,rsp ... pop rbp; ret
+    (b'\x55\x48\x89\xe5',b'\x5d\xc3'),
+    # sub rsp,imm8 ... add rsp,imm8; ret
+    (b'\x48\x83\xec\x28',b'\x48\x83\xc4\x28\xc3'),
+]
+
+# A function of the corpus:
+CorpusFunc = collections.namedtuple('CorpusFunc',['name','family','data'])
+
+
+def log_uniform_len(rng,min_len,max_len):
+    """
+    Get a length distributed uniformly on a log scale between min_len and
+    max_len.
+    """
+    return int(round(math.exp(rng.uniform(\
+            math.log(min_len),math.log(max_len)))))
+
+
+def rand_bytes(rng,n):
+    """
+    Get n random bytes.
+    """
+    return bytes(rng.getrandbits(8) for i in range(n))
+
+
+class ZipfChooser:
+    """
+    Choose items from a list, with the k-th item chosen with probability
+    proportional to 1/k^skew.
+    """
+    def __init__(self,items,skew):
+        self._items = items
+        self._cum_weights = []
+        total = 0.0
+        for k in range(1,len(items) + 1):
+            total += 1.0 / (k ** skew)
+            self._cum_weights.append(total)
+
+    def choose(self,rng):
+        i = bisect.bisect(self._cum_weights,rng.random() * \
+                self._cum_weights[-1])
+        return self._items[min(i,len(self._items) - 1)]
+
+
+def rename_register(data,reg_a,reg_b):
+    """
+    Swap two registers in all the register to register ModRM bytes (mod=11)
+    of data.
+    """
+    def swap(reg):
+        if reg == reg_a:
+            return reg_b
+        if reg == reg_b:
+            return reg_a
+        return reg
+
+    res = bytearray(data)
+    for i,b in enumerate(res):
+        if b >= 0xc0:
+            res[i] = 0xc0 | (swap((b >> 3) & 7) << 3) | swap(b & 7)
+    return bytes(res)
+
+
+class CorpusGenerator:
+    def __init__(self,seed=0,min_len=DEFAULT_MIN_FUNC_LEN,\
+            max_len=DEFAULT_MAX_FUNC_LEN,num_snippets=DEFAULT_NUM_SNIPPETS,\
+            snippet_skew=DEFAULT_SNIPPET_SKEW,\
+            snippet_ratio=DEFAULT_SNIPPET_RATIO,\
+            mutation_rate=DEFAULT_MUTATION_RATE,\
+            min_family_size=DEFAULT_MIN_FAMILY_SIZE,\
+            max_family_size=DEFAULT_MAX_FAMILY_SIZE):
+        if not (0 < min_len <= max_len):
+            raise CorpusError('Invalid function lengths range {}..{}'.\
+                    format(min_len,max_len))
+        if not (0 < min_family_size <= max_family_size):
+            raise CorpusError('Invalid family sizes range {}..{}'.\
+                    format(min_family_size,max_family_size))
+        if num_snippets < 1:
+            raise CorpusError('At least one snippet is needed')
+
+        self._seed = seed
+        self._min_len = min_len
+        self._max_len = max_len
+        self._snippet_ratio = snippet_ratio
+        self._mutation_rate = mutation_rate
+        self._min_family_size = min_family_size
+        self._max_family_size = max_family_size
+
+        # The shared pool of snippets:
+        rng = random.Random('snippets-{}'.format(seed))
+        self._snippets = ZipfChooser([rand_bytes(rng,\
+                rng.randint(MIN_SNIPPET_LEN,MAX_SNIPPET_LEN)) \
+                for i in range(num_snippets)],snippet_skew)
+        self._templates = ZipfChooser(TEMPLATES,1.0)
+
+    def base_func(self,rng):
+        """
+        Build the base function of a new family.
+        """
+        prologue,epilogue = self._templates.choose(rng)
+        body_len = max(log_uniform_len(rng,self._min_len,self._max_len) - \
+                len(prologue) - len(epilogue),1)
+
+        parts = []
+        cur_len = 0
+        while cur_len < body_len:
+            if rng.random() < self._snippet_ratio:
+                part = self._snippets.choose(rng)
+            else:
+                part = rand_bytes(rng,\
+                        rng.randint(MIN_SNIPPET_LEN,MAX_SNIPPET_LEN))
+            parts.append(part)
+            cur_len += len(part)
+
+        return prologue + b''.join(parts)[:body_len] + epilogue
+
+    def mutate(self,rng,func_data):
+        """
+        Create a variant of func_data.
+        """
+        data = bytearray(func_data)
+        if rng.random() < RENAME_PROB:
+            reg_a,reg_b = rng.sample(range(8),2)
+            data = bytearray(rename_register(data,reg_a,reg_b))
+
+        num_mutations = max(1,int(len(data) * self._mutation_rate))
+        for i in range(num_mutations):
+            op = rng.random()
+            pos = rng.randrange(len(data))
+            if op < 0.6:
+                # Change a byte (An immediate, an offset):
+                data[pos] = rng.getrandbits(8)
+            elif op < 0.8:
+                # Insert a snippet:
+                data[pos:pos] = self._snippets.choose(rng)
+            elif len(data) > MAX_SNIPPET_LEN:
+                # Delete a few bytes:
+                del data[pos:pos + rng.randint(1,MIN_SNIPPET_LEN * 2)]
+        return bytes(data)
+
+    def family(self,rng,family_size):
+        """
+        Build a family of family_size functions. The first one is the base
+        function.
+        """
+        base = self.base_func(rng)
+        return [base] + [self.mutate(rng,base) \
+                for i in range(family_size - 1)]
+
+    def generate(self,num_families):
+        """
+        Generate the functions of num_families families.
+        Returns a list of CorpusFunc.
+        """
+        funcs = []
+        for family_idx in range(num_families):
+            # Every family has its own random source, so that a family does not
+            # depend on the amount of families generated:
+            rng = random.Random('family-{}-{}'.format(self._seed,family_idx))
+            family_size = rng.randint(self._min_family_size,\
+                    self._max_family_size)
+            for member_idx,data in \
+                    enumerate(self.family(rng,family_size)):
+                funcs.append(CorpusFunc(\
+                        name='f{}_{}'.format(family_idx,member_idx),\
+                        family=family_idx,data=data))
+        return funcs
+
+    ###########################################################
+    # Workload interface for fcatalog-bench:
+
+    def catalog(self,rng,size):
+        """
+        Get the data of size functions, made of whole families.
+        """
+        funcs = []
+        while len(funcs) < size:
+            funcs += self.family(rng,rng.randint(self._min_family_size,\
+                    self._max_family_size))
+        return funcs[:size]
+
+    def new_func(self,rng):
+        """
+        Get the data of a function of a new family.
+        """
+        return self.base_func(rng)
+
+    def query_func(self,rng,catalog):
+        """
+        Get the data of a function to look for: A new variant of a function
+        of the catalogue.
+        """
+        return self.mutate(rng,rng.choice(catalog))
+
+
+###################################################################
+# Ground truth:
+
+def family_recall(corpus_funcs,results):
+    """
+    Measure how many of the similar functions were found.
+    results maps a function name to the list of function names found for it.
+    Returns the fraction of the other members of every function's family that
+    were found, averaged over all the queries that have such members.
+    """
+    families = collections.defaultdict(set)
+    for func in corpus_funcs:
+        families[func.family].add(func.name)
+    family_of = {func.name: func.family for func in corpus_funcs}
+
+    recalls = []
+    for name,found in results.items():
+        expected = families[family_of[name]] - {name}
+        if len(expected) == 0:
+            continue
+        recalls.append(len(expected.intersection(found)) / len(expected))
+
+    if len(recalls) == 0:
+        return None
+    return sum(recalls) / len(recalls)
+
+
+def dump_corpus(corpus_funcs,f):
+    """
+    Write a corpus to a file, as JSON lines.
+    """
+    for func in corpus_funcs:
+        f.write(json.dumps({'name': func.name,'family': func.family,\
+                'data': func.data.hex()}) + '\n')
+
+
+def load_corpus(f):
+    """
+    Read a corpus written by dump_corpus.
+    """
+    corpus_funcs = []
+    for line in f:
+        obj = json.loads(line)
+        corpus_funcs.append(CorpusFunc(name=obj['name'],\
+                family=obj['family'],data=bytes.fromhex(obj['data'])))
+    return corpus_funcs
+
+
+###################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='fcatalog-corpus',\
+            description='Generate a synthetic corpus of function families.'
+            ' Writes JSON lines with the name, family and data (hex) of every'
+            ' function.')
+    parser.add_argument('output',help='Output file')
+    parser.add_argument('--families',type=int,default=1000,\
+            help='Amount of families (Default: 1000)')
+    parser.add_argument('--seed',type=int,default=0,\
+            help='Seed (Default: 0)')
+    parser.add_argument('--min-family-size',type=int,\
+            default=DEFAULT_MIN_FAMILY_SIZE)
+    parser.add_argument('--max-family-size',type=int,\
+            default=DEFAULT_MAX_FAMILY_SIZE)
+    parser.add_argument('--min-func-len',type=int,\
+            default=DEFAULT_MIN_FUNC_LEN)
+    parser.add_argument('--max-func-len',type=int,\
+            default=DEFAULT_MAX_FUNC_LEN)
+    parser.add_argument('--snippets',type=int,default=DEFAULT_NUM_SNIPPETS,\
+            help='Amount of shared snippets (Default: {})'.\
+            format(DEFAULT_NUM_SNIPPETS))
+    parser.add_argument('--snippet-skew',type=float,\
+            default=DEFAULT_SNIPPET_SKEW,\
+            help='Zipf exponent of the snippets distribution (Default: {})'.\
+            format(DEFAULT_SNIPPET_SKEW))
+    parser.add_argument('--mutation-rate',type=float,\
+            default=DEFAULT_MUTATION_RATE,\
+            help='Mutations per byte in family members (Default: {})'.\
+            format(DEFAULT_MUTATION_RATE))
+    args = parser.parse_args(argv)
+
+    try:
+        gen = CorpusGenerator(seed=args.seed,min_len=args.min_func_len,\
+                max_len=args.max_func_len,num_snippets=args.snippets,\
+                snippet_skew=args.snippet_skew,\
+                mutation_rate=args.mutation_rate,\
+                min_family_size=args.min_family_size,\
+                max_family_size=args.max_family_size)
+    except CorpusError as e:
+        parser.error(str(e))
+
+    with open(args.output,'w') as f:
+        dump_corpus(gen.generate(args.families),f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+
+from fcatalog.funcs_db import FuncsDB,TUNING_PROFILES
+from fcatalog.sig_index import SIG_INDEX_SUFFIX
+
+# fcatalog-migrate: Convert a database created before signature clusters
+# existed to the clustered layout, in place (See Signature clusters in
+# fcatalog.funcs_db). Signatures move to the narrow sigs table, and names and
+# comments stay in funcs, which is only read for the final results of
+# queries.
+#
+# The migration holds the write lock of the database while it runs, and
+# server processes that have the database open keep using the old layout. Stop
+# the server first. The signature index of the database (If any) is deleted,
+# and is built again when the database is next opened with use_sig_index.
+
+# Default amount of hashes for signature (As in server_conf):
+NUM_HASHES = 16
+
+# Default tuning profile of the migration (See fcatalog.funcs_db):
+TUNING_PROFILE = 'bulk'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='fcatalog-migrate',\
+            description='Convert a fcatalog database to the clustered'
+            ' layout, in place. Prints JSON.')
+    parser.add_argument('db_path',help='Database file')
+    parser.add_argument('--num-hashes',type=int,default=NUM_HASHES,\
+            help='Amount of hashes for signature (Default: {})'.\
+            format(NUM_HASHES))
+    parser.add_argument('--tuning-profile',default=TUNING_PROFILE,\
+            choices=sorted(TUNING_PROFILES),\
+            help='SQLite tuning profile (Default: {})'.format(TUNING_PROFILE))
+    parser.add_argument('--no-vacuum',action='store_true',\
+            help='Do not rebuild the database file afterwards. (The space of'
+            ' the old table is then only reused by new rows)')
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.db_path):
+        parser.error('No database at {}'.format(args.db_path))
+
+    size_before = os.path.getsize(args.db_path)
+    fdb = FuncsDB(args.db_path,args.num_hashes,\
+            tuning_profile=args.tuning_profile)
+    try:
+        migrated = fdb.cluster_signatures()
+    finally:
+        fdb.close()
+
+    index_path = args.db_path + SIG_INDEX_SUFFIX
+    if migrated and os.path.isfile(index_path):
+        os.unlink(index_path)
+
+    if migrated and not args.no_vacuum:
+        conn = sqlite3.connect(args.db_path,isolation_level=None)
+        try:
+            # Let maintenance return free pages to the file system from now
+            # on (See Maintenance in fcatalog.funcs_db):
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+
+    conn = sqlite3.connect(args.db_path)
+    try:
+        num_funcs = conn.execute('SELECT COUNT(*) FROM funcs').fetchone()[0]
+        num_sigs = conn.execute('SELECT COUNT(*) FROM sigs').fetchone()[0]
+    finally:
+        conn.close()
+
+    json.dump({
+        'migrated': migrated,
+        'functions': num_funcs,
+        'signatures': num_sigs,
+        'size_before': size_before,
+        'size_after': os.path.getsize(args.db_path),
+    },sys.stdout,indent=2,sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import collections
+
+from fcatalog.proto.frame_endpoint import TCPFrameEndpoint
+from fcatalog.proto.serializer import unpack_msg_type
+from fcatalog.proto.capture import read_capture,RECORD_OPEN,RECORD_FRAME,\
+        RECORD_CLOSE
+from fcatalog.client.fcatalog_client import client_serializer
+from fcatalog.tools.bench import LocalServer,summarize
+
+# fcatalog-replay: Replay captured traffic (See fcatalog.proto.capture)
+# against a server.
+# Every captured session is replayed on its own connection. Frames are sent
+# at their original times (Optionally sped up), or as fast as possible.
+# Responses are read, and the latency of every request that has a response is
+# measured. The result is a JSON report, like the one of fcatalog-bench.
+# Captured ChallengeResponse frames answer challenges of the original server,
+# which the replay target did not send. The target closes connections that
+# send unexpected ChallengeResponse messages, so they are skipped (And counted
+# in the report). Challenges of the target are not answered.
+
+class ReplayError(Exception): pass
+
+# Requests that get a response, and the name of the response:
+RESPONSES = {
+    'RequestSimilars': 'ResponseSimilars',
+    'RequestSimilarsSigned': 'ResponseSimilars',
+    'BeginRequestSimilars': 'ResponseSimilars',
+    'RequestCompression': 'ResponseCompression',
+}
+
+# Responses that are sent instead of others on some connections (After a
+# SetQueryLimits):
+RESPONSE_ALIASES = {
+    'ResponseSimilarsApprox': 'ResponseSimilars',
+}
+
+# Time to wait for the responses of a session after all its frames were sent,
+# in seconds:
+RESPONSE_TIMEOUT = 30.0
+
+# A captured session: The time it was opened, and a list of (timestamp,frame):
+Session = collections.namedtuple('Session',['start','frames'])
+
+
+def load_sessions(files):
+    """
+    Read the sessions of a few capture logs (Binary file objects). Logs of
+    different worker processes may be merged, as all timestamps are absolute.
+    Returns a list of Session, sorted by start time.
+    """
+    sessions = []
+    for f in files:
+        # The session of every open conn_id:
+        open_sessions = {}
+        for record in read_capture(f):
+            if record.kind == RECORD_OPEN:
+                session = Session(start=record.timestamp,frames=[])
+                open_sessions[record.conn_id] = session
+                sessions.append(session)
+            elif record.kind == RECORD_FRAME:
+                session = open_sessions.get(record.conn_id)
+                if session is not None:
+                    session.frames.append((record.timestamp,record.data))
+            elif record.kind == RECORD_CLOSE:
+                open_sessions.pop(record.conn_id,None)
+
+    sessions.sort(key=lambda session: session.start)
+    return sessions
+
+
+def _msg_name(frame):
+    """
+    Get the name of the message in a frame.
+    """
+    msg_type,msg_data = unpack_msg_type(frame)
+    return client_serializer.msg_type_to_msg_name(msg_type)
+
+
+class _SessionReplay:
+    def __init__(self,frame_endpoint,latencies,loop):
+        self._frame_endpoint = frame_endpoint
+        self._latencies = latencies
+        self._loop = loop
+        # (request name,response name,send time) of requests waiting for a
+        # response, in order:
+        self._pending = collections.deque()
+        self._drained = asyncio.Event(loop=loop)
+        self._drained.set()
+        self.closed_early = False
+
+    def sent(self,msg_name):
+        """
+        A frame with a message msg_name was sent.
+        """
+        response_name = RESPONSES.get(msg_name)
+        if response_name is None:
+            return
+        self._pending.append((msg_name,response_name,time.perf_counter()))
+        self._drained.clear()
+
+    @asyncio.coroutine
+    def recv_loop(self):
+        """
+        Read the responses of the server.
+        """
+        try:
+            while True:
+                frame = yield from self._frame_endpoint.recv()
+                if frame is None:
+                    if self._pending:
+                        self.closed_early = True
+                    break
+                msg_name = _msg_name(frame)
+                if msg_name == 'ResponseCompression':
+                    msg_inst = client_serializer.deserialize_msg(frame)
+                    if msg_inst.get_field('accepted'):
+                        self._frame_endpoint.enable_compression()
+                msg_name = RESPONSE_ALIASES.get(msg_name,msg_name)
+                if not self._pending or self._pending[0][1] != msg_name:
+                    # Not a response to a request (A ChallengeFuncData):
+                    continue
+                request_name,response_name,start = self._pending.popleft()
+                self._latencies[request_name].append(\
+                        time.perf_counter() - start)
+                if not self._pending:
+                    self._drained.set()
+        finally:
+            self._drained.set()
+
+    @asyncio.coroutine
+    def wait_drained(self):
+        yield from asyncio.wait_for(self._drained.wait(),RESPONSE_TIMEOUT,\
+                loop=self._loop)
+
+
+@asyncio.coroutine
+def _replay_session(host,port,session,time_base,speed,latencies,stats,loop):
+    """
+    Replay one session. Frames are sent at their original times, divided by
+    speed, relative to time_base (A (capture time,loop time) pair). If speed
+    is 0, frames are sent as fast as possible.
+    """
+    capture_base,loop_base = time_base
+
+    @asyncio.coroutine
+    def wait_until(timestamp):
+        if speed <= 0:
+            return
+        delay = loop_base + (timestamp - capture_base) / speed - loop.time()
+        if delay > 0:
+            yield from asyncio.sleep(delay,loop=loop)
+
+    yield from wait_until(session.start)
+    reader,writer = yield from asyncio.open_connection(host=host,port=port,\
+            loop=loop)
+    frame_endpoint = TCPFrameEndpoint(reader,writer)
+    replay = _SessionReplay(frame_endpoint,latencies,loop)
+    recv_task = asyncio.ensure_future(replay.recv_loop(),loop=loop)
+    # The first message of the current chunked transfer:
+    chunked_begin = None
+    try:
+        for timestamp,frame in session.frames:
+            yield from wait_until(timestamp)
+            msg_name = _msg_name(frame)
+            if msg_name == 'ChallengeResponse':
+                stats['skipped_challenge_responses'] += 1
+                continue
+            if msg_name in ('BeginRequestSimilars','BeginAddFunction'):
+                chunked_begin = msg_name
+                msg_name = None
+            elif msg_name == 'EndFuncData':
+                # A chunked query is answered after its last chunk:
+                msg_name,chunked_begin = chunked_begin,None
+            yield from frame_endpoint.send(frame)
+            if msg_name is not None:
+                replay.sent(msg_name)
+            stats['frames'] += 1
+
+        try:
+            yield from replay.wait_drained()
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
+    finally:
+        yield from frame_endpoint.close()
+        recv_task.cancel()
+        yield from asyncio.wait([recv_task],loop=loop)
+
+    if replay.closed_early:
+        stats['closed_early'] += 1
+
+
+@asyncio.coroutine
+def run_replay(host,port,sessions,speed=1.0,loop=None):
+    """
+    Replay sessions (A list of Session) against a server.
+    Returns a report with the latencies of requests.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if len(sessions) == 0:
+        raise ReplayError('No sessions to replay')
+
+    latencies = collections.defaultdict(list)
+    stats = {'frames': 0,'timeouts': 0,'closed_early': 0,\
+            'skipped_challenge_responses': 0}
+    time_base = (sessions[0].start,loop.time())
+
+    start = time.perf_counter()
+    yield from asyncio.gather(*[_replay_session(host,port,session,time_base,\
+            speed,latencies,stats,loop) for session in sessions],loop=loop)
+    duration = time.perf_counter() - start
+
+    report = summarize(latencies,duration)
+    report['sessions'] = len(sessions)
+    report.update(stats)
+    return report
+
+
+###################################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='fcatalog-replay',\
+            description='Replay captured traffic against a fcatalog server.'
+            ' Prints a JSON report.')
+    parser.add_argument('captures',nargs='+',help='Capture log files')
+    parser.add_argument('--host',default='127.0.0.1',\
+            help='Server host (Used with --port)')
+    parser.add_argument('--port',type=int,default=None,\
+            help='Replay against a running server on this port. By default a'
+            ' local server is started, with a temporary database directory')
+    parser.add_argument('--speed',type=float,default=1.0,\
+            help='Speed relative to the original timing. 0 sends as fast as'
+            ' possible (Default: 1)')
+    parser.add_argument('--use-sig-index',action='store_true',\
+            help='Local server only: Answer queries using the signature'
+            ' index')
+    parser.add_argument('--output',default=None,\
+            help='Write the report to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.speed < 0:
+        parser.error('--speed must not be negative')
+
+    sessions = []
+    for path in args.captures:
+        with open(path,'rb') as f:
+            sessions += load_sessions([f])
+    sessions.sort(key=lambda session: session.start)
+
+    local_server = None
+    db_base_path = None
+    host,port = args.host,args.port
+    if port is None:
+        db_base_path = tempfile.mkdtemp(prefix='fcatalog-replay-')
+        local_server = LocalServer(db_base_path,\
+                use_sig_index=args.use_sig_index)
+        host,port = local_server.host,local_server.port
+
+    loop = asyncio.new_event_loop()
+    try:
+        report = loop.run_until_complete(run_replay(host,port,sessions,\
+                speed=args.speed,loop=loop))
+    finally:
+        loop.close()
+        if local_server is not None:
+            local_server.stop()
+            shutil.rmtree(db_base_path)
+
+    text = json.dumps(report,indent=2,sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output,'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
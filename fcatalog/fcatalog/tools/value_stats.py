@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import argparse
+
+from fcatalog.funcs_db import FuncsDB
+
+# fcatalog-value-stats: Show the hot signature values of a database (See Hot
+# values in fcatalog.funcs_db), and rebuild its value counts offline. A
+# rebuild holds the write lock of the database while it runs, so it is better
+# done while the server is stopped.
+
+# Default amount of values shown:
+DEFAULT_TOP = 20
+
+# Default amount of hashes for signature (As in server_conf):
+NUM_HASHES = 16
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='fcatalog-value-stats',\
+            description='Show the most common signature values of a fcatalog'
+            ' database. Prints JSON.')
+    parser.add_argument('db_path',help='Database file')
+    parser.add_argument('--rebuild',action='store_true',\
+            help='Count the values of all the functions again first')
+    parser.add_argument('--top',type=int,default=DEFAULT_TOP,\
+            help='Amount of values to show (Default: {})'.format(DEFAULT_TOP))
+    parser.add_argument('--num-hashes',type=int,default=NUM_HASHES,\
+            help='Amount of hashes for signature (Default: {})'.\
+            format(NUM_HASHES))
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.db_path):
+        parser.error('No database at {}'.format(args.db_path))
+
+    fdb = FuncsDB(args.db_path,args.num_hashes)
+    try:
+        if args.rebuild:
+            fdb.rebuild_value_counts()
+        hot_values = fdb.hot_values(args.top)
+    finally:
+        fdb.close()
+
+    json.dump([{'col': col,'value': value,'count': count} \
+            for col,value,count in hot_values],sys.stdout,indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
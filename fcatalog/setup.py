@@ -92,7 +92,11 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'sample=sample:main',
+            'fcatalog-bench=fcatalog.tools.bench:main',
+            'fcatalog-corpus=fcatalog.tools.corpus:main',
+            'fcatalog-migrate=fcatalog.tools.migrate:main',
+            'fcatalog-replay=fcatalog.tools.replay:main',
+            'fcatalog-value-stats=fcatalog.tools.value_stats:main',
         ],
     },
 )